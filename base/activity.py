@@ -0,0 +1,122 @@
+"""
+Keeps the denormalized activity columns on Room (message_count, last_message_at, participants) in step with Message.
+
+Every change is a single UPDATE expressed relative to the current row (F expressions), so concurrent posters can not
+overwrite each other's counts. recount_rooms rebuilds everything from the Message table in case the counters ever
+drift, it is what ``python manage.py recount_room_activity`` runs.
+"""
+from django.db import transaction
+from django.db.models import Count, F, Max, Subquery
+from django.db.models.functions import Coalesce, Greatest
+from django.utils import timezone
+
+from . import metrics
+from .models import ArchivedMessage, Message, Room
+
+Participant = Room.participants.through
+
+
+def record_message(message):
+    """
+    Called once a new message is saved: bumps the room counters and makes the author a participant.
+    updated_at is bumped as well so the home page ordering follows room activity.
+    """
+    Room.objects.filter(id=message.room_id).update(
+        message_count=F("message_count") + 1,
+        last_message_at=Greatest(Coalesce(F("last_message_at"), message.created_at), message.created_at),
+        updated_at=timezone.now(),
+    )
+    if message.user_id:
+        Participant.objects.bulk_create(
+            [Participant(room_id=message.room_id, user_id=message.user_id)], ignore_conflicts=True
+        )
+    metrics.messages_posted.inc()
+
+
+def record_messages(messages):
+    """
+    Same as record_message for a batch of messages written with bulk_create, which does not send post_save.
+    It runs one UPDATE per room in the batch rather than one per message.
+    """
+    rooms = {}
+    for message in messages:
+        count, latest = rooms.get(message.room_id, (0, message.created_at))
+        rooms[message.room_id] = (count + 1, max(latest, message.created_at))
+    now = timezone.now()
+    for room_id, (count, latest) in rooms.items():
+        Room.objects.filter(id=room_id).update(
+            message_count=F("message_count") + count,
+            last_message_at=Greatest(Coalesce(F("last_message_at"), latest), latest),
+            updated_at=now,
+        )
+    Participant.objects.bulk_create(
+        [
+            Participant(room_id=room_id, user_id=user_id)
+            for room_id, user_id in {(message.room_id, message.user_id) for message in messages if message.user_id}
+        ],
+        ignore_conflicts=True,
+    )
+    metrics.messages_posted.inc(amount=len(messages))
+
+
+def forget_message(message):
+    """
+    Called after a message is deleted. last_message_at is re-read from the (room, created_at, id) index in the same
+    statement and the author stops being a participant once they have no messages left in the room.
+    """
+    # archived messages (base/archive.py) are older than every hot one, they only matter once the hot ones are gone
+    latest = [
+        Subquery(model.objects.filter(room_id=message.room_id).order_by("-created_at", "-id").values("created_at")[:1])
+        for model in (Message, ArchivedMessage)
+    ]
+    Room.objects.filter(id=message.room_id).update(
+        message_count=Greatest(F("message_count") - 1, 0),
+        last_message_at=Coalesce(*latest),
+        updated_at=timezone.now(),  # the room page is served with updated_at as its Last-Modified date
+    )
+    if message.user_id and not any(
+        model.objects.filter(room_id=message.room_id, user_id=message.user_id).exists()
+        for model in (Message, ArchivedMessage)
+    ):
+        Participant.objects.filter(room_id=message.room_id, user_id=message.user_id).delete()
+
+
+def recount_rooms(room_ids):
+    """
+    Recomputes message_count, last_message_at and participants for the given rooms from scratch, counting archived
+    messages too.
+    """
+    with transaction.atomic():
+        counts = {}
+        latest = {}
+        authors = set()
+        # archived messages (base/archive.py) still belong to their room
+        for model in (Message, ArchivedMessage):
+            for row in (
+                model.objects.filter(room_id__in=room_ids)
+                .order_by()
+                .values("room_id")
+                .annotate(count=Count("id"), latest=Max("created_at"))
+            ):
+                counts[row["room_id"]] = counts.get(row["room_id"], 0) + row["count"]
+                latest[row["room_id"]] = max(latest.get(row["room_id"], row["latest"]), row["latest"])
+            authors.update(
+                model.objects.filter(room_id__in=room_ids, user__isnull=False)
+                .order_by()
+                .values_list("room_id", "user_id")
+                .distinct()
+            )
+        rooms = list(Room.objects.filter(id__in=room_ids).only("id"))
+        for room in rooms:
+            room.message_count = counts.get(room.id, 0)
+            room.last_message_at = latest.get(room.id)
+        Room.objects.bulk_update(rooms, ["message_count", "last_message_at"])
+
+        current = set(Participant.objects.filter(room_id__in=room_ids).values_list("room_id", "user_id"))
+        for room_id, user_id in current - authors:
+            Participant.objects.filter(room_id=room_id, user_id=user_id).delete()
+        Participant.objects.bulk_create(
+            [Participant(room_id=room_id, user_id=user_id) for room_id, user_id in authors - current],
+            ignore_conflicts=True,
+        )
+    return len(rooms)
@@ -4,3 +4,14 @@ from django.apps import AppConfig
 class BaseConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'base'
+
+    def ready(self):
+        from django.db.models.signals import post_migrate
+
+        from . import db, signals  # noqa: F401 registers the connection and model signal receivers
+        from .indexes import ensure_expression_indexes
+
+        post_migrate.connect(ensure_expression_indexes, sender=self)
+        from .instrumentation import install_template_timing
+
+        install_template_timing()
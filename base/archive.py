@@ -0,0 +1,69 @@
+"""
+Hot and cold storage for messages.
+
+Rooms only ever show the newest messages unless someone scrolls back, yet every room query walks the same Message
+table and index, which keep growing. archive_messages moves messages older than MESSAGE_ARCHIVE_AFTER_DAYS into the
+ArchivedMessage table (the body zlib compressed, id, author and timestamps kept) so the hot table and its index stay
+small enough to stay in the page cache.
+
+Messages are moved oldest first, in (created_at, id) order, one batch per transaction. So at any moment, even after an
+interrupted run, the archived messages of a room are exactly the ones that sort before its hot messages. That is what
+lets base.pagination read the hot table first and simply continue into the archive for older pages.
+"""
+import zlib
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+
+from .models import ArchivedMessage, Message
+
+
+def _delete_messages(ids):
+    table, pk = connection.ops.quote_name(Message._meta.db_table), connection.ops.quote_name(Message._meta.pk.column)
+    # older SQLite builds take at most 999 parameters per statement
+    size = connection.features.max_query_params or len(ids)
+    with connection.cursor() as cursor:
+        for start in range(0, len(ids), size):
+            chunk = ids[start : start + size]
+            cursor.execute(f"DELETE FROM {table} WHERE {pk} IN ({', '.join(['%s'] * len(chunk))})", chunk)
+
+
+def archive_messages(older_than=None, batch_size=1000, progress=None):
+    """
+    Moves every message created before now - older_than (a timedelta) to the archive. Returns the number moved.
+    progress, when given, is called after every batch with the number of messages moved so far.
+    """
+    if older_than is None:
+        older_than = timedelta(days=settings.MESSAGE_ARCHIVE_AFTER_DAYS)
+    cutoff = timezone.now() - older_than
+    moved = 0
+    while True:
+        with transaction.atomic():
+            batch = list(
+                Message.objects.filter(created_at__lt=cutoff)
+                .order_by("created_at", "id")
+                .values_list("id", "user_id", "room_id", "body", "updated_at", "created_at")[:batch_size]
+            )
+            if not batch:
+                return moved
+            ArchivedMessage.objects.bulk_create(
+                [
+                    ArchivedMessage(
+                        id=pk,
+                        user_id=user_id,
+                        room_id=room_id,
+                        compressed_body=zlib.compress(body.encode()),
+                        updated_at=updated_at,
+                        created_at=created_at,
+                    )
+                    for pk, user_id, room_id, body, updated_at, created_at in batch
+                ]
+            )
+            # a plain DELETE without signals, the message is not gone from the room so the activity counters must not
+            # change
+            _delete_messages([row[0] for row in batch])
+        moved += len(batch)
+        if progress:
+            progress(moved)
@@ -0,0 +1,143 @@
+"""
+Cached session and user lookups.
+
+Without this, every request from a logged in user runs two queries before the view even starts: the session row
+(django_session) and then the user row (AuthenticationMiddleware). Both are now read through two cache levels:
+
+1. a bounded LRU in each process (LocalLRU), holding pickled copies so no two requests ever share an object
+2. the shared cache (CACHES), through which a process that has not seen a session or user yet finds it
+   without touching the database
+
+Local copies can not be reached from other processes, so each cached session and user has a version in the shared
+cache, a random token stored next to it: a local copy is only used while the version is the one it was stored under.
+Logging out, saving a session, changing a password or editing a profile replaces the version of that one session or
+user, so from the next request on every process goes back to the shared cache for it, where the changed entry has
+already been replaced or deleted. The local copies of everybody else stay valid. The common request costs two lookups
+of one small token in the shared cache and no query at all.
+"""
+import pickle
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+
+
+class LocalLRU:
+    """
+    A small thread-safe least-recently-used map. Entries also expire after ttl seconds, whatever the version says.
+    """
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, version):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            stored_version, expires, value = entry
+            if stored_version != version or expires < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, version, value):
+        with self._lock:
+            self._entries[key] = (version, time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+local = LocalLRU(settings.AUTH_LOCAL_CACHE["SIZE"], settings.AUTH_LOCAL_CACHE["TTL"])
+
+
+def _shared():
+    return caches[settings.SESSION_CACHE_ALIAS]
+
+
+def _user_key(user_id):
+    return f"buddies:user:{user_id}"
+
+
+def _version_key(key):
+    return f"{key}:version"
+
+
+def get_version(key):
+    """
+    Returns the current version of key from the shared cache, starting one when there is none yet.
+    """
+    shared = _shared()
+    version = shared.get(_version_key(key))
+    if version is None:
+        # add rather than set, two processes starting the version at once must end up agreeing on it
+        shared.add(_version_key(key), uuid.uuid4().hex, timeout=settings.AUTH_LOCAL_CACHE["SHARED_TIMEOUT"])
+        version = shared.get(_version_key(key))
+    return version
+
+
+def bump_version(key):
+    """
+    Makes every process drop its local copy of key. A version that expired from the shared cache does the same.
+    """
+    _shared().set(_version_key(key), uuid.uuid4().hex, timeout=settings.AUTH_LOCAL_CACHE["SHARED_TIMEOUT"])
+
+
+def local_get(key):
+    """
+    Returns a fresh copy of the value stored locally under key, or None.
+    """
+    data = local.get(key, get_version(key))
+    return None if data is None else pickle.loads(data)
+
+
+def local_set(key, value):
+    local.set(key, get_version(key), pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+
+
+def get_user(user_id, load):
+    """
+    Returns the user with this id from the local LRU, then the shared cache, and only then calls load(user_id).
+    """
+    key = _user_key(user_id)
+    user = local_get(key)
+    if user is not None:
+        return user
+    user = _shared().get(key)
+    if user is None:
+        user = load(user_id)
+        if user is None:
+            return None
+        _shared().set(key, user, timeout=settings.AUTH_LOCAL_CACHE["SHARED_TIMEOUT"])
+    local_set(key, user)
+    return user
+
+
+def forget_user(user_id):
+    """
+    Drops the cached user everywhere once the current transaction commits.
+    """
+
+    def forget():
+        _shared().delete(_user_key(user_id))
+        local.delete(_user_key(user_id))
+        bump_version(_user_key(user_id))
+
+    transaction.on_commit(forget)
@@ -0,0 +1,85 @@
+"""
+Prefix search behind the topic autocomplete endpoint and the AutocompleteWidget used by RoomForm.
+
+A `<select>` with every topic grows with the table and loads all of it on every form render. The widget instead renders
+only the current value and asks /autocomplete/topics/?q=... for suggestions as the user types.
+
+The lookups are range queries on lower(name), e.g. "py" becomes lower(name) >= 'py' AND lower(name) < 'pz'. SQLite
+answers that from the lower(name) expression index on Topic by seeking to the first match and reading the next few
+entries, unlike istartswith (LIKE) which does not use it. So a lookup costs the same with ten topics or a million.
+"""
+import string
+import sys
+
+from django import forms
+from django.conf import settings
+from django.db.models.functions import Lower
+from django.urls import reverse
+
+from .models import Topic
+
+
+# SQLite's lower() only folds A-Z, str.lower() would fold "É" to "é" and miss the "É..." entries of the index
+ASCII_LOWER = str.maketrans(string.ascii_uppercase, string.ascii_lowercase)
+
+
+def prefix_range(prefix):
+    """
+    Returns the (lowest, highest) bounds of every string starting with prefix, the upper bound excluded. highest is
+    None when there is no string above the prefix, i.e. it ends in the last code point.
+    """
+    lowest = prefix.translate(ASCII_LOWER)
+    # the last character is bumped by one, a trailing U+10FFFF has no successor so it is bumped on the one before it
+    stem = lowest.rstrip(chr(sys.maxunicode))
+    if not stem:
+        return lowest, None
+    return lowest, stem[:-1] + chr(ord(stem[-1]) + 1)
+
+
+def complete(queryset, field, prefix, limit=None):
+    """
+    Returns up to limit (id, value) pairs whose field starts with prefix, case-insensitively, in alphabetical order.
+    An empty prefix returns the first entries of the alphabet.
+    """
+    limit = limit or settings.AUTOCOMPLETE_LIMIT
+    queryset = queryset.annotate(lowered=Lower(field))
+    prefix = prefix.strip()
+    if prefix:
+        lowest, highest = prefix_range(prefix)
+        queryset = queryset.filter(lowered__gte=lowest)
+        if highest is not None:
+            queryset = queryset.filter(lowered__lt=highest)
+    return list(queryset.order_by("lowered").values_list("id", field)[:limit])
+
+
+def complete_topics(prefix, limit=None):
+    return complete(Topic.objects.all(), "name", prefix, limit)
+
+
+class AutocompleteWidget(forms.Widget):
+    """
+    Renders a hidden input holding the chosen id and a text box that fetches suggestions from the url named url_name.
+    The only query it runs is one primary key lookup for the label of the current value.
+    """
+
+    template_name = "base/widgets/autocomplete.html"
+
+    def __init__(self, model, label_field, url_name, attrs=None):
+        super().__init__(attrs)
+        self.model = model
+        self.label_field = label_field
+        self.url_name = url_name
+
+    def label_for(self, value):
+        if value in (None, ""):
+            return ""
+        try:
+            return self.model.objects.filter(pk=value).values_list(self.label_field, flat=True).first() or ""
+        except (TypeError, ValueError):
+            return ""
+
+    def get_context(self, name, value, attrs):
+        context = super().get_context(name, value, attrs)
+        context["widget"]["label"] = self.label_for(value)
+        context["widget"]["url"] = reverse(self.url_name)
+        return context
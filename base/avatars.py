@@ -0,0 +1,144 @@
+"""
+Avatar uploads and thumbnails.
+
+An uploaded avatar is stored once under the sha256 of its content (avatars/originals/<hash>.<ext>), so the same picture
+uploaded twice, by one user or by many, is only kept and processed once. The fixed size thumbnails (AVATAR_SIZES) are
+made from it in a small pool of worker processes, off the request path, and written as
+avatars/<hash>-<size>.png. A file name never gets different content, which is why /media/avatars/ can be served with
+an immutable cache header.
+
+User.avatar_hash only moves to the new hash once every thumbnail exists. Until then pages keep showing the previous
+avatar. The avatar_url template filter (base/templatetags/avatars.py) turns the hash into a url without touching the
+filesystem.
+
+Files are not removed when a user changes avatar: another user may be showing the same one.
+"""
+import hashlib
+import logging
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from threading import Lock
+
+import django
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import close_old_connections, connection, transaction
+
+from . import authcache, caching
+from .models import User
+
+logger = logging.getLogger(__name__)
+
+ORIGINALS_DIR = "avatars/originals"
+THUMBNAILS_DIR = "avatars"
+
+# <sha256>-<size>.png, the only files under /media/avatars/ that are served
+THUMBNAIL_FILE = re.compile(r"^[0-9a-f]{64}-[0-9]+\.png$")
+
+_pool = None
+_pool_lock = Lock()
+# saves the new avatar_hash once the thumbnails are made, with its own database connection
+_finisher = ThreadPoolExecutor(max_workers=1, thread_name_prefix="avatar-done")
+
+
+def thumbnail_name(avatar_hash, size):
+    return f"{THUMBNAILS_DIR}/{avatar_hash}-{size}.png"
+
+
+def open_thumbnail(filename):
+    """
+    Returns the thumbnail file called filename (no directory), or None when there is no such thumbnail.
+    """
+    if not THUMBNAIL_FILE.match(filename) or not default_storage.exists(f"{THUMBNAILS_DIR}/{filename}"):
+        return None
+    return default_storage.open(f"{THUMBNAILS_DIR}/{filename}")
+
+
+def _init_worker():
+    # only needed when the platform spawns workers instead of forking them
+    django.setup()
+
+
+def _avatar_pool():
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ProcessPoolExecutor(max_workers=settings.AVATAR_WORKERS, initializer=_init_worker)
+    return _pool
+
+
+def make_thumbnails(original_path, avatar_hash, sizes, directory):
+    """
+    Runs in a worker process: crops the original to a square and writes one png per size. Thumbnails that already
+    exist (the same picture was uploaded before) are skipped.
+    """
+    from PIL import Image, ImageOps
+
+    with Image.open(original_path) as image:
+        image = ImageOps.exif_transpose(image).convert("RGBA")
+        for size in sizes:
+            path = os.path.join(directory, f"{avatar_hash}-{size}.png")
+            if os.path.exists(path):
+                continue
+            thumbnail = ImageOps.fit(image, (size, size), Image.LANCZOS)
+            # written under a temporary name first, a half written file must never be served as the real one
+            thumbnail.save(f"{path}.tmp", format="PNG", optimize=True)
+            os.replace(f"{path}.tmp", path)
+
+
+def _thumbnails_done(user_id, avatar_hash, future):
+    try:
+        future.result()
+    except Exception:
+        logger.exception("Could not make the avatar thumbnails of user %s", user_id)
+        return
+    try:
+        close_old_connections()
+        with transaction.atomic():
+            User.objects.filter(pk=user_id).update(avatar_hash=avatar_hash)
+            # .update() sends no signal: the cached user and every cached row showing the avatar have to go
+            authcache.forget_user(user_id)
+            caching.invalidate(caching.MESSAGES)
+            caching.invalidate(caching.ROOMS)
+    finally:
+        connection.close()
+
+
+def save_avatar(user, upload):
+    """
+    Stores the uploaded image under its content hash, points user.avatar at it and queues the thumbnails once the
+    current transaction commits. The caller saves the user.
+    """
+    digest = hashlib.sha256()
+    for chunk in upload.chunks():
+        digest.update(chunk)
+    avatar_hash = digest.hexdigest()
+    extension = os.path.splitext(upload.name)[1].lower() or ".img"
+    name = f"{ORIGINALS_DIR}/{avatar_hash}{extension}"
+    if not default_storage.exists(name):
+        upload.seek(0)
+        name = default_storage.save(name, ContentFile(upload.read()))
+    user.avatar.name = name
+
+    if all(default_storage.exists(thumbnail_name(avatar_hash, size)) for size in settings.AVATAR_SIZES.values()):
+        # a duplicate of a picture that was already processed
+        user.avatar_hash = avatar_hash
+        return
+
+    def submit():
+        os.makedirs(default_storage.path(THUMBNAILS_DIR), exist_ok=True)
+        future = _avatar_pool().submit(
+            make_thumbnails,
+            default_storage.path(name),
+            avatar_hash,
+            sorted(settings.AVATAR_SIZES.values()),
+            default_storage.path(THUMBNAILS_DIR),
+        )
+        # done callbacks run on the management thread of the pool, which must not wait on the database: the update is
+        # handed over to the finisher thread
+        future.add_done_callback(lambda future: _finisher.submit(_thumbnails_done, user.pk, avatar_hash, future))
+
+    transaction.on_commit(submit)
@@ -1,6 +1,16 @@
-from django.contrib.auth import get_user_model
+from concurrent.futures import ProcessPoolExecutor
+from threading import Lock
+
+import django
+from django.conf import settings
+from django.contrib.auth import hashers
 from django.contrib.auth.backends import ModelBackend
+from django.core.cache import cache
+from django.db.models import Q
+from django.db.models.functions import Lower
+from django.utils.crypto import get_random_string, salted_hmac
 
+from . import authcache
 from .models import User
 
 
@@ -8,19 +18,104 @@ class UserBackend(ModelBackend):
     """
     This overrides the authenticate method of the ModelBackend class and helps us
     modify the authentication process that allows a user login with either their username or email.
+
+    It is the only authentication backend, so a login costs a single query: the username and the email are matched
+    case-insensitively against the lower(username) and lower(email) indexes in the same select. Both are stored
+    lowercased (User.save), SQLite's lower() only folds ASCII letters and would miss e.g. an É typed as é.
+    The password hash itself is checked in a small pool of worker processes (see check_password below) and failed
+    attempts are remembered for a short while, so hammering the same wrong credentials does not cost another hash.
+    """
+
+    def authenticate(self, request, username=None, password=None, **kwargs):
+        if username is None or password is None:
+            return None
+        identifier = username.lower()
+
+        user = (
+            User.objects.annotate(username_lower=Lower("username"), email_lower=Lower("email"))
+            .filter(Q(username_lower=identifier) | Q(email_lower=identifier))
+            .first()
+        )
+        failure_key = login_failure_key(identifier, password, user)
+        if cache.get(failure_key):
+            return None
+
+        if user is None:
+            # hash the password anyway so a missing account takes as long as a wrong password
+            check_password(password, dummy_password_hash())
+        elif check_password(password, user.password) and self.user_can_authenticate(user):
+            upgrade_password(user, password)
+            return user
+        cache.set(failure_key, True, timeout=settings.LOGIN_FAILURE_CACHE_TIMEOUT)
+        # this checks the user input against the database. if a user does not exist, the views.py will handle the error message.
+
+    def get_user(self, user_id):
+        """
+        Runs on every request of a logged in user (AuthenticationMiddleware), the user comes from the caches of
+        base/authcache.py and the database is only asked when neither has it.
+        """
+        user = authcache.get_user(user_id, lambda pk: User._default_manager.filter(pk=pk).first())
+        return user if self.user_can_authenticate(user) else None
+
+
+def login_failure_key(identifier, password, user=None):
     """
+    Cache key marking a failed login. It is derived from the stored password hash, so it stops matching as soon as the
+    password changes, and it is an hmac so the cache never holds anything that helps guess the password offline.
+    """
+    if user is None:
+        return "buddies:login-failure:unknown:" + salted_hmac("buddies.login-failure", identifier).hexdigest()
+    value = f"{user.pk}:{user.password}:{password}"
+    return "buddies:login-failure:" + salted_hmac("buddies.login-failure", value).hexdigest()
+
+
+_pool = None
+_pool_lock = Lock()
+_dummy_hash = None
 
-    def authenticate(self, request, **kwargs):
-        email = kwargs["username"]
-        password = kwargs["password"]
-        try:
-            user = User.objects.get(email=email)
-            if user.check_password(password) is True:
-                # this checks if the password provided corresponds with an existing user
-                return user
-        except User.DoesNotExist:
-            pass
-            # this checks the user input against the database. if a user does not exist, the views.py will handle the error message.
 
+def dummy_password_hash():
+    global _dummy_hash
+    if _dummy_hash is None:
+        _dummy_hash = hashers.make_password(get_random_string(12))
+    return _dummy_hash
 
-# The form and view can remain unchanged and keep the fields name as username and password. We need to add CustomerBackend to AUTHENTICATION_BACKENDS.
+
+def _init_worker():
+    # only needed when the platform spawns workers instead of forking them, a forked worker already has django set up
+    django.setup()
+
+
+def _password_pool():
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ProcessPoolExecutor(max_workers=settings.PASSWORD_CHECK_WORKERS, initializer=_init_worker)
+    return _pool
+
+
+def check_password(password, encoded):
+    """
+    Verifies password against an encoded hash. The key derivation runs in a bounded pool of processes, which keeps the
+    CPU heavy hashing off the request threads (and the GIL) and caps how many hashes run at the same time no matter how
+    many login attempts come in at once. PASSWORD_CHECK_WORKERS = 0 checks inline.
+    """
+    if not settings.PASSWORD_CHECK_WORKERS:
+        return hashers.check_password(password, encoded)
+    return _password_pool().submit(hashers.check_password, password, encoded).result()
+
+
+def upgrade_password(user, password):
+    """
+    Re-hashes the password when the hasher or its iteration count changed since it was stored, like
+    User.check_password does through its setter.
+    """
+    preferred = hashers.get_hasher("default")
+    try:
+        hasher = hashers.identify_hasher(user.password)
+    except ValueError:
+        return
+    if hasher.algorithm != preferred.algorithm or preferred.must_update(user.password):
+        user.set_password(password)
+        user.save(update_fields=["password"])
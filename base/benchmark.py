@@ -0,0 +1,345 @@
+"""
+Latency benchmarks for the Buddies views.
+
+``python manage.py seed_buddies`` fills the database with a dataset of a chosen size and
+``python manage.py bench_views`` drives every view through the Django test client (or the ASGI handler with
+--client asgi) and reports p50/p95/p99 latency, queries per request and the peak memory allocated while serving one
+request. Results can be saved as a JSON baseline, later runs are compared against it and fail when a view got slower
+than the threshold allows or runs more queries than it used to.
+
+The run happens inside a transaction that is rolled back at the end, so the seeded dataset stays the same from one run
+to the next. Benchmark with MESSAGE_INGEST disabled: the write-behind thread would wait on the database lock held by
+that transaction. Rate limits (base/ratelimit.py) are switched off during the run, the scenarios post far more often
+than any user would.
+
+``python manage.py bench_ingest`` measures what the write-behind ingestion (base/ingest.py) is for instead: the
+sustained number of messages per second a room takes when many users post at once, with MESSAGE_INGEST off and on.
+Those posts have to be committed for the ingestion thread to write them, so they go to a scratch copy of the
+database (scratch_database) that is thrown away afterwards.
+"""
+import json
+import math
+import os
+import sqlite3
+import statistics
+import tempfile
+import threading
+import time
+import tracemalloc
+from contextlib import closing, contextmanager
+from urllib.parse import urlencode
+
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, connection, connections, transaction
+from django.test import AsyncClient, Client
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.urls import reverse
+
+from . import activity, caching, roomcount, search
+from .ingest import get_ingestor
+from .models import Message, Room, Topic, User
+from .pagination import message_page
+
+SEED_USERNAME = "bench-user-{}"
+SEED_PASSWORD = "buddies-bench-password"
+
+
+def seed(users=100, topics=20, rooms=200, messages_per_room=200, batch_size=2000, stdout=None):
+    """
+    Bulk inserts a synthetic dataset. Every seeded user gets the same password (SEED_PASSWORD), it is hashed once.
+    """
+    password = make_password(SEED_PASSWORD)
+    offset = User.objects.count()
+
+    def log(text):
+        if stdout:
+            stdout.write(text)
+
+    User.objects.bulk_create(
+        [
+            User(username=SEED_USERNAME.format(offset + i), email=f"bench{offset + i}@example.com", password=password)
+            for i in range(users)
+        ],
+        batch_size=batch_size,
+    )
+    user_ids = list(User.objects.order_by("-id").values_list("id", flat=True)[:users])
+    log(f"Created {users} users")
+
+    Topic.objects.bulk_create([Topic(name=f"Topic {i}") for i in range(topics)], batch_size=batch_size)
+    topic_ids = list(Topic.objects.order_by("-id").values_list("id", flat=True)[:topics])
+    log(f"Created {topics} topics")
+
+    Room.objects.bulk_create(
+        [
+            Room(
+                host_id=user_ids[i % len(user_ids)],
+                topic_id=topic_ids[i % len(topic_ids)],
+                name=f"Benchmark room {i}",
+                description=f"Room number {i} about topic {i % len(topic_ids)}",
+            )
+            for i in range(rooms)
+        ],
+        batch_size=batch_size,
+    )
+    room_ids = list(Room.objects.order_by("-id").values_list("id", flat=True)[:rooms])
+    log(f"Created {rooms} rooms")
+
+    pending = []
+    created = 0
+    for room_id in room_ids:
+        for i in range(messages_per_room):
+            pending.append(Message(room_id=room_id, user_id=user_ids[i % len(user_ids)], body=f"Message {i}"))
+            if len(pending) == batch_size:
+                Message.objects.bulk_create(pending)
+                created += len(pending)
+                pending = []
+                log(f"Created {created} messages")
+    Message.objects.bulk_create(pending)
+    log(f"Created {created + len(pending)} messages")
+
+    # bulk_create skips the signal receivers, bring the derived data up to date in one go
+    for start in range(0, len(room_ids), 500):
+        activity.recount_rooms(room_ids[start : start + 500])
+    search.rebuild_index()
+    cache.delete(roomcount.TOTAL_KEY)
+    for group in (caching.TOPICS, caching.ROOMS, caching.RANKINGS):
+        caching.bump_generation(group)
+
+
+class Scenario:
+    def __init__(self, name, path, method="get", data=None, anonymous=False, logout_after=False):
+        self.name = name
+        self.path = path
+        self.method = method
+        self.data = data
+        self.anonymous = anonymous
+        self.logout_after = logout_after
+
+
+def build_scenarios():
+    user = User.objects.filter(username__startswith=SEED_USERNAME.format("")).order_by("id").first()
+    room = Room.objects.order_by("-message_count").first()
+    if user is None or room is None:
+        raise ValueError("Seed the database first with manage.py seed_buddies")
+    _, older = message_page(room)
+    word = room.name.split()[0]
+    return user, [
+        Scenario("home", reverse("home")),
+        Scenario("home_search", f"{reverse('home')}?q={word}"),
+        Scenario("room", reverse("room", args=[room.id])),
+        Scenario("room_older", f"{reverse('room-messages', args=[room.id])}?before={older or ''}"),
+        Scenario("login_page", reverse("login"), anonymous=True),
+        Scenario(
+            "login",
+            reverse("login"),
+            method="post",
+            data={"username": user.username, "password": SEED_PASSWORD},
+            anonymous=True,
+            logout_after=True,
+        ),
+        Scenario("create_room_page", reverse("create-room")),
+        Scenario(
+            "create_room",
+            reverse("create-room"),
+            method="post",
+            data={"name": "Benchmark room", "description": "", "topic": room.topic_id or ""},
+        ),
+        Scenario("post_message", reverse("room", args=[room.id]), method="post", data={"body": "Benchmark message"}),
+    ]
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    return ordered[max(0, math.ceil(pct / 100 * len(ordered)) - 1)]
+
+
+def _requester(client_kind):
+    client = AsyncClient() if client_kind == "asgi" else Client()
+
+    def request(scenario):
+        call = getattr(client, scenario.method)
+        kwargs = {}
+        if scenario.data is not None:
+            # urlencoded like a browser form, the multipart body the test clients default to is not read back
+            # correctly through the ASGI handler
+            kwargs = {"data": urlencode(scenario.data), "content_type": "application/x-www-form-urlencoded"}
+        if client_kind == "asgi":
+            call = async_to_sync(call)
+        response = call(scenario.path, **kwargs)
+        if response.status_code >= 400:
+            raise RuntimeError(f"{scenario.name} answered {response.status_code}")
+        return response
+
+    return client, request
+
+
+def run_scenario(scenario, user, iterations=50, warmup=5, client_kind="wsgi"):
+    client, request = _requester(client_kind)
+    if not scenario.anonymous:
+        client.force_login(user)
+
+    latencies = []
+    queries = []
+    for i in range(warmup + iterations):
+        with CaptureQueriesContext(connection) as captured:
+            start = time.perf_counter()
+            request(scenario)
+            elapsed = time.perf_counter() - start
+        if scenario.logout_after:
+            client.logout()
+        if i >= warmup:
+            latencies.append(elapsed * 1000)
+            queries.append(len(captured))
+
+    # allocations are measured on a separate request, tracing every allocation would skew the latencies above
+    tracemalloc.start()
+    request(scenario)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    if scenario.logout_after:
+        client.logout()
+
+    return {
+        "p50_ms": round(percentile(latencies, 50), 3),
+        "p95_ms": round(percentile(latencies, 95), 3),
+        "p99_ms": round(percentile(latencies, 99), 3),
+        "mean_ms": round(statistics.mean(latencies), 3),
+        "queries": max(queries),
+        "alloc_peak_kib": round(peak / 1024, 1),
+    }
+
+
+def run(iterations=50, warmup=5, client_kind="wsgi", only=None):
+    results = {}
+    with transaction.atomic(), override_settings(RATE_LIMIT={**settings.RATE_LIMIT, "ENABLED": False}):
+        user, scenarios = build_scenarios()
+        for scenario in scenarios:
+            if only and scenario.name not in only:
+                continue
+            results[scenario.name] = run_scenario(scenario, user, iterations, warmup, client_kind)
+        transaction.set_rollback(True)
+    return {
+        "meta": {
+            "client": client_kind,
+            "iterations": iterations,
+            "users": User.objects.count(),
+            "rooms": Room.objects.count(),
+            "messages": Message.objects.count(),
+        },
+        "scenarios": results,
+    }
+
+
+INGEST_BODY = "Benchmark ingest message"
+
+
+@contextmanager
+def scratch_database(alias=DEFAULT_DB_ALIAS):
+    """
+    Runs the block against a copy of the SQLite database in a temporary file: every connection opened meanwhile, by
+    this thread or any other, uses the copy, which is deleted afterwards.
+    """
+    live = connections[alias]
+    if live.vendor != "sqlite":
+        raise ValueError("The ingest benchmark runs on a copy of the database and needs SQLite")
+    original = connections.databases[alias]
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "scratch.sqlite3")
+        live.ensure_connection()
+        with closing(sqlite3.connect(path)) as copy:
+            live.connection.backup(copy)
+        # a new settings dictionary, the live connection keeps the one it was made with
+        connections.databases[alias] = {**original, "NAME": path}
+        connections[alias] = connections.create_connection(alias)
+        try:
+            yield
+        finally:
+            connections[alias].close()
+            connections[alias] = live
+            connections.databases[alias] = original
+
+
+def ingest_throughput(posters=8, posts=50, ingest=False):
+    """
+    Posts `posts` messages from each of `posters` threads at once to the busiest room, every post waiting until its
+    message is saved (the form post of the room page). Returns the messages saved per second, the latency of a post
+    and the number of posts that failed. Runs on a scratch copy of the database.
+    """
+    with scratch_database():
+        user, _ = build_scenarios()
+        room = Room.objects.order_by("-message_count").first()
+        path = reverse("room", args=[room.id])
+        start_line = threading.Barrier(posters + 1)
+        latencies = []
+        failures = []
+
+        def post():
+            client = Client(raise_request_exception=False)
+            client.force_login(user)
+            start_line.wait()
+            for _ in range(posts):
+                start = time.perf_counter()
+                response = client.post(path, {"body": INGEST_BODY})
+                if response.status_code >= 400:
+                    # e.g. "database is locked" when writers wait on each other longer than the busy timeout
+                    failures.append(response.status_code)
+                else:
+                    latencies.append((time.perf_counter() - start) * 1000)
+            connection.close()
+
+        settings_override = override_settings(
+            RATE_LIMIT={**settings.RATE_LIMIT, "ENABLED": False},
+            MESSAGE_INGEST={**settings.MESSAGE_INGEST, "ENABLED": ingest},
+        )
+        with settings_override:
+            threads = [threading.Thread(target=post) for _ in range(posters)]
+            for thread in threads:
+                thread.start()
+            start_line.wait()
+            start = time.perf_counter()
+            for thread in threads:
+                thread.join()
+            elapsed = time.perf_counter() - start
+            if ingest:
+                get_ingestor().stop()
+
+        written = Message.objects.filter(room=room, body=INGEST_BODY).count()
+    if not latencies:
+        raise RuntimeError("Every post failed")
+    return {
+        "messages": written,
+        "failed": len(failures),
+        "messages_per_s": round(written / elapsed, 1),
+        "p50_ms": round(percentile(latencies, 50), 3),
+        "p95_ms": round(percentile(latencies, 95), 3),
+    }
+
+
+def compare(results, baseline, threshold=0.2):
+    """
+    Returns a list of regressions: a p95 more than threshold above the baseline, or more queries than the baseline.
+    """
+    regressions = []
+    for name, current in results["scenarios"].items():
+        previous = baseline.get("scenarios", {}).get(name)
+        if previous is None:
+            continue
+        if current["p95_ms"] > previous["p95_ms"] * (1 + threshold):
+            regressions.append(f"{name}: p95 {current['p95_ms']}ms, baseline {previous['p95_ms']}ms")
+        if current["queries"] > previous["queries"]:
+            regressions.append(f"{name}: {current['queries']} queries, baseline {previous['queries']}")
+    return regressions
+
+
+def load_baseline(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_baseline(results, path):
+    with open(path, "w") as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+        f.write("\n")
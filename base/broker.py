@@ -0,0 +1,121 @@
+"""
+Pub/sub brokers used to push new room messages to connected browsers (see base.realtime).
+
+The backend is chosen with the REALTIME_BROKER setting:
+
+    REALTIME_BROKER = {
+        "BACKEND": "base.broker.InProcessBroker",
+        "OPTIONS": {},
+    }
+
+InProcessBroker only reaches subscribers living in the same process, which is fine for a single ASGI worker or for
+development. When the site runs more than one worker every process has to share one broker, RedisBroker talks to any
+Redis-compatible server for that (redis, keydb, dragonfly...) through the ``redis`` package of requirements.txt.
+"""
+import asyncio
+import threading
+from abc import ABC, abstractmethod
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.module_loading import import_string
+
+_CLOSED = object()
+
+
+class Broker(ABC):
+    @abstractmethod
+    def publish(self, channel, data):
+        """
+        Sends data (a str) to every subscriber of channel. Called from regular synchronous code such as views.
+        """
+
+    @abstractmethod
+    async def subscribe(self, channel):
+        """
+        Async generator yielding every str published to channel from the moment it is called.
+        It returns when the subscriber can not keep up, the client is expected to reconnect.
+        """
+
+
+class InProcessBroker(Broker):
+    def __init__(self, queue_size=100):
+        self.queue_size = queue_size
+        self._subscribers = defaultdict(set)
+        self._lock = threading.Lock()
+
+    def publish(self, channel, data):
+        with self._lock:
+            subscribers = list(self._subscribers.get(channel, ()))
+        for loop, queue in subscribers:
+            # publish runs in a worker thread while the queues belong to the event loop, so hand the data over to the loop
+            loop.call_soon_threadsafe(self._deliver, queue, data)
+
+    @staticmethod
+    def _deliver(queue, data):
+        try:
+            queue.put_nowait(data)
+        except asyncio.QueueFull:
+            # a slow client should not make the queue grow without bound, drop everything and close its stream
+            while not queue.empty():
+                queue.get_nowait()
+            queue.put_nowait(_CLOSED)
+
+    async def subscribe(self, channel):
+        subscriber = (asyncio.get_running_loop(), asyncio.Queue(maxsize=self.queue_size))
+        with self._lock:
+            self._subscribers[channel].add(subscriber)
+        try:
+            while True:
+                data = await subscriber[1].get()
+                if data is _CLOSED:
+                    return
+                yield data
+        finally:
+            with self._lock:
+                self._subscribers[channel].discard(subscriber)
+                if not self._subscribers[channel]:
+                    del self._subscribers[channel]
+
+
+class RedisBroker(Broker):
+    def __init__(self, url="redis://localhost:6379/0"):
+        try:
+            import redis
+            import redis.asyncio  # noqa: F401
+        except ImportError as exc:
+            raise ImproperlyConfigured("RedisBroker requires the redis package (pip install redis)") from exc
+        self.url = url
+        self._redis = redis
+        self._client = redis.Redis.from_url(url)
+
+    def publish(self, channel, data):
+        self._client.publish(channel, data)
+
+    async def subscribe(self, channel):
+        client = self._redis.asyncio.Redis.from_url(self.url)
+        pubsub = client.pubsub()
+        await pubsub.subscribe(channel)
+        try:
+            async for message in pubsub.listen():
+                if message["type"] == "message":
+                    yield message["data"].decode()
+        finally:
+            await pubsub.unsubscribe(channel)
+            await pubsub.close()
+            await client.close()
+
+
+_broker = None
+_broker_lock = threading.Lock()
+
+
+def get_broker():
+    global _broker
+    if _broker is None:
+        with _broker_lock:
+            if _broker is None:
+                config = settings.REALTIME_BROKER
+                _broker = import_string(config["BACKEND"])(**config.get("OPTIONS", {}))
+    return _broker
@@ -0,0 +1,155 @@
+"""
+Versioned fragment cache for the home page.
+
+Rendered fragments are stored under keys that carry a generation number, e.g. ``buddies:fragment:topics:g12``.
+The signal receivers in base.signals bump the generation of a group as soon as something it shows changes
+(a topic is renamed, a room is created, a message is posted...), from then on every page looks up a key that does not
+exist yet and renders fresh html. Nothing is ever deleted or guessed with a short TTL, stale fragments simply stop being
+read and age out of the cache.
+
+Message rows are cached one by one (render_messages) under their id and updated_at, so an edited message gets a new
+key by itself. Their MESSAGES generation only moves when something every row shows changes, like a username.
+
+Which cache is used is up to the CACHES setting (locmem, file based, memcached or redis through CACHE_URL).
+With more than one worker process use a shared cache, otherwise a worker would not see the generation bumps of the
+others.
+"""
+import threading
+import time
+from collections import Counter
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.template.loader import get_template
+from django.utils.safestring import mark_safe
+
+TOPICS = "topics"
+ROOMS = "rooms"
+MESSAGES = "messages"
+RANKINGS = "rankings"  # the trending topics and rooms of base.rollup
+COUNTS = "counts"  # the search counts of base.roomcount, not a fragment but part of the home page ETag
+
+_stats = Counter()
+_unflushed = Counter()
+_stats_lock = threading.Lock()
+
+# hit/miss counts are added to the shared totals in the cache every this many lookups, not on every lookup
+STATS_FLUSH_EVERY = 100
+
+
+def _cache():
+    return caches[settings.FRAGMENT_CACHE_ALIAS]
+
+
+def _generation_key(group):
+    return f"buddies:generation:{group}"
+
+
+def _new_generation():
+    # a lost generation key must never restart at a number that old fragments may still be stored under
+    return int(time.time() * 1000)
+
+
+def get_generation(group):
+    cache = _cache()
+    generation = cache.get(_generation_key(group))
+    if generation is None:
+        cache.add(_generation_key(group), _new_generation(), timeout=None)
+        generation = cache.get(_generation_key(group))
+    return generation
+
+
+def bump_generation(group):
+    cache = _cache()
+    try:
+        cache.incr(_generation_key(group))
+    except ValueError:
+        # the key was evicted or never set, start over from a generation that has never been used
+        cache.add(_generation_key(group), _new_generation(), timeout=None)
+
+
+def invalidate(group):
+    """
+    Bumps the generation once the current transaction commits. Bumping earlier would let a concurrent request cache
+    the old data under the new generation, where it would stay until the next change.
+    """
+    transaction.on_commit(lambda: bump_generation(group))
+
+
+def _record(event, count=1):
+    with _stats_lock:
+        _stats[event] += count
+        _unflushed[event] += count
+        if sum(_unflushed.values()) < STATS_FLUSH_EVERY:
+            return
+        pending = dict(_unflushed)
+        _unflushed.clear()
+    cache = _cache()
+    for name, count in pending.items():
+        key = f"buddies:stats:{name}"
+        if not cache.add(key, count, timeout=None):
+            try:
+                cache.incr(key, count)
+            except ValueError:
+                cache.set(key, count, timeout=None)
+
+
+def cache_stats():
+    """
+    Returns the hit/miss counts of this process and the totals shared by every process.
+    """
+    with _stats_lock:
+        local = dict(_stats)
+    shared = _cache().get_many(["buddies:stats:hit", "buddies:stats:miss"])
+    return {
+        "process": {"hits": local.get("hit", 0), "misses": local.get("miss", 0)},
+        "shared": {"hits": shared.get("buddies:stats:hit", 0), "misses": shared.get("buddies:stats:miss", 0)},
+    }
+
+
+def cached_fragment(group, render, *variant):
+    """
+    Returns the html for this group (and variant, e.g. the viewer) from the cache, calling render() on a miss.
+    render is only called when needed, so the queries behind the fragment do not run on a hit.
+    """
+    key = ":".join(["buddies:fragment", group, f"g{get_generation(group)}", *map(str, variant)])
+    cache = _cache()
+    html = cache.get(key)
+    if html is not None:
+        _record("hit")
+        return html
+    _record("miss")
+    html = render()
+    cache.set(key, html, timeout=settings.FRAGMENT_CACHE_TIMEOUT)
+    return html
+
+
+def _message_key(generation, message):
+    return f"buddies:message:g{generation}:{message.id}:{message.updated_at.timestamp()}"
+
+
+def render_messages(messages):
+    """
+    Returns the html of the given messages rendered with base/message.html, newest first as given.
+    All the rows are looked up with one get_many and only the missing ones are rendered (and stored with one
+    set_many), so a page of cached rows comes down to joining strings.
+    """
+    messages = list(messages)
+    if not messages:
+        return mark_safe("")
+    cache = _cache()
+    generation = get_generation(MESSAGES)
+    keys = [_message_key(generation, message) for message in messages]
+    rows = cache.get_many(keys)
+
+    missing = {}
+    template = get_template("base/message.html")
+    for key, message in zip(keys, messages):
+        if key not in rows:
+            missing[key] = rows[key] = template.render({"message": message})
+    if missing:
+        cache.set_many(missing, timeout=settings.FRAGMENT_CACHE_TIMEOUT)
+    _record("hit", len(messages) - len(missing))
+    _record("miss", len(missing))
+    return mark_safe("".join(rows[key] for key in keys))
@@ -0,0 +1,84 @@
+"""
+Validators for conditional GET on the home and room pages.
+
+A browser reloading a page sends back the ETag (If-None-Match) and Last-Modified (If-Modified-Since) it got the first
+time. When nothing the page shows has changed since then Django's condition decorator answers 304 Not Modified before
+the view runs, so the page is neither queried nor rendered again.
+
+The validators are cheap on purpose:
+- the room page: one query on the room primary key for updated_at and message_count. updated_at moves whenever the
+  room is edited or a message is posted (base.activity), message_count also catches deleted messages.
+- the home page: no query at all, the TOPICS and ROOMS fragment cache generations (base.caching) already change on
+  every write that could change the page. Search pages also depend on the COUNTS generation, moved whenever a search
+  count is recounted in the background (base.roomcount).
+
+Both pages look different per visitor (hosts get Edit and Delete links, the comment form is only shown to logged in
+users), so the user id is part of every ETag, and so is the visitor's CSRF token: the forms on the pages embed it, a 304
+must not keep a page whose token was rotated (at login, for one). The room page also shows the name and avatar of every
+author, its ETag includes the MESSAGES generation that moves when those change. Pages with a pending flash message get
+no validator, a 304 would swallow the message.
+"""
+import hashlib
+
+from django.contrib import messages
+
+from . import caching
+from .models import Room
+
+
+def _etag(*parts):
+    return hashlib.md5("|".join(str(part) for part in parts).encode()).hexdigest()
+
+
+def _viewer(request):
+    # CSRF_COOKIE is the token the forms of the page are rendered with, set by CsrfViewMiddleware before the view
+    return f'{request.user.pk or "anonymous"}:{request.META.get("CSRF_COOKIE", "")}'
+
+
+def _has_flash_messages(request):
+    return len(messages.get_messages(request)) > 0
+
+
+def _room_state(request, pk):
+    if request.method not in ("GET", "HEAD"):
+        return None
+    # etag_func and last_modified_func are called one after the other, the room row is only read once
+    if not hasattr(request, "_room_state"):
+        request._room_state = Room.objects.filter(id=pk).values_list("updated_at", "message_count").first()
+    return request._room_state
+
+
+def room_etag(request, pk):
+    state = _room_state(request, pk)
+    if state is None or _has_flash_messages(request):
+        return None
+    updated_at, message_count = state
+    return _etag(
+        "room",
+        pk,
+        updated_at.isoformat(),
+        message_count,
+        caching.get_generation(caching.MESSAGES),
+        _viewer(request),
+    )
+
+
+def room_last_modified(request, pk):
+    state = _room_state(request, pk)
+    if state is None or _has_flash_messages(request):
+        return None
+    return state[0]
+
+
+def home_etag(request):
+    if _has_flash_messages(request):
+        return None
+    return _etag(
+        "home",
+        caching.get_generation(caching.TOPICS),
+        caching.get_generation(caching.ROOMS),
+        caching.get_generation(caching.RANKINGS),
+        request.GET.get("q") or "",
+        caching.get_generation(caching.COUNTS) if request.GET.get("q") else "",
+        _viewer(request),
+    )
@@ -0,0 +1,42 @@
+"""
+SQLite connection tuning.
+
+Every new SQLite connection gets the pragmas from the SQLITE_PRAGMAS setting applied before it is used. With
+journal_mode=wal readers no longer block the writer (and the other way around), busy_timeout makes a connection wait
+for the write lock instead of failing straight away with "database is locked", and mmap_size/cache_size keep the hot
+pages in memory. Together with CONN_MAX_AGE this runs once per connection rather than once per request. The read
+replica keeps the rollback journal of the copy made by sync_replica.
+
+The pragmas run on the raw sqlite3 connection, past Django's cursor wrappers, so they are not counted as queries of
+whichever request happened to open the connection (base/instrumentation.py).
+"""
+import re
+
+from django.conf import settings
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+
+ALLOWED_PRAGMAS = {
+    "journal_mode",
+    "synchronous",
+    "busy_timeout",
+    "mmap_size",
+    "cache_size",
+    "temp_store",
+    "foreign_keys",
+    "wal_autocheckpoint",
+}
+
+
+@receiver(connection_created)
+def apply_sqlite_pragmas(sender, connection, **kwargs):
+    if connection.vendor != "sqlite":
+        return
+    for name, value in settings.SQLITE_PRAGMAS.items():
+        # pragmas can not take bound parameters, so only known names and plain values are let through
+        if name not in ALLOWED_PRAGMAS or not re.fullmatch(r"-?\w+", str(value)):
+            raise ValueError(f"Unsupported SQLite pragma {name}={value!r}")
+        if name == "journal_mode" and connection.alias == settings.REPLICA_DATABASE:
+            # sync_replica swaps the replica file, a -wal file left next to it would belong to the previous copy
+            continue
+        connection.connection.execute(f"PRAGMA {name} = {value}")
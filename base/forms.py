@@ -1,16 +1,39 @@
+from django import forms
 from django.contrib.auth.forms import UserCreationForm
 from django.forms import ModelForm
 
-from .models import Room, User
+from .autocomplete import AutocompleteWidget
+from .models import Room, Topic, User
 
 
 class RoomForm(ModelForm):
     class Meta:
         model = Room
-        fields = "__all__"
+        # no host or participants: participants are the people who posted in the room, see base.activity. The host is
+        # always the user who created the room, the view sets it
+        fields = ["topic", "name", "description"]
+        widgets = {
+            # a <select> would load every topic on each render, the widget fetches suggestions as the user types
+            "topic": AutocompleteWidget(Topic, "name", "autocomplete-topics"),
+        }
 
 
-class CustomUserCreationForm(UserCreationForm):
+class LowercaseIdentifiersMixin:
+    """
+    Usernames and emails are stored lowercased (User.save), so they are compared lowercased by the uniqueness checks
+    too instead of failing on the database constraint.
+    """
+
+    def clean_username(self):
+        username = self.cleaned_data.get("username")
+        return username.lower() if username else username
+
+    def clean_email(self):
+        email = self.cleaned_data.get("email")
+        return email.lower() if email else email
+
+
+class CustomUserCreationForm(LowercaseIdentifiersMixin, UserCreationForm):
     class Meta(UserCreationForm.Meta):
         model = User
         fields = UserCreationForm.Meta.fields + (
@@ -18,3 +41,12 @@ class CustomUserCreationForm(UserCreationForm):
             "last_name",
             "email",
         )
+
+
+class UserForm(LowercaseIdentifiersMixin, ModelForm):
+    # not the model field: the upload is stored under its content hash by base.avatars instead of its own name
+    avatar = forms.ImageField(required=False)
+
+    class Meta:
+        model = User
+        fields = ["first_name", "last_name", "username", "email", "bio"]
@@ -0,0 +1,34 @@
+"""
+Expression indexes kept out of the model Meta.
+
+Django 3.2 can create an index on an expression such as lower(username), but on SQLite every later migration that
+rebuilds the table (adding or altering a field does) then crashes with 'the "." operator prohibited in index
+expressions'. These indexes are therefore created with plain SQL by their migrations, and again after every migrate
+(ensure_expression_indexes), since a table rebuild drops the indexes Django does not know about.
+"""
+from django.db import connections
+
+# (name, table, indexed expression)
+EXPRESSION_INDEXES = [
+    # base.backends.UserBackend looks users up by lower(username) or lower(email) in a single query
+    ("user_username_lower_idx", "base_user", "lower(username)"),
+    ("user_email_lower_idx", "base_user", "lower(email)"),
+    # the topic autocomplete (base.autocomplete) runs prefix range queries on lower(name)
+    ("topic_name_lower_idx", "base_topic", "lower(name)"),
+]
+
+
+def create_index_sql(name, table, expression):
+    return f'CREATE INDEX IF NOT EXISTS "{name}" ON "{table}" ({expression})'
+
+
+def ensure_expression_indexes(using="default", **kwargs):
+    """
+    post_migrate receiver, creates whichever of the indexes is missing.
+    """
+    connection = connections[using]
+    tables = set(connection.introspection.table_names())
+    with connection.cursor() as cursor:
+        for name, table, expression in EXPRESSION_INDEXES:
+            if table in tables:
+                cursor.execute(create_index_sql(name, table, expression))
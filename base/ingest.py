@@ -0,0 +1,156 @@
+"""
+Write-behind ingestion of posted messages.
+
+With MESSAGE_INGEST["ENABLED"] the room view does not insert messages itself. It puts them on a queue and a single
+background thread per process writes them with bulk_create, one transaction per batch. A batch is flushed once it
+holds BATCH_SIZE messages or FLUSH_INTERVAL seconds after its first message arrived, whichever comes first. On SQLite,
+where every write transaction takes the database lock, a hundred posts then cost one lock and one fsync instead of a
+hundred.
+
+Messages are written in the order they were submitted, so the order within a room is preserved. The queue is
+drained and flushed when the process exits normally (atexit), so a graceful restart does not drop messages. Callers
+that need the message to be in the database before they answer (the non-javascript POST-redirect) can wait on the
+future returned by submit.
+
+It pays off with many concurrent posters, measure with ``python manage.py bench_ingest``: a post that waits for its
+message waits out the flush interval too, so with a handful of posters the rooms take fewer messages per second than
+with direct inserts.
+"""
+import atexit
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from django.conf import settings
+from django.db import OperationalError, close_old_connections, connection, transaction
+from django.db.models import prefetch_related_objects
+
+from . import activity, caching, metrics, realtime
+from .models import Message
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+class MessageIngestor:
+    def __init__(self, batch_size=100, flush_interval=0.05, queue_size=10000, retries=3):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.retries = retries
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._thread = None
+        self._lock = threading.Lock()
+        atexit.register(self.stop)
+
+    def start(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="message-ingestor", daemon=True)
+                self._thread.start()
+
+    def submit(self, user_id, room_id, body):
+        """
+        Queues a message and returns a Future resolved with the saved Message once its batch is committed.
+        Blocks while the queue is full, which pushes back on posters when the database can not keep up.
+        """
+        self.start()
+        future = Future()
+        self._queue.put((Message(user_id=user_id, room_id=room_id, body=body), future))
+        return future
+
+    def stop(self, timeout=10):
+        """
+        Flushes everything still queued and stops the worker thread.
+        """
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is None or not thread.is_alive():
+            return
+        self._queue.put((_STOP, None))
+        thread.join(timeout)
+
+    def _run(self):
+        try:
+            stopping = False
+            while not stopping:
+                item = self._queue.get()
+                if item[0] is _STOP:
+                    break
+                batch = [item]
+                deadline = time.monotonic() + self.flush_interval
+                while len(batch) < self.batch_size:
+                    try:
+                        item = self._queue.get(timeout=max(deadline - time.monotonic(), 0))
+                    except queue.Empty:
+                        break
+                    if item[0] is _STOP:
+                        stopping = True
+                        break
+                    batch.append(item)
+                self._flush(batch)
+        finally:
+            connection.close()
+
+    def _flush(self, batch):
+        messages = [message for message, future in batch]
+        for attempt in range(self.retries + 1):
+            try:
+                close_old_connections()
+                with transaction.atomic():
+                    created = Message.objects.bulk_create(messages)
+                    if created[-1].pk is None:
+                        _assign_ids(created)
+                    activity.record_messages(created)
+                    caching.invalidate(caching.ROOMS)
+                break
+            except OperationalError as exc:  # most likely "database is locked", back off and try again
+                if attempt < self.retries:
+                    time.sleep(0.05 * 2 ** attempt)
+                    continue
+                error = exc
+            except Exception as exc:
+                error = exc
+            logger.error("Could not write %s queued messages", len(batch), exc_info=error)
+            for message, future in batch:
+                future.set_exception(error)
+            return
+
+        metrics.ingest_queue.set(self._queue.qsize())
+        prefetch_related_objects(messages, "user")  # the live updates show the author of every message
+        for message, future in batch:
+            realtime.publish_message(message)
+            future.set_result(message)
+
+
+def _assign_ids(messages):
+    """
+    SQLite does not hand back the ids of a bulk insert on this Django version. The batch was written in one transaction
+    holding the database write lock and message ids are AUTOINCREMENT, so they are the consecutive ids ending at the
+    last inserted rowid.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT last_insert_rowid()")
+        last_id = cursor.fetchone()[0]
+    for offset, message in enumerate(reversed(messages)):
+        message.id = last_id - offset
+
+
+_ingestor = None
+_ingestor_lock = threading.Lock()
+
+
+def get_ingestor():
+    global _ingestor
+    if _ingestor is None:
+        with _ingestor_lock:
+            if _ingestor is None:
+                config = settings.MESSAGE_INGEST
+                _ingestor = MessageIngestor(
+                    batch_size=config["BATCH_SIZE"],
+                    flush_interval=config["FLUSH_INTERVAL"],
+                    queue_size=config["QUEUE_SIZE"],
+                )
+    return _ingestor
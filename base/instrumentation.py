@@ -0,0 +1,179 @@
+"""
+Per-request timing and query budgets.
+
+RequestTimingMiddleware records, for every request, how many SQL queries ran, how long they took, how long template
+rendering took and how long the view took. The numbers are sent back in a Server-Timing header, which browsers show in
+the network panel, added to a rolling in-process histogram per view (request_histogram) and recorded in the
+metrics served at /metrics (base/metrics.py).
+
+The query_budget decorator declares how many queries a view may run. A view going over its budget raises
+QueryBudgetExceeded when QUERY_BUDGET_STRICT is on (the default with DEBUG) and logs a warning otherwise, so an N+1
+lookup introduced in a template shows up the first time the page is opened.
+"""
+import functools
+import logging
+import threading
+import time
+from collections import defaultdict, deque
+from contextlib import ExitStack
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.db import connections
+from django.template import base as template_base
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+_current = ContextVar("request_timings", default=None)
+
+
+class RequestTimings:
+    def __init__(self):
+        self.queries = 0
+        self.db_time = 0.0
+        self.template_time = 0.0
+        self._template_depth = 0
+
+    def execute_wrapper(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.db_time += time.perf_counter() - start
+            self.queries += 1
+
+
+class RollingHistogram:
+    """
+    Keeps the last `size` samples per view so percentiles reflect recent traffic only.
+    """
+
+    def __init__(self, size=1000):
+        self._samples = defaultdict(lambda: deque(maxlen=size))
+        self._lock = threading.Lock()
+
+    def add(self, name, duration, queries):
+        with self._lock:
+            self._samples[name].append((duration, queries))
+
+    def snapshot(self):
+        with self._lock:
+            samples = {name: list(values) for name, values in self._samples.items()}
+        summary = {}
+        for name, values in samples.items():
+            durations = sorted(duration for duration, queries in values)
+            summary[name] = {
+                "count": len(values),
+                "p50_ms": _percentile(durations, 50) * 1000,
+                "p95_ms": _percentile(durations, 95) * 1000,
+                "p99_ms": _percentile(durations, 99) * 1000,
+                "max_queries": max(queries for duration, queries in values),
+            }
+        return summary
+
+
+def _percentile(ordered, pct):
+    return ordered[max(0, -(-pct * len(ordered) // 100) - 1)]
+
+
+request_histogram = RollingHistogram()
+
+
+def _timed_render(render):
+    @functools.wraps(render)
+    def wrapper(self, context):
+        timings = _current.get()
+        if timings is None:
+            return render(self, context)
+        # included and extended templates render inside their parent, only the outermost render is counted
+        timings._template_depth += 1
+        start = time.perf_counter()
+        try:
+            return render(self, context)
+        finally:
+            timings._template_depth -= 1
+            if not timings._template_depth:
+                timings.template_time += time.perf_counter() - start
+
+    wrapper.timed = True
+    return wrapper
+
+
+def install_template_timing():
+    """
+    Django only sends its template_rendered signal under the test runner, so template time is measured by wrapping
+    Template.render instead. Called once from BaseConfig.ready().
+    """
+    if not getattr(template_base.Template.render, "timed", False):
+        template_base.Template.render = _timed_render(template_base.Template.render)
+
+
+class RequestTimingMiddleware:
+    """
+    Should be the last entry in MIDDLEWARE so the view time is the time spent in the view alone.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        timings = RequestTimings()
+        token = _current.set(timings)
+        start = time.perf_counter()
+        try:
+            with ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(connection.execute_wrapper(timings.execute_wrapper))
+                response = self.get_response(request)
+        finally:
+            _current.reset(token)
+        view_time = time.perf_counter() - start
+
+        match = request.resolver_match
+        view_name = match.view_name if match else "unresolved"
+        request_histogram.add(view_name, view_time, timings.queries)
+        metrics.start_flusher()
+        metrics.request_latency.observe(view_time, view_name)
+        metrics.request_queries.observe(timings.queries, view_name)
+        metrics.responses.inc(view_name, str(response.status_code))
+        response["Server-Timing"] = (
+            f'db;dur={timings.db_time * 1000:.1f};desc="{timings.queries} queries", '
+            f"tpl;dur={timings.template_time * 1000:.1f}, "
+            f"view;dur={view_time * 1000:.1f}"
+        )
+        return response
+
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+
+def query_budget(max_queries):
+    """
+    Declares the number of queries a view is allowed to run, including the ones its template triggers.
+
+        @query_budget(4)
+        def home(request):
+            ...
+    """
+
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(request, *args, **kwargs):
+            counter = RequestTimings()
+            with ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(connection.execute_wrapper(counter.execute_wrapper))
+                response = view(request, *args, **kwargs)
+            if counter.queries > max_queries:
+                message = f"{view.__name__} ran {counter.queries} queries, its budget is {max_queries}"
+                if settings.QUERY_BUDGET_STRICT:
+                    raise QueryBudgetExceeded(message)
+                logger.warning(message)
+            return response
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,27 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from base.archive import archive_messages
+
+
+class Command(BaseCommand):
+    help = "Moves messages older than the given number of days from the Message table to the compressed archive"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--days",
+            type=int,
+            default=settings.MESSAGE_ARCHIVE_AFTER_DAYS,
+            help="Archive messages older than this many days",
+        )
+        parser.add_argument("--batch-size", type=int, default=1000, help="Number of messages moved per transaction")
+
+    def handle(self, *args, **options):
+        moved = archive_messages(
+            timedelta(days=options["days"]),
+            options["batch_size"],
+            progress=lambda moved: self.stdout.write(f"Archived {moved} messages"),
+        )
+        self.stdout.write(self.style.SUCCESS(f"{moved} messages archived"))
@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from base import benchmark
+
+
+class Command(BaseCommand):
+    help = "Measures how many messages per second a busy room takes, with the write-behind ingestion off and on"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--posters", type=int, default=8, help="Users posting at the same time")
+        parser.add_argument("--posts", type=int, default=50, help="Messages posted by each user")
+
+    def handle(self, *args, **options):
+        self.stdout.write(f"{'ingestion':<10} {'messages':>9} {'failed':>7} {'msg/s':>9} {'p50 ms':>9} {'p95 ms':>9}")
+        for ingest in (False, True):
+            try:
+                result = benchmark.ingest_throughput(options["posters"], options["posts"], ingest=ingest)
+            except (ValueError, RuntimeError) as exc:
+                raise CommandError(exc)
+            self.stdout.write(
+                f"{'on' if ingest else 'off':<10} {result['messages']:>9} {result['failed']:>7} {result['messages_per_s']:>9} "
+                f"{result['p50_ms']:>9} {result['p95_ms']:>9}"
+            )
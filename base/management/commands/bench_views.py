@@ -0,0 +1,58 @@
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+
+from base import benchmark
+
+
+class Command(BaseCommand):
+    help = "Measures latency, queries and allocations of every view and compares them against a saved baseline"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--iterations", type=int, default=50, help="Timed requests per view")
+        parser.add_argument("--warmup", type=int, default=5, help="Untimed requests per view before measuring")
+        parser.add_argument("--client", choices=["wsgi", "asgi"], default="wsgi")
+        parser.add_argument("--scenario", action="append", help="Only run this scenario, can be repeated")
+        parser.add_argument("--baseline", default="benchmarks/baseline.json", help="Baseline JSON file")
+        parser.add_argument("--save-baseline", action="store_true", help="Store this run as the new baseline")
+        parser.add_argument(
+            "--threshold", type=float, default=0.2, help="Allowed p95 slowdown against the baseline, 0.2 is 20%%"
+        )
+
+    def handle(self, *args, **options):
+        try:
+            results = benchmark.run(
+                iterations=options["iterations"],
+                warmup=options["warmup"],
+                client_kind=options["client"],
+                only=options["scenario"],
+            )
+        except (ValueError, RuntimeError) as exc:
+            raise CommandError(exc)
+
+        self.stdout.write(
+            f"{'scenario':<18} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'queries':>8} {'alloc KiB':>10}"
+        )
+        for name, result in results["scenarios"].items():
+            self.stdout.write(
+                f"{name:<18} {result['p50_ms']:>9} {result['p95_ms']:>9} {result['p99_ms']:>9} "
+                f"{result['queries']:>8} {result['alloc_peak_kib']:>10}"
+            )
+
+        path = options["baseline"]
+        if options["save_baseline"]:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            benchmark.save_baseline(results, path)
+            self.stdout.write(self.style.SUCCESS(f"Baseline saved to {path}"))
+            return
+        if not os.path.exists(path):
+            self.stdout.write(f"No baseline at {path}, run with --save-baseline to create one")
+            return
+
+        baseline = benchmark.load_baseline(path)
+        if baseline["meta"]["client"] != options["client"]:
+            raise CommandError(f"The baseline at {path} was recorded with the {baseline['meta']['client']} client")
+        regressions = benchmark.compare(results, baseline, options["threshold"])
+        if regressions:
+            raise CommandError("Performance regressions:\n" + "\n".join(regressions))
+        self.stdout.write(self.style.SUCCESS("No regressions against the baseline"))
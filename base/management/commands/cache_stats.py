@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from base.caching import ROOMS, TOPICS, cache_stats, get_generation
+
+
+class Command(BaseCommand):
+    help = "Shows the hit/miss counts of the home page fragment cache shared by all processes"
+
+    def handle(self, *args, **options):
+        shared = cache_stats()["shared"]
+        lookups = shared["hits"] + shared["misses"]
+        ratio = shared["hits"] / lookups if lookups else 0
+        self.stdout.write(f"hits: {shared['hits']}")
+        self.stdout.write(f"misses: {shared['misses']}")
+        self.stdout.write(f"hit ratio: {ratio:.1%}")
+        self.stdout.write(f"generations: topics={get_generation(TOPICS)} rooms={get_generation(ROOMS)}")
@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+
+from base.transfer import export_data
+
+
+class Command(BaseCommand):
+    help = "Exports users, topics, rooms and messages as NDJSON, gzip compressed when the file name ends in .gz"
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", help="File to write, - for stdout")
+        parser.add_argument(
+            "--chunk-size", type=int, default=2000, help="Number of rows read from the database at once"
+        )
+
+    def handle(self, *args, **options):
+        # progress goes to stderr, stdout may be the export itself
+        written = export_data(
+            options["path"],
+            options["chunk_size"],
+            progress=lambda written: self.stderr.write(f"Exported {written} records"),
+        )
+        self.stderr.write(self.style.SUCCESS(f"{written} records exported"))
@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from base.transfer import import_data
+
+
+class Command(BaseCommand):
+    help = (
+        "Imports users, topics, rooms and messages from a file written by export_buddies. "
+        "An interrupted import resumes from its checkpoint when started again"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", help="File to read, - for stdin")
+        parser.add_argument("--chunk-size", type=int, default=2000, help="Number of rows inserted per transaction")
+        parser.add_argument(
+            "--checkpoint",
+            default=None,
+            help="Where the progress is saved, <path>.checkpoint by default. Importing from stdin can not be resumed",
+        )
+
+    def handle(self, *args, **options):
+        checkpoint = options["checkpoint"]
+        if checkpoint is None and options["path"] != "-":
+            checkpoint = options["path"] + ".checkpoint"
+
+        def progress(state):
+            imported = ", ".join(f"{count} {model}s" for model, count in state["imported"].items())
+            self.stdout.write(f"Line {state['line']}: {imported}")
+
+        try:
+            imported, skipped = import_data(options["path"], options["chunk_size"], checkpoint, progress)
+        except (OSError, ValueError) as exc:
+            raise CommandError(exc)
+        imported = ", ".join(f"{count} {model}s" for model, count in imported.items())
+        self.stdout.write(self.style.SUCCESS(f"Imported {imported}, skipped {skipped} messages without a room"))
@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+
+from base.purge import purge_deleted_rooms
+
+
+class Command(BaseCommand):
+    help = (
+        "Deletes the messages of soft-deleted rooms in batches, then the rooms themselves. "
+        "Safe to run again after an interrupted purge, it continues where the last one stopped"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=None, help="Number of messages deleted per transaction")
+        parser.add_argument("--pause", type=float, default=None, help="Seconds to wait between two batches")
+
+    def handle(self, *args, **options):
+        def progress(room_id, deleted, total):
+            self.stdout.write(f"Room {room_id}: deleted {deleted} of {total} messages")
+
+        purged = purge_deleted_rooms(options["batch_size"], options["pause"], progress)
+        self.stdout.write(self.style.SUCCESS(f"Purged {purged} rooms"))
@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import OperationalError
+
+from base import search
+
+
+class Command(BaseCommand):
+    help = "Rebuilds the full-text index used by the home page room search"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=1000, help="Number of rooms inserted per batch")
+
+    def handle(self, *args, **options):
+        try:
+            total = search.rebuild_index(batch_size=options["batch_size"], stdout=self.stdout)
+        except OperationalError as exc:
+            raise CommandError(exc)
+        self.stdout.write(self.style.SUCCESS(f"Search index rebuilt with {total} rooms"))
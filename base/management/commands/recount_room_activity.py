@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+
+from base.activity import recount_rooms
+from base.models import Room
+
+
+class Command(BaseCommand):
+    help = "Recomputes the message counts, last activity and participants of every room from the messages table"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=500, help="Number of rooms recounted per transaction")
+
+    def handle(self, *args, **options):
+        room_ids = Room.objects.order_by("id").values_list("id", flat=True)
+        last_id = 0
+        total = 0
+        while True:
+            batch = list(room_ids.filter(id__gt=last_id)[: options["batch_size"]])
+            if not batch:
+                break
+            total += recount_rooms(batch)
+            last_id = batch[-1]
+            self.stdout.write(f"Recounted {total} rooms")
+        self.stdout.write(self.style.SUCCESS(f"Room activity recounted for {total} rooms"))
@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+
+from base.rollup import rank_activity, rollup_messages
+
+
+class Command(BaseCommand):
+    help = (
+        "Counts the messages posted since the last run per room and day and ranks the most active topics and rooms, "
+        "run it periodically (e.g. from cron)"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=None, help="Number of messages counted per transaction")
+
+    def handle(self, *args, **options):
+        counted = rollup_messages(
+            options["batch_size"],
+            progress=lambda counted, last_id: self.stdout.write(
+                f"Counted {counted} messages, up to message {last_id}"
+            ),
+        )
+        rankings = rank_activity()
+        self.stdout.write(self.style.SUCCESS(f"{counted} new messages counted, {len(rankings)} rankings written"))
@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+
+from base.benchmark import SEED_PASSWORD, seed
+
+
+class Command(BaseCommand):
+    help = "Fills the database with a synthetic dataset of users, topics, rooms and messages for benchmarking"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=100)
+        parser.add_argument("--topics", type=int, default=20)
+        parser.add_argument("--rooms", type=int, default=200)
+        parser.add_argument("--messages-per-room", type=int, default=200)
+        parser.add_argument("--batch-size", type=int, default=2000, help="Number of rows per bulk insert")
+
+    def handle(self, *args, **options):
+        seed(
+            users=options["users"],
+            topics=options["topics"],
+            rooms=options["rooms"],
+            messages_per_room=options["messages_per_room"],
+            batch_size=options["batch_size"],
+            stdout=self.stdout,
+        )
+        self.stdout.write(self.style.SUCCESS(f"Dataset seeded, every seeded user has the password {SEED_PASSWORD!r}"))
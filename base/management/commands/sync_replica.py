@@ -0,0 +1,43 @@
+import os
+import sqlite3
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+
+class Command(BaseCommand):
+    help = "Copies the primary SQLite database into the read replica file, run it periodically (e.g. from cron)"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--pages", type=int, default=1024, help="Pages copied per step, the primary stays writable"
+        )
+
+    def handle(self, *args, **options):
+        alias = settings.REPLICA_DATABASE
+        if alias not in settings.DATABASES:
+            raise CommandError(f"No {alias!r} database is configured")
+        primary, replica = settings.DATABASES["default"], settings.DATABASES[alias]
+        if primary["ENGINE"] != replica["ENGINE"] or not primary["ENGINE"].endswith("sqlite3"):
+            raise CommandError(
+                "sync_replica only copies SQLite databases, use the database's own replication otherwise"
+            )
+
+        # the copy is made next to the replica and then moved over it: readers that still have the old file open keep
+        # reading a complete database instead of one being overwritten page by page
+        path = str(replica["NAME"])
+        copy = f"{path}.sync"
+        source = sqlite3.connect(str(primary["NAME"]))
+        target = sqlite3.connect(copy)
+        try:
+            # the online backup api copies a consistent snapshot even while the site keeps writing to the primary
+            source.backup(target, pages=options["pages"])
+            # a wal copy would leave -wal and -shm files behind that do not belong to the next copy
+            target.execute("PRAGMA journal_mode = delete")
+        finally:
+            target.close()
+            source.close()
+        os.replace(copy, path)
+        connections[alias].close()
+        self.stdout.write(self.style.SUCCESS(f"Replica {replica['NAME']} is up to date"))
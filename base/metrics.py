@@ -0,0 +1,322 @@
+"""
+Process metrics in the Prometheus text format.
+
+Counters, gauges and histograms live in plain dictionaries behind one lock per metric, so recording a value on the
+request path is a dictionary update. /metrics (config/urls.py) renders them for the scraper.
+
+Each worker process only sees its own numbers. With METRICS_DIR set, every process writes a snapshot of its metrics to
+<METRICS_DIR>/<pid>-<random>.json every METRICS_FLUSH_INTERVAL seconds and when it exits, and /metrics adds up the
+snapshots of all processes, whichever worker answers the scrape. Gauges are summed over the live processes only.
+
+Counters and histograms of processes that have exited are kept so the totals never go backwards: the worker answering
+the scrape takes the snapshot file of an exited process over, adds its numbers to its own snapshot (as "retired"
+values, never reset) and deletes the file. The directory therefore holds about one file per live process, however
+often workers are restarted.
+
+Labels must have a bounded set of values (view names, status codes), every label value is a series kept forever.
+"""
+import atexit
+import json
+import os
+import re
+import threading
+import time
+import uuid
+from bisect import bisect_left
+
+from django.conf import settings
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# <pid>-<token>.json, written by flush(), and <snapshot>.<pid>-<token>.retired, a snapshot claimed by _retire() in the
+# process with that pid
+SNAPSHOT_FILE = re.compile(r"^(\d+)-[0-9a-f]{8}\.json$")
+RETIRED_FILE = re.compile(r"^\d+-[0-9a-f]{8}\.json\.(\d+)-[0-9a-f]{8}\.retired$")
+
+
+class Metric:
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def snapshot(self):
+        with self._lock:
+            return [[list(labels), value] for labels, value in self._values.items()]
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def set(self, value, *labels):
+        with self._lock:
+            self._values[labels] = value
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, *labels):
+        # one count per bucket plus +Inf, then the sum. The counts are made cumulative when rendered
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            values = self._values.get(labels)
+            if values is None:
+                values = self._values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            values[index] += 1
+            values[-1] += value
+
+    def snapshot(self):
+        with self._lock:
+            return [[list(labels), list(values)] for labels, values in self._values.items()]
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            return self._metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, documentation, labelnames=()):
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self.register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def snapshot(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return {
+            metric.name: {
+                "type": metric.type,
+                "help": metric.documentation,
+                "labels": list(metric.labelnames),
+                "buckets": list(getattr(metric, "buckets", ())),
+                "samples": metric.snapshot(),
+            }
+            for metric in metrics
+        }
+
+
+registry = Registry()
+
+request_latency = registry.histogram(
+    "buddies_request_duration_seconds", "Time spent in the view, by view name", ["view"]
+)
+request_queries = registry.histogram(
+    "buddies_request_queries",
+    "SQL queries run per request, by view name",
+    ["view"],
+    buckets=(1, 2, 5, 10, 20, 50, 100),
+)
+responses = registry.counter(
+    "buddies_responses_total", "Responses sent, by view name and status code", ["view", "status"]
+)
+messages_posted = registry.counter("buddies_messages_posted_total", "Messages posted")
+logins = registry.counter("buddies_logins_total", "Login attempts on the login page, by result", ["result"])
+ingest_queue = registry.gauge("buddies_ingest_queue_depth", "Messages waiting in the write-behind queue")
+rate_limited = registry.counter(
+    "buddies_rate_limited_total", "Requests answered with 429 by a rate limit, by limit name", ["limit"]
+)
+
+
+def _process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _merge(snapshots):
+    """
+    Adds snapshots together: counters and gauges are summed, histograms bucket by bucket.
+    """
+    merged = {}
+    for snapshot in snapshots:
+        for name, metric in snapshot.items():
+            target = merged.setdefault(name, {**metric, "samples": {}})
+            for labels, value in metric["samples"]:
+                key = tuple(labels)
+                if key not in target["samples"]:
+                    target["samples"][key] = value
+                elif metric["type"] == "histogram":
+                    target["samples"][key] = [a + b for a, b in zip(target["samples"][key], value)]
+                else:
+                    target["samples"][key] = target["samples"][key] + value
+    for metric in merged.values():
+        metric["samples"] = [[list(labels), value] for labels, value in metric["samples"].items()]
+    return merged
+
+
+# counters and histograms taken over from the snapshots of exited processes, written out with this process's own
+_retired = {}
+_retired_lock = threading.Lock()
+
+
+def flush():
+    """
+    Writes this process's snapshot to METRICS_DIR. The file is replaced atomically, a reader never sees half of it.
+    """
+    directory = settings.METRICS_DIR
+    if not directory:
+        return
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"{os.getpid()}-{_process_token}.json")
+    with _retired_lock:
+        snapshot = _merge([registry.snapshot(), _retired])
+    with open(f"{path}.tmp", "w") as f:
+        json.dump(snapshot, f)
+    os.replace(f"{path}.tmp", path)
+
+
+def _retire(path):
+    """
+    Takes over the counters and histograms of the snapshot at path, written by a process that has exited. Returns the
+    file to delete once this process's snapshot has been written with them, or None when there is nothing to take.
+    """
+    global _retired
+    # renaming is atomic, when two workers scrape at once only one of them gets the file
+    claimed = f"{path}.{os.getpid()}-{_process_token}.retired"
+    try:
+        os.rename(path, claimed)
+    except FileNotFoundError:
+        return None
+    try:
+        with open(claimed) as f:
+            snapshot = json.load(f)
+    except (OSError, ValueError):
+        return claimed
+    kept = {name: metric for name, metric in snapshot.items() if metric["type"] != "gauge"}
+    with _retired_lock:
+        _retired = _merge([_retired, kept])
+    return claimed
+
+
+def collect():
+    """
+    Returns the snapshot of every process added together, or this process's alone without METRICS_DIR.
+    """
+    directory = settings.METRICS_DIR
+    if not directory:
+        return registry.snapshot()
+    os.makedirs(directory, exist_ok=True)
+
+    retired = []
+    for filename in os.listdir(directory):
+        snapshot = SNAPSHOT_FILE.match(filename)
+        if snapshot and not _process_alive(int(snapshot[1])):
+            retired.append(_retire(os.path.join(directory, filename)))
+        claimed = RETIRED_FILE.match(filename)
+        if claimed and not _process_alive(int(claimed[1])):
+            # the worker that claimed it died before deleting it, and it can not tell whether its own snapshot already
+            # holds these numbers. Dropped rather than counted twice
+            try:
+                os.remove(os.path.join(directory, filename))
+            except FileNotFoundError:
+                pass
+    flush()
+    for path in retired:
+        if path is not None:
+            os.remove(path)
+
+    snapshots = []
+    for filename in os.listdir(directory):
+        # only the snapshots themselves, not their .tmp copies or anything else that is put in the directory
+        if not SNAPSHOT_FILE.match(filename):
+            continue
+        try:
+            with open(os.path.join(directory, filename)) as f:
+                snapshots.append(json.load(f))
+        except (OSError, ValueError):
+            continue
+    return _merge(snapshots)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in [*zip(names, values), *extra]]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def render(snapshot):
+    """
+    Renders a snapshot in the Prometheus text exposition format.
+    """
+    lines = []
+    for name, metric in sorted(snapshot.items()):
+        lines.append(f"# HELP {name} {metric['help']}")
+        lines.append(f"# TYPE {name} {metric['type']}")
+        for labels, value in metric["samples"]:
+            if metric["type"] != "histogram":
+                lines.append(f"{name}{_labels(metric['labels'], labels)} {value}")
+                continue
+            cumulative = 0
+            for bound, count in zip([*metric["buckets"], "+Inf"], value[:-1]):
+                cumulative += count
+                lines.append(f"{name}_bucket{_labels(metric['labels'], labels, [('le', bound)])} {cumulative}")
+            lines.append(f"{name}_sum{_labels(metric['labels'], labels)} {value[-1]}")
+            lines.append(f"{name}_count{_labels(metric['labels'], labels)} {cumulative}")
+    return "\n".join(lines) + "\n"
+
+
+def _flush_periodically():
+    while True:
+        time.sleep(settings.METRICS_FLUSH_INTERVAL)
+        try:
+            flush()
+        except OSError:
+            pass
+
+
+_flusher_pid = None
+_flusher_lock = threading.Lock()
+# a later process that gets the same pid must not overwrite the snapshot of this one
+_process_token = uuid.uuid4().hex[:8]
+
+
+def start_flusher():
+    """
+    Starts the thread writing this process's snapshot to METRICS_DIR. Called on every request by the timing
+    middleware, it only does something the first time in each process (including processes forked after startup).
+    """
+    global _flusher_pid, _process_token
+    if _flusher_pid == os.getpid() or not settings.METRICS_DIR:
+        return
+    with _flusher_lock:
+        if _flusher_pid != os.getpid():
+            if _flusher_pid is not None:
+                # forked from a process that already recorded metrics, start counting from zero under a new name
+                _process_token = uuid.uuid4().hex[:8]
+                for metric in registry._metrics.values():
+                    metric._values.clear()
+                _retired.clear()
+            _flusher_pid = os.getpid()
+            threading.Thread(target=_flush_periodically, name="metrics-flush", daemon=True).start()
+            atexit.register(flush)
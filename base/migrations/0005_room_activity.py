@@ -0,0 +1,45 @@
+# Generated by Django 3.2.7 on 2026-10-18 16:49
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, Max
+
+
+def backfill_room_activity(apps, schema_editor):
+    Room = apps.get_model("base", "Room")
+    Message = apps.get_model("base", "Message")
+    stats = Message.objects.order_by().values("room_id").annotate(count=Count("id"), latest=Max("created_at"))
+    for row in stats:
+        Room.objects.filter(id=row["room_id"]).update(message_count=row["count"], last_message_at=row["latest"])
+
+    Participant = Room.participants.through
+    authors = Message.objects.filter(user__isnull=False).order_by().values_list("room_id", "user_id").distinct()
+    Participant.objects.bulk_create(
+        [Participant(room_id=room_id, user_id=user_id) for room_id, user_id in authors], ignore_conflicts=True
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0004_room_search_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='room',
+            name='last_message_at',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='room',
+            name='message_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='room',
+            name='participants',
+            field=models.ManyToManyField(blank=True, related_name='participants', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.RunPython(backfill_room_activity, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,34 @@
+from django.db import migrations
+
+
+def lowercase_identifiers(apps, schema_editor):
+    # logins compare against lowercased usernames and emails, see User.save. A row whose lowercased value is already
+    # taken by another user is left alone rather than breaking the unique constraint
+    User = apps.get_model("base", "User")
+    for field in ("username", "email"):
+        taken = set(User.objects.exclude(**{f"{field}__isnull": True}).values_list(field, flat=True))
+        for pk, value in User.objects.exclude(**{f"{field}__isnull": True}).values_list("id", field):
+            if value != value.lower() and value.lower() not in taken:
+                User.objects.filter(pk=pk).update(**{field: value.lower()})
+                taken.add(value.lower())
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0005_room_activity'),
+    ]
+
+    # plain SQL rather than AddIndex(Index(Lower(...))): Django 3.2 can not rebuild a SQLite table that has an
+    # expression index in the model state, see base/indexes.py
+    operations = [
+        migrations.RunSQL(
+            'CREATE INDEX IF NOT EXISTS "user_username_lower_idx" ON "base_user" (lower(username))',
+            reverse_sql='DROP INDEX IF EXISTS "user_username_lower_idx"',
+        ),
+        migrations.RunSQL(
+            'CREATE INDEX IF NOT EXISTS "user_email_lower_idx" ON "base_user" (lower(email))',
+            reverse_sql='DROP INDEX IF EXISTS "user_email_lower_idx"',
+        ),
+        migrations.RunPython(lowercase_identifiers, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,16 @@
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0006_user_lower_indexes'),
+    ]
+
+    # plain SQL for the same reason as 0006, see base/indexes.py
+    operations = [
+        migrations.RunSQL(
+            'CREATE INDEX IF NOT EXISTS "topic_name_lower_idx" ON "base_topic" (lower(name))',
+            reverse_sql='DROP INDEX IF EXISTS "topic_name_lower_idx"',
+        ),
+    ]
@@ -0,0 +1,41 @@
+# Generated by Django 3.2.7 on 2026-10-18 17:03
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0008_room_soft_delete'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedMessage',
+            fields=[
+                ('id', models.BigIntegerField(primary_key=True, serialize=False)),
+                ('compressed_body', models.BinaryField()),
+                ('updated_at', models.DateTimeField()),
+                ('created_at', models.DateTimeField()),
+                (
+                    'room',
+                    models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to='base.room'),
+                ),
+                (
+                    'user',
+                    models.ForeignKey(
+                        null=True, on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL
+                    ),
+                ),
+            ],
+            options={
+                'ordering': ['-created_at', '-id'],
+            },
+        ),
+        migrations.AddIndex(
+            model_name='archivedmessage',
+            index=models.Index(fields=['room', '-created_at', '-id'], name='archived_room_created_idx'),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 3.2.7 on 2026-10-18 17:09
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0010_read_marker'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='room',
+            index=models.Index(fields=['-updated_at', '-created_at'], name='room_updated_idx'),
+        ),
+    ]
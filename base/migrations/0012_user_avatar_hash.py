@@ -0,0 +1,28 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0011_room_updated_idx'),
+    ]
+
+    operations = [
+        # On SQLite Django 3.2 adds a column by rebuilding the table, which would also drop the lower() indexes of
+        # migration 0006 until the next post_migrate (base/indexes.py). A nullable column can simply be added.
+        migrations.SeparateDatabaseAndState(
+            database_operations=[
+                migrations.RunSQL(
+                    'ALTER TABLE "base_user" ADD COLUMN "avatar_hash" varchar(64) NULL',
+                    reverse_sql='ALTER TABLE "base_user" DROP COLUMN "avatar_hash"',
+                ),
+            ],
+            state_operations=[
+                migrations.AddField(
+                    model_name='user',
+                    name='avatar_hash',
+                    field=models.CharField(blank=True, editable=False, max_length=64, null=True),
+                ),
+            ],
+        ),
+    ]
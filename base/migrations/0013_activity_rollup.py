@@ -0,0 +1,67 @@
+# Generated by Django 3.2.7 on 2026-10-18 17:14
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0012_user_avatar_hash'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RollupWatermark',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=50, unique=True)),
+                ('last_message_id', models.BigIntegerField(default=0)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ActivityRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('message_count', models.PositiveIntegerField(default=0)),
+                ('room', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='base.room')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ActivityRanking',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('topic', 'Topic'), ('room', 'Room')], max_length=10)),
+                ('rank', models.PositiveIntegerField()),
+                ('message_count', models.PositiveIntegerField()),
+                (
+                    'room',
+                    models.ForeignKey(
+                        blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='base.room'
+                    ),
+                ),
+                (
+                    'topic',
+                    models.ForeignKey(
+                        blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='base.topic'
+                    ),
+                ),
+            ],
+            options={
+                'ordering': ['kind', 'rank'],
+            },
+        ),
+        migrations.AddIndex(
+            model_name='activityrollup',
+            index=models.Index(fields=['day'], name='activityrollup_day_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='activityrollup',
+            constraint=models.UniqueConstraint(fields=('room', 'day'), name='activityrollup_room_day_unique'),
+        ),
+        migrations.AddIndex(
+            model_name='activityranking',
+            index=models.Index(fields=['kind', 'rank'], name='activityranking_kind_rank_idx'),
+        ),
+    ]
@@ -1,3 +1,5 @@
+import zlib
+
 from django.contrib.auth.models import AbstractUser, User
 from django.db import models
 
@@ -19,29 +21,66 @@ class User(AbstractUser):
     )
     bio = models.TextField(null=True, blank=True)
     avatar = models.ImageField(null=True, default="")
+    # sha256 of the avatar image once its thumbnails exist, see base/avatars.py. Templates build the thumbnail urls
+    # from it without looking at the files
+    avatar_hash = models.CharField(max_length=64, null=True, blank=True, editable=False)
 
     # USERNAME_FIELD = "email"
     # REQUIRED_FIELDS = []
+    # the lower(username) and lower(email) indexes are created in base/indexes.py, not here
+
+    def save(self, *args, **kwargs):
+        # usernames and emails are stored lowercased. SQLite's lower() only folds ASCII letters, so a login, which
+        # lowercases what was typed with Python, could otherwise never match an address like Élodie@example.com
+        if self.username:
+            self.username = self.username.lower()
+        if self.email:
+            self.email = self.email.lower()
+        super().save(*args, **kwargs)
 
 
 class Topic(models.Model):
     name = models.CharField(max_length=200)
+    # the lower(name) index is created in base/indexes.py
 
     def __str__(self):
         return self.name
 
 
+class RoomManager(models.Manager):
+    """
+    Hides rooms that were deleted but whose messages are still being purged, see base.purge
+    """
+
+    def get_queryset(self):
+        return super().get_queryset().filter(deleted_at__isnull=True)
+
+
 class Room(models.Model):
     host = models.ForeignKey(User, on_delete=models.SET_NULL, null=True)
     topic = models.ForeignKey(Topic, on_delete=models.SET_NULL, null=True)
     name = models.CharField(max_length=200)
     description = models.TextField(null=True, blank=True)
-    # participants =
+    participants = models.ManyToManyField(User, related_name="participants", blank=True)
+    # message_count and last_message_at are kept up to date by base.activity whenever a message is posted or deleted,
+    # so pages can show room activity without counting messages
+    message_count = models.PositiveIntegerField(default=0, editable=False)
+    last_message_at = models.DateTimeField(null=True, blank=True, editable=False)
     updated_at = models.DateTimeField(auto_now=True)
     created_at = models.DateTimeField(auto_now_add=True)
+    # set when the room is deleted. The room disappears from every page right away and base.purge removes its
+    # messages and then the room itself in the background
+    deleted_at = models.DateTimeField(null=True, blank=True, editable=False)
+
+    objects = RoomManager()
+    all_objects = models.Manager()  # deleted rooms included
 
     class Meta:
         ordering = ["-updated_at", "-created_at"]
+        indexes = [
+            # the home page reads the room list one page at a time in this order
+            models.Index(fields=["-updated_at", "-created_at"], name="room_updated_idx"),
+        ]
 
     def __str__(self):
         return self.name
@@ -54,5 +93,106 @@ class Message(models.Model):
     updated_at = models.DateTimeField(auto_now=True)
     created_at = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        ordering = ["-created_at", "-id"]
+        indexes = [
+            # backs the keyset pagination in base.pagination: (room, created_at, id) lets SQLite seek straight to the
+            # cursor position instead of scanning and sorting the whole room history
+            models.Index(fields=["room", "-created_at", "-id"], name="message_room_created_idx"),
+        ]
+
+    def __str__(self):
+        return self.body
+
+
+class ArchivedMessage(models.Model):
+    """
+    Cold storage for old messages, moved here by ``python manage.py archive_messages`` (see base/archive.py).
+    A message keeps its id when it is archived and the body is stored zlib compressed. It renders with the same
+    template as a Message.
+    """
+
+    id = models.BigIntegerField(primary_key=True)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, null=True)
+    room = models.ForeignKey(Room, on_delete=models.CASCADE, db_index=False)  # covered by the index below
+    compressed_body = models.BinaryField()
+    updated_at = models.DateTimeField()
+    created_at = models.DateTimeField()
+
+    class Meta:
+        ordering = ["-created_at", "-id"]
+        indexes = [
+            # same (room, created_at, id) order as the hot Message table, base.pagination pages through both alike
+            models.Index(fields=["room", "-created_at", "-id"], name="archived_room_created_idx"),
+        ]
+
+    @property
+    def body(self):
+        return zlib.decompress(self.compressed_body).decode()
+
     def __str__(self):
         return self.body
+
+
+class ReadMarker(models.Model):
+    """
+    How far a user has read a room, updated by base.unread whenever the user opens the room.
+    seen_count is the room message_count at that moment, so the unread count is message_count - seen_count and never
+    needs a count over Message.
+    """
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    room = models.ForeignKey(Room, on_delete=models.CASCADE)
+    last_read_message_id = models.BigIntegerField(null=True)
+    seen_count = models.PositiveIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=["user", "room"], name="readmarker_user_room_unique")]
+
+
+class ActivityRollup(models.Model):
+    """
+    Number of messages posted in a room on one day, kept up to date by ``python manage.py rollup_activity`` (see
+    base/rollup.py) so rankings never have to group the Message table.
+    """
+
+    room = models.ForeignKey(Room, on_delete=models.CASCADE)
+    day = models.DateField()
+    message_count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=["room", "day"], name="activityrollup_room_day_unique")]
+        indexes = [
+            # the rankings only read the last ACTIVITY_ROLLUP["WINDOW_DAYS"] days
+            models.Index(fields=["day"], name="activityrollup_day_idx"),
+        ]
+
+
+class RollupWatermark(models.Model):
+    """
+    The id of the last message a rollup job has counted, the next run starts after it.
+    """
+
+    name = models.CharField(max_length=50, unique=True)
+    last_message_id = models.BigIntegerField(default=0)
+
+
+class ActivityRanking(models.Model):
+    """
+    The most active topics and rooms of the last days, rewritten by every rollup run and read by the home page in
+    rank order.
+    """
+
+    TOPIC = "topic"
+    ROOM = "room"
+
+    kind = models.CharField(max_length=10, choices=[(TOPIC, "Topic"), (ROOM, "Room")])
+    rank = models.PositiveIntegerField()
+    topic = models.ForeignKey(Topic, on_delete=models.CASCADE, null=True, blank=True)
+    room = models.ForeignKey(Room, on_delete=models.CASCADE, null=True, blank=True)
+    message_count = models.PositiveIntegerField()
+
+    class Meta:
+        ordering = ["kind", "rank"]
+        indexes = [models.Index(fields=["kind", "rank"], name="activityranking_kind_rank_idx")]
@@ -0,0 +1,82 @@
+import base64
+import binascii
+from datetime import datetime
+
+from django.conf import settings
+from django.db.models import Q
+
+from .models import ArchivedMessage, Message
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def encode_cursor(message):
+    """
+    A cursor is the (created_at, id) position of the last message on a page, packed into an opaque url-safe token.
+    The id breaks ties between messages that were created within the same timestamp.
+    """
+    raw = f"{message.created_at.isoformat()}|{message.id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+# ids are stored as signed 64 bit integers, anything outside would fail in the database instead of here
+MAX_ID = 2**63 - 1
+
+
+def decode_cursor(token):
+    try:
+        padded = token + "=" * (-len(token) % 4)
+        created_at, pk = base64.urlsafe_b64decode(padded.encode()).decode().split("|")
+        created_at, pk = datetime.fromisoformat(created_at), int(pk)
+    except (binascii.Error, UnicodeDecodeError, ValueError) as exc:
+        raise InvalidCursor(token) from exc
+    # encode_cursor only ever writes aware datetimes, a naive one can not be compared with created_at
+    if not -MAX_ID - 1 <= pk <= MAX_ID or created_at.tzinfo is None:
+        raise InvalidCursor(token)
+    return created_at, pk
+
+
+def _room_messages(model, room, cursor, using):
+    messages = model.objects.using(using).filter(room=room).select_related("user").order_by("-created_at", "-id")
+    if cursor:
+        created_at, pk = cursor
+        messages = messages.filter(Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=pk))
+    return messages
+
+
+def message_page(room, cursor=None, page_size=None, using=None):
+    """
+    Returns one page of a room's messages, newest first, and the cursor for the next (older) page.
+
+    This is keyset pagination: instead of OFFSET, which gets slower the further back you go, we ask for the rows that
+    sort strictly after the cursor. Together with the (room, created_at, id) index every page costs the same no matter
+    how long the room history is. select_related pulls the message author in the same query so the template does not
+    run one extra query per message.
+
+    Old messages live in the ArchivedMessage table (see base/archive.py) and are always older than the messages still
+    in Message, so a page that runs out of hot messages is filled up from the archive with the same cursor. The archive
+    is only queried once somebody scrolls that far back.
+    """
+    page_size = page_size or settings.MESSAGES_PAGE_SIZE
+    position = decode_cursor(cursor) if cursor else None
+
+    # fetch one extra row so we know whether there is an older page without running a count
+    page = list(_room_messages(Message, room, position, using)[: page_size + 1])
+    if len(page) <= page_size:
+        if page:
+            position = (page[-1].created_at, page[-1].id)
+        page += _room_messages(ArchivedMessage, room, position, using)[: page_size + 1 - len(page)]
+
+    next_cursor = encode_cursor(page[page_size - 1]) if len(page) > page_size else None
+    return page[:page_size], next_cursor
+
+
+def room_history(room, chunk_size, using=None):
+    """
+    Every message of a room, newest first, read from a server-side cursor chunk_size rows at a time: the hot messages
+    first, then the archived ones.
+    """
+    yield from _room_messages(Message, room, None, using).iterator(chunk_size=chunk_size)
+    yield from _room_messages(ArchivedMessage, room, None, using).iterator(chunk_size=chunk_size)
@@ -0,0 +1,148 @@
+"""
+Soft delete of rooms and the background purge of their messages.
+
+room.delete() makes Django's deletion collector load every message of the room to cascade (and to send post_delete
+for each one), all inside one transaction that holds the SQLite write lock until the last row is gone. For a room with
+a long history that blocks the request and every other writer for seconds.
+
+Instead soft_delete_room only stamps deleted_at, which hides the room everywhere at once (Room.objects leaves deleted
+rooms out), and a background thread purges it afterwards:
+
+- messages are removed BATCH_SIZE at a time with a raw DELETE, one short transaction per batch, pausing PAUSE seconds
+  between batches so other writers get the lock
+- once no message is left the room row itself is deleted
+
+Nothing about the purge is kept in memory: a soft-deleted room still in the table is the to-do list. If the process
+dies halfway, the next purge (the next room deletion or ``python manage.py purge_rooms``) continues where it stopped.
+"""
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.db import close_old_connections, connection, transaction
+from django.utils import timezone
+
+from . import caching, roomcount, search
+from .models import ArchivedMessage, Message, Room
+
+logger = logging.getLogger(__name__)
+
+
+def soft_delete_room(room):
+    with transaction.atomic():
+        deleted = Room.all_objects.filter(id=room.id, deleted_at__isnull=True).update(deleted_at=timezone.now())
+        # .update() sends no signals, take the room out of search, the cached room lists and the room total here
+        search.unindex_room(room.id)
+        caching.invalidate(caching.ROOMS)
+        caching.invalidate(caching.RANKINGS)
+        if deleted:
+            roomcount.adjust_total(-1)
+    if settings.ROOM_PURGE["BACKGROUND"]:
+        start_purge()
+
+
+def purge_room(room_id, batch_size=None, pause=None, progress=None):
+    """
+    Deletes the messages of a soft-deleted room batch by batch, then the room. Returns the number of messages deleted.
+    progress, when given, is called after every batch with (room_id, deleted so far, messages left at the start).
+    """
+    batch_size = batch_size or settings.ROOM_PURGE["BATCH_SIZE"]
+    pause = settings.ROOM_PURGE["PAUSE"] if pause is None else pause
+    # archived messages (base/archive.py) would be cascaded one by one by the room delete as well
+    models = (Message, ArchivedMessage)
+    # counted once, the indexes answer it without reading the rows
+    total = sum(model.objects.filter(room_id=room_id).count() for model in models)
+    deleted = 0
+    for model in models:
+        while True:
+            with transaction.atomic():
+                count = _delete_batch(model, room_id, batch_size)
+            deleted += count
+            if progress:
+                progress(room_id, deleted, total)
+            if count < batch_size:
+                break
+            time.sleep(pause)
+
+    # only the participant rows are left to cascade, and any message posted while the purge ran
+    Room.all_objects.filter(id=room_id).delete()
+    return deleted
+
+
+def _delete_batch(model, room_id, batch_size):
+    """
+    DELETE ... WHERE id IN (SELECT id ... LIMIT n): no rows are loaded and no signals are sent, the room counters and
+    participants go away with the room anyway. Returns the number of rows deleted.
+    """
+    batch = model.objects.filter(room_id=room_id).values("id")[:batch_size]
+    subquery, params = batch.query.sql_with_params()
+    table, pk = connection.ops.quote_name(model._meta.db_table), connection.ops.quote_name(model._meta.pk.column)
+    with connection.cursor() as cursor:
+        cursor.execute(f"DELETE FROM {table} WHERE {pk} IN ({subquery})", params)
+        return cursor.rowcount
+
+
+def purge_deleted_rooms(batch_size=None, pause=None, progress=None):
+    """
+    Purges every soft-deleted room, including the ones an interrupted purge left behind. Returns the number of rooms.
+    """
+    purged = 0
+    while True:
+        room_id = (
+            Room.all_objects.filter(deleted_at__isnull=False)
+            .order_by("deleted_at")
+            .values_list("id", flat=True)
+            .first()
+        )
+        if room_id is None:
+            return purged
+        purge_room(room_id, batch_size, pause, progress)
+        purged += 1
+
+
+def _log_progress(room_id, deleted, total):
+    logger.info("Purging room %s: %s of %s messages deleted", room_id, deleted, total)
+
+
+_purge_thread = None
+_purge_pending = False
+_purge_lock = threading.Lock()
+
+
+def _run_purge():
+    global _purge_thread, _purge_pending
+    try:
+        while True:
+            with _purge_lock:
+                # a room deleted while the last pass was running gets another pass, otherwise the thread ends
+                if not _purge_pending:
+                    _purge_thread = None
+                    return
+                _purge_pending = False
+            close_old_connections()
+            try:
+                purge_deleted_rooms(progress=_log_progress)
+            except Exception:
+                logger.exception("Room purge failed, it will resume with the next deletion or manage.py purge_rooms")
+                with _purge_lock:
+                    _purge_thread = None
+                return
+    finally:
+        connection.close()
+
+
+def start_purge():
+    """
+    Starts the purge thread once the current transaction commits. A single thread per process does the purging.
+    """
+
+    def start():
+        global _purge_thread, _purge_pending
+        with _purge_lock:
+            _purge_pending = True
+            if _purge_thread is None:
+                _purge_thread = threading.Thread(target=_run_purge, name="room-purge", daemon=True)
+                _purge_thread.start()
+
+    transaction.on_commit(start)
@@ -0,0 +1,256 @@
+"""
+Token bucket rate limits for the views that are expensive to abuse: posting messages (every post is a write on the
+single SQLite writer) and logging in (every attempt is a PBKDF2 hash).
+
+Each limited client has a bucket of up to `burst` tokens, refilled at burst tokens per `period` seconds. A request
+takes a token, and a request finding the bucket empty gets a 429 answer with a Retry-After header telling when the next
+token arrives. Well behaved users never notice, while a flood from one client is cut down to the refill rate before it
+reaches the database or the password hasher.
+
+    @rate_limit("login-ip", key="ip")
+    def loginPage(request): ...
+
+A limit declared with only_failures=True lets every request through while its bucket has a token but only takes one
+when the view calls failed(request). The per account login limit works that way, so it counts wrong passwords, not
+logins, and a username and address that logged in successfully within RATE_LIMIT["TRUSTED_LOGIN_SECONDS"]
+(trust_login) are not limited per account at all: someone guessing passwords from elsewhere can not lock the owner
+out.
+
+The rates are set per name in RATE_LIMIT["RATES"] as (burst, period). Buckets are kept by a limiter backend chosen with
+RATE_LIMIT["BACKEND"]:
+
+- InProcessLimiter keeps them in a dictionary, each worker process counts on its own
+- SharedMemoryLimiter keeps them in a memory mapped file shared by every worker process on the machine
+
+Neither runs a query, and a check is one dictionary or one slot lookup.
+"""
+import hashlib
+import math
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from functools import wraps
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.http import HttpResponse
+from django.utils.module_loading import import_string
+
+from . import metrics
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+
+def _refill(tokens, updated, now, burst, period):
+    return min(burst, tokens + (now - updated) * burst / period)
+
+
+def _take(tokens, burst, period, take=True):
+    """
+    Returns the tokens left after taking one (or only looking, with take=False) and the seconds to wait, which is 0
+    when there was a token.
+    """
+    if tokens >= 1:
+        return tokens - 1 if take else tokens, 0.0
+    return tokens, (1 - tokens) * period / burst
+
+
+class Limiter(ABC):
+    @abstractmethod
+    def take(self, key, burst, period, take=True):
+        """
+        Takes a token from the bucket of key. Returns 0 when there was one, otherwise the number of seconds until
+        there is. With take=False the bucket is only looked at.
+        """
+
+
+class InProcessLimiter(Limiter):
+    """
+    Buckets in a dictionary of this process. The max_keys least recently used ones are kept, a forgotten bucket
+    simply starts full again.
+    """
+
+    def __init__(self, max_keys=10000):
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key, burst, period, take=True):
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.pop(key, (burst, now))
+            tokens, wait = _take(_refill(tokens, updated, now, burst, period), burst, period, take)
+            self._buckets[key] = (tokens, now)
+            if len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        return wait
+
+
+class SharedMemoryLimiter(Limiter):
+    """
+    Buckets in a file mapped into memory by every worker process on the machine, put it on a tmpfs such as /dev/shm.
+
+    The file is a fixed table of `slots` slots of (key fingerprint, tokens, last update). A key always goes to the slot
+    picked by its hash, so a check is one slot read and write, done while holding an flock on the file (and a thread
+    lock, flock does not keep the threads of one process apart). Two keys sharing a slot take it from each other,
+    the bucket then starts full again, which can only ever let a request through. Make the table much larger than the
+    number of clients active within a period to keep that rare.
+    """
+
+    SLOT = struct.Struct("<Qdd")
+
+    def __init__(self, path=None, slots=65536):
+        if fcntl is None:
+            raise ImproperlyConfigured("SharedMemoryLimiter needs fcntl, use InProcessLimiter on this platform")
+        if path is None:
+            directory = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+            path = os.path.join(directory, "buddies-ratelimit")
+        self.path = path
+        self.slots = slots
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def _open(self):
+        # each process needs its own open file: a descriptor inherited over fork shares its flock with the parent
+        if self._pid != os.getpid():
+            size = self.slots * self.SLOT.size
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+            if os.fstat(fd).st_size < size:
+                os.ftruncate(fd, size)
+            self._fd = fd
+            self._map = mmap.mmap(fd, size)
+            self._pid = os.getpid()
+
+    def take(self, key, burst, period, take=True):
+        digest = int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "little")
+        fingerprint = digest or 1  # 0 marks an empty slot
+        offset = (digest % self.slots) * self.SLOT.size
+        now = time.time()  # the processes have to agree on the clock
+        with self._lock:
+            self._open()
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                stored, tokens, updated = self.SLOT.unpack_from(self._map, offset)
+                if stored != fingerprint:
+                    tokens, updated = burst, now
+                tokens, wait = _take(_refill(tokens, updated, now, burst, period), burst, period, take)
+                self.SLOT.pack_into(self._map, offset, fingerprint, tokens, now)
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+        return wait
+
+
+_limiter = None
+_limiter_lock = threading.Lock()
+
+
+def get_limiter():
+    global _limiter
+    if _limiter is None:
+        with _limiter_lock:
+            if _limiter is None:
+                config = settings.RATE_LIMIT
+                _limiter = import_string(config["BACKEND"])(**config.get("OPTIONS", {}))
+    return _limiter
+
+
+def client_ip(request):
+    # behind a reverse proxy set RATE_LIMIT["IP_HEADER"] to the header it puts the client address in, e.g.
+    # HTTP_X_REAL_IP. Only the first address of a list is used
+    value = request.META.get(settings.RATE_LIMIT["IP_HEADER"]) or request.META.get("REMOTE_ADDR", "")
+    return value.split(",")[0].strip()
+
+
+def _user_key(request):
+    if request.user.is_authenticated:
+        return f"user:{request.user.pk}"
+    return f"ip:{client_ip(request)}"
+
+
+def _ip_key(request):
+    return f"ip:{client_ip(request)}"
+
+
+def _login_username(request):
+    return (request.POST.get("username") or "").lower()
+
+
+def _trusted_key(username, ip):
+    return "buddies:ratelimit:trusted:" + hashlib.md5(f"{username}|{ip}".encode()).hexdigest()
+
+
+def trust_login(request):
+    """
+    Called after a successful login: this username from this address is no longer limited per account.
+    """
+    username = _login_username(request)
+    if username:
+        cache.set(
+            _trusted_key(username, client_ip(request)), True, timeout=settings.RATE_LIMIT["TRUSTED_LOGIN_SECONDS"]
+        )
+
+
+def _username_key(request):
+    # the account a login attempt is aimed at, whichever address it comes from
+    username = _login_username(request)
+    if not username or cache.get(_trusted_key(username, client_ip(request))):
+        return None
+    return f"username:{username}"
+
+
+KEYS = {"user": _user_key, "ip": _ip_key, "username": _username_key}
+
+
+def too_many_requests(wait):
+    seconds = max(1, math.ceil(wait))
+    response = HttpResponse(f"Too many requests, try again in {seconds} second(s).", status=429)
+    response["Retry-After"] = str(seconds)
+    return response
+
+
+def failed(request):
+    """
+    Tells the only_failures limits of the view that this request failed and costs a token.
+    """
+    request._rate_limit_failed = True
+
+
+def rate_limit(name, key="user", methods=("POST",), only_failures=False):
+    """
+    Limits the requests of the given methods made to the view by each client, as told apart by key: "user" (the
+    logged in user, else the address), "ip" or "username" (the username field of a login form, unless that username
+    logged in from this address before). The rate is RATE_LIMIT["RATES"][name]. With only_failures a request only
+    costs a token when the view calls failed(request).
+    """
+    identify = KEYS[key]
+
+    def decorator(view):
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            if not settings.RATE_LIMIT["ENABLED"] or request.method not in methods:
+                return view(request, *args, **kwargs)
+            identity = identify(request)
+            if identity is None:
+                return view(request, *args, **kwargs)
+            burst, period = settings.RATE_LIMIT["RATES"][name]
+            wait = get_limiter().take(f"{name}:{identity}", burst, period, take=not only_failures)
+            if wait:
+                metrics.rate_limited.inc(name)
+                return too_many_requests(wait)
+            response = view(request, *args, **kwargs)
+            if only_failures and getattr(request, "_rate_limit_failed", False):
+                get_limiter().take(f"{name}:{identity}", burst, period)
+            return response
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,135 @@
+"""
+Live room updates over Server-Sent Events.
+
+Every message posted in a room is rendered once, with the same base/message.html row the room page uses, and published
+on the room's broker channel. The browser keeps an EventSource open on /room/<pk>/events/ and inserts each row as it
+arrives, so nobody has to reload the page and the server never re-renders the history for a new message.
+
+The events endpoint is a plain ASGI application mounted in config/asgi.py in front of Django, it is not available
+when the site is served over WSGI.
+"""
+import asyncio
+import json
+import logging
+import re
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+from .broker import get_broker
+from .caching import render_messages
+from .models import Message, Room
+
+logger = logging.getLogger(__name__)
+
+EVENTS_PATH = re.compile(r"^/room/(?P<pk>\d+)/events/$")
+
+
+def room_channel(room_id):
+    return f"room:{room_id}"
+
+
+def message_event(message):
+    html = render_messages([message])
+    return json.dumps({"id": message.id, "html": html})
+
+
+def publish_message(message):
+    try:
+        get_broker().publish(room_channel(message.room_id), message_event(message))
+    except Exception:
+        # the message is already saved, a broker outage should only cost the live update
+        logger.exception("Could not publish message %s", message.id)
+
+
+def _missed_events(room_id, last_event_id):
+    """
+    Messages posted while an EventSource was reconnecting, so the client does not end up with a gap.
+    """
+    messages = Message.objects.filter(room_id=room_id, id__gt=last_event_id).select_related("user").order_by("id")
+    return [message_event(message) for message in messages[: settings.MESSAGES_PAGE_SIZE]]
+
+
+def _format_event(data):
+    return f"id: {json.loads(data)['id']}\nevent: message\ndata: {data}\n\n".encode()
+
+
+async def room_events(scope, receive, send, pk):
+    if not await sync_to_async(Room.objects.filter(id=pk).exists)():
+        await send({"type": "http.response.start", "status": 404, "headers": [(b"content-type", b"text/plain")]})
+        await send({"type": "http.response.body", "body": b"Room not found"})
+        return
+
+    disconnected = asyncio.Event()
+
+    async def watch_disconnect():
+        while (await receive())["type"] != "http.disconnect":
+            pass
+        disconnected.set()
+
+    headers = dict(scope.get("headers", []))
+    last_event_id = headers.get(b"last-event-id", b"").decode()
+
+    # subscribe before sending anything so nothing published from now on can be missed
+    events = get_broker().subscribe(room_channel(pk)).__aiter__()
+    next_event = asyncio.ensure_future(events.__anext__())
+    watcher = asyncio.ensure_future(watch_disconnect())
+    try:
+        await send(
+            {
+                "type": "http.response.start",
+                "status": 200,
+                "headers": [
+                    (b"content-type", b"text/event-stream"),
+                    (b"cache-control", b"no-cache"),
+                    (b"x-accel-buffering", b"no"),
+                ],
+            }
+        )
+        await send({"type": "http.response.body", "body": b"retry: 3000\n\n", "more_body": True})
+        if last_event_id.isdigit():
+            for data in await sync_to_async(_missed_events)(pk, int(last_event_id)):
+                await send({"type": "http.response.body", "body": _format_event(data), "more_body": True})
+
+        while True:
+            done, _ = await asyncio.wait(
+                {next_event, watcher}, timeout=settings.REALTIME_HEARTBEAT, return_when=asyncio.FIRST_COMPLETED
+            )
+            if watcher in done:
+                break
+            if next_event not in done:
+                # comment lines keep proxies from timing out an idle stream
+                await send({"type": "http.response.body", "body": b": keepalive\n\n", "more_body": True})
+                continue
+            try:
+                data = next_event.result()
+            except StopAsyncIteration:
+                break  # the broker dropped us, the browser reconnects and catches up through Last-Event-ID
+            await send({"type": "http.response.body", "body": _format_event(data), "more_body": True})
+            next_event = asyncio.ensure_future(events.__anext__())
+        if not disconnected.is_set():
+            await send({"type": "http.response.body", "body": b""})
+    finally:
+        watcher.cancel()
+        next_event.cancel()
+        try:
+            await next_event
+        except (asyncio.CancelledError, StopAsyncIteration):
+            pass
+        await events.aclose()
+
+
+class RoomEventsRouter:
+    """
+    ASGI middleware sending /room/<pk>/events/ to the event stream and every other request to Django.
+    """
+
+    def __init__(self, application):
+        self.application = application
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["method"] == "GET":
+            match = EVENTS_PATH.match(scope["path"])
+            if match:
+                return await room_events(scope, receive, send, int(match["pk"]))
+        return await self.application(scope, receive, send)
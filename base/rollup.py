@@ -0,0 +1,137 @@
+"""
+Trending topics and most active rooms, without grouping the Message table on page views.
+
+``python manage.py rollup_activity``, run periodically (e.g. from cron), does three things:
+
+1. It counts the messages posted since the last run into ActivityRollup, one row per room and day. Only messages
+   after the watermark (RollupWatermark, the id of the last message counted) are read, BATCH_SIZE at a time, and each
+   batch moves the watermark in the same transaction as its counts, so a run that stops halfway is simply resumed.
+2. It ranks topics and rooms by their messages of the last WINDOW_DAYS days, which only groups the few rollup rows of
+   that window, and rewrites the TOP entries of each kind into ActivityRanking.
+3. It deletes the rollup rows that have left the window.
+
+The home page then reads the rankings in one indexed query (rankings()), through the RANKINGS fragment cache.
+Deleted messages are not taken off the counts, the rankings show how busy a topic or room has been.
+"""
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, Max, Sum
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+
+from . import caching
+from .models import ActivityRanking, ActivityRollup, Message, RollupWatermark
+
+WATERMARK = "activity"
+
+
+def _window_start():
+    return timezone.localdate() - timedelta(days=settings.ACTIVITY_ROLLUP["WINDOW_DAYS"] - 1)
+
+
+def _next_batch(last_id, batch_size):
+    """
+    Returns the id of the last message of the next batch, or None when there are no new messages.
+    """
+    new = Message.objects.filter(id__gt=last_id).order_by("id").values_list("id", flat=True)
+    upper = new[batch_size - 1 : batch_size].first()
+    if upper is None:
+        upper = new.aggregate(Max("id"))["id__max"]
+    return upper
+
+
+def rollup_messages(batch_size=None, progress=None):
+    """
+    Adds the messages posted since the watermark to the daily room counts. Returns the number of messages counted.
+    """
+    batch_size = batch_size or settings.ACTIVITY_ROLLUP["BATCH_SIZE"]
+    since = _window_start()
+    RollupWatermark.objects.get_or_create(name=WATERMARK)
+    counted = 0
+    while True:
+        with transaction.atomic():
+            watermark = RollupWatermark.objects.select_for_update().get(name=WATERMARK)
+            upper = _next_batch(watermark.last_message_id, batch_size)
+            if upper is None:
+                break
+            batch = Message.objects.filter(id__gt=watermark.last_message_id, id__lte=upper)
+            # messages older than the window would be deleted again right away, which matters on the first run over
+            # an existing table
+            counts = {
+                (row["room_id"], row["day"]): row["messages"]
+                for row in batch.filter(created_at__date__gte=since, room__deleted_at__isnull=True)
+                .annotate(day=TruncDate("created_at"))
+                .order_by()
+                .values("room_id", "day")
+                .annotate(messages=Count("id"))
+            }
+            counted += sum(counts.values())
+            _add_counts(counts)
+            watermark.last_message_id = upper
+            watermark.save(update_fields=["last_message_id"])
+        if progress:
+            progress(counted, upper)
+    return counted
+
+
+def _add_counts(counts):
+    if not counts:
+        return
+    existing = ActivityRollup.objects.filter(
+        room_id__in={room_id for room_id, day in counts}, day__in={day for room_id, day in counts}
+    )
+    changed = []
+    for rollup in existing:
+        key = (rollup.room_id, rollup.day)
+        if key in counts:
+            rollup.message_count += counts.pop(key)
+            changed.append(rollup)
+    ActivityRollup.objects.bulk_update(changed, ["message_count"])
+    ActivityRollup.objects.bulk_create(
+        [ActivityRollup(room_id=room_id, day=day, message_count=count) for (room_id, day), count in counts.items()]
+    )
+
+
+def rank_activity(top=None):
+    """
+    Rewrites ActivityRanking from the rollups of the current window and drops the rollups older than it.
+    """
+    top = top or settings.ACTIVITY_ROLLUP["TOP"]
+    since = _window_start()
+    recent = ActivityRollup.objects.filter(day__gte=since, room__deleted_at__isnull=True).order_by()
+    topics = (
+        recent.filter(room__topic__isnull=False)
+        .values("room__topic")
+        .annotate(total=Sum("message_count"))
+        .order_by("-total", "room__topic")[:top]
+    )
+    rooms = recent.values("room").annotate(total=Sum("message_count")).order_by("-total", "room")[:top]
+    rankings = [
+        ActivityRanking(kind=ActivityRanking.TOPIC, rank=rank, topic_id=row["room__topic"], message_count=row["total"])
+        for rank, row in enumerate(topics, 1)
+    ] + [
+        ActivityRanking(kind=ActivityRanking.ROOM, rank=rank, room_id=row["room"], message_count=row["total"])
+        for rank, row in enumerate(rooms, 1)
+    ]
+    with transaction.atomic():
+        ActivityRanking.objects.all().delete()
+        ActivityRanking.objects.bulk_create(rankings)
+        ActivityRollup.objects.filter(day__lt=since).delete()
+        caching.invalidate(caching.RANKINGS)
+    return rankings
+
+
+def rankings():
+    """
+    Returns the ranked (topics, rooms) for the home page, read in one query. Rooms deleted since the last run are left
+    out.
+    """
+    topics, rooms = [], []
+    for ranking in ActivityRanking.objects.select_related("topic", "room"):
+        if ranking.kind == ActivityRanking.TOPIC:
+            topics.append(ranking)
+        elif ranking.room.deleted_at is None:
+            rooms.append(ranking)
+    return topics, rooms
@@ -0,0 +1,111 @@
+"""
+The "N room(s) available" figure on the home page, without counting rooms on every visit.
+
+- Without a search the figure is a counter kept in the cache, moved by one whenever a room is created or deleted
+  (base.signals, base.purge). When it is missing it is counted once and stored again.
+- A search looks its count up in the cache under the normalized search text. A missing or older than
+  ROOM_COUNT["TTL"] count is recounted by a background thread, the page does not wait for it. Until then the page
+  shows what it can tell from the rows it has, e.g. "50+". A new count bumps the COUNTS generation, which is part of
+  the ETag of search pages (base/conditional.py), so a browser holding the "50+" page gets the new figure.
+
+Counts above ROOM_COUNT["CAP"] are shown as "1000+", so a count never reads more than CAP + 1 index entries.
+"""
+import hashlib
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import close_old_connections, connection, transaction
+
+from . import caching
+from .models import Room
+from .search import count_rooms
+
+logger = logging.getLogger(__name__)
+
+TOTAL_KEY = "buddies:roomcount:total"
+
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="room-count")
+_pending = set()
+_pending_lock = threading.Lock()
+
+
+def normalize(q):
+    """
+    "  Python   Django " and "python django" are the same search and share a count.
+    """
+    return " ".join(q.lower().split())
+
+
+def _search_key(q):
+    return "buddies:roomcount:q:" + hashlib.md5(normalize(q).encode()).hexdigest()
+
+
+def total_rooms():
+    total = cache.get(TOTAL_KEY)
+    if total is None:
+        total = Room.objects.count()
+        cache.add(TOTAL_KEY, total, timeout=None)
+    return total
+
+
+def adjust_total(delta):
+    """
+    Moves the total by delta once the current transaction commits. A missing total is left missing, the next page view
+    counts it.
+    """
+
+    def adjust():
+        try:
+            cache.incr(TOTAL_KEY, delta)
+        except ValueError:
+            pass
+
+    transaction.on_commit(adjust)
+
+
+def _recount(q):
+    try:
+        close_old_connections()
+        cache.set(
+            _search_key(q),
+            (count_rooms(q, settings.ROOM_COUNT["CAP"]), time.time()),
+            timeout=settings.ROOM_COUNT["TTL"] * 10,
+        )
+        caching.bump_generation(caching.COUNTS)
+    except Exception:
+        logger.exception("Could not count the rooms matching %r", q)
+    finally:
+        connection.close()
+        with _pending_lock:
+            _pending.discard(normalize(q))
+
+
+def search_count(q):
+    """
+    Returns the cached count of rooms matching q, or None when it has not been counted yet. A missing or stale count
+    is recounted in the background, at most once at a time per search.
+    """
+    entry = cache.get(_search_key(q))
+    if entry is None or time.time() - entry[1] > settings.ROOM_COUNT["TTL"]:
+        with _pending_lock:
+            if normalize(q) not in _pending:
+                _pending.add(normalize(q))
+                _executor.submit(_recount, q)
+    return entry[0] if entry else None
+
+
+def display_count(count, offset, shown, has_more):
+    """
+    The figure shown on the page. count may be None (not known yet); offset and shown describe the current page and
+    has_more whether there is another page, which is all that is needed for an exact figure on the last page.
+    """
+    cap = settings.ROOM_COUNT["CAP"]
+    if not has_more:
+        count = offset + shown
+    elif count is None or count < offset + shown:
+        return f"{offset + shown}+"
+    return f"{cap}+" if count > cap else str(count)
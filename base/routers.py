@@ -0,0 +1,70 @@
+"""
+Read replica routing.
+
+Views decorated with read_from_replica send their reads to the REPLICA_DATABASE alias, every write and every other
+read goes to the default database. The replica can be any configured database: a second SQLite file refreshed with
+``python manage.py sync_replica``, or a real replica of another database server.
+
+A replica lags behind the primary, so after someone writes (any non GET request through a decorated view, or a
+response passed to pin_primary by a view that writes) their reads stay on the primary for REPLICA_PIN_SECONDS. That way
+a user always sees the message they just posted or the room they just created.
+"""
+import functools
+from contextvars import ContextVar
+
+from django.conf import settings
+
+PIN_COOKIE = "buddies_primary"
+
+_use_replica = ContextVar("use_replica", default=False)
+
+
+# only room content is read from the replica. Sessions and users must come from the primary, a login that has not
+# reached the replica yet would otherwise look like an anonymous visitor
+REPLICA_MODELS = {"base.room", "base.topic", "base.message", "base.archivedmessage", "base.activityranking"}
+
+
+class ReadReplicaRouter:
+    def db_for_read(self, model, **hints):
+        if (
+            _use_replica.get()
+            and model._meta.label_lower in REPLICA_MODELS
+            and settings.REPLICA_DATABASE in settings.DATABASES
+        ):
+            return settings.REPLICA_DATABASE
+        return "default"
+
+    def db_for_write(self, model, **hints):
+        return "default"
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # the replica holds the same rows as the primary
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # the replica gets its schema from the primary when it is synced
+        return db == "default"
+
+
+def pin_primary(response):
+    """
+    Sends the reads of whoever gets this response to the primary for the next REPLICA_PIN_SECONDS.
+    """
+    response.set_cookie(PIN_COOKIE, "1", max_age=settings.REPLICA_PIN_SECONDS, httponly=True, samesite="Lax")
+    return response
+
+
+def read_from_replica(view):
+    @functools.wraps(view)
+    def wrapper(request, *args, **kwargs):
+        safe = request.method in ("GET", "HEAD")
+        token = _use_replica.set(safe and PIN_COOKIE not in request.COOKIES)
+        try:
+            response = view(request, *args, **kwargs)
+        finally:
+            _use_replica.reset(token)
+        if not safe:
+            pin_primary(response)
+        return response
+
+    return wrapper
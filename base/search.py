@@ -0,0 +1,189 @@
+"""
+Room search for the home page.
+
+On SQLite the rooms are indexed in an FTS5 virtual table (see migration 0004) holding the room name, description and
+topic name, keyed by the room id. Every search term is matched as a word prefix, so typing "pyt" still finds python
+rooms like the old icontains filter did, and results come back ranked with bm25 instead of in table order.
+Other databases, or an SQLite build without FTS5, fall back to the plain icontains filter.
+
+The index is kept up to date by the Room and Topic signal receivers in base.signals and can be rebuilt from scratch with
+``python manage.py rebuild_search_index``.
+"""
+import re
+
+from django.conf import settings
+from django.db import OperationalError, connections, router, transaction
+from django.db.models import Q
+
+from .models import Room
+
+FTS_TABLE = "base_room_fts"
+
+# bm25 column weights for (name, description, topic): a hit in the room name counts the most
+RANK_WEIGHTS = (10.0, 1.0, 5.0)
+
+_fts_available = {}
+
+
+def _connection(read=False):
+    return connections[router.db_for_read(Room) if read else router.db_for_write(Room)]
+
+
+def fts_available(connection=None):
+    connection = connection or _connection()
+    if connection.vendor != "sqlite":
+        return False
+    key = (connection.alias, str(connection.settings_dict["NAME"]))
+    if key not in _fts_available:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = %s", [FTS_TABLE])
+            _fts_available[key] = cursor.fetchone() is not None
+    return _fts_available[key]
+
+
+def create_index(connection):
+    """
+    Creates the FTS5 table. Returns False when the SQLite library was compiled without FTS5.
+    """
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} "
+                "USING fts5(name, description, topic, tokenize = 'unicode61 remove_diacritics 2')"
+            )
+    except OperationalError:
+        return False
+    _fts_available.clear()
+    return True
+
+
+def build_match_query(q):
+    """
+    Turns the raw search box input into an FTS5 query: every word becomes a quoted prefix term and all terms must match.
+    Returns None when the input has no words in it.
+    """
+    terms = re.findall(r"\w+", q)
+    if not terms:
+        return None
+    return " ".join('"{}"*'.format(term.replace('"', '""')) for term in terms)
+
+
+def _fts_select(sql, params, match):
+    """
+    Runs a select on the FTS index and returns its rows, or None when the search has to fall back to icontains.
+    """
+    connection = _connection(read=True)
+    key = (connection.alias, str(connection.settings_dict["NAME"]))
+    if match is None or connection.vendor != "sqlite" or not _fts_available.get(key, True):
+        return None
+    # the index is simply queried, finding out it does not exist costs a failed statement once per process instead
+    # of a lookup in sqlite_master on every search
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            return cursor.fetchall()
+    except OperationalError as exc:
+        if "no such table" not in str(exc):
+            raise
+        _fts_available[key] = False
+        return None
+
+
+def _icontains(q):
+    return Room.objects.filter(Q(topic__name__icontains=q) | Q(name__icontains=q) | Q(description__icontains=q))
+
+
+def search_rooms(q, limit=None, offset=0):
+    """
+    Returns the rooms matching q, best match first, skipping the first offset matches.
+    """
+    limit = limit or settings.SEARCH_MAX_RESULTS
+    match = build_match_query(q)
+    rows = _fts_select(
+        f"SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s "
+        f"ORDER BY bm25({FTS_TABLE}, %s, %s, %s) LIMIT %s OFFSET %s",
+        [match, *RANK_WEIGHTS, limit, offset],
+        match,
+    )
+    if rows is None:
+        return list(_icontains(q).select_related("host", "topic")[offset : offset + limit])
+    ids = [row[0] for row in rows]
+    rooms = Room.objects.select_related("host", "topic").in_bulk(ids)
+    return [rooms[pk] for pk in ids if pk in rooms]
+
+
+def count_rooms(q, cap):
+    """
+    Counts the rooms matching q, but stops counting past cap: the result is at most cap + 1.
+    """
+    match = build_match_query(q)
+    rows = _fts_select(
+        f"SELECT count(*) FROM (SELECT 1 FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s LIMIT %s)",
+        [match, cap + 1],
+        match,
+    )
+    if rows is None:
+        return _icontains(q).values("id")[: cap + 1].count()
+    return rows[0][0]
+
+
+def index_room(room):
+    if not fts_available():
+        return
+    topic = room.topic.name if room.topic_id else ""
+    with _connection().cursor() as cursor:
+        cursor.execute(
+            f"INSERT OR REPLACE INTO {FTS_TABLE} (rowid, name, description, topic) VALUES (%s, %s, %s, %s)",
+            [room.id, room.name, room.description or "", topic],
+        )
+
+
+def unindex_room(room_id):
+    if not fts_available():
+        return
+    with _connection().cursor() as cursor:
+        cursor.execute(f"DELETE FROM {FTS_TABLE} WHERE rowid = %s", [room_id])
+
+
+def reindex_topic(topic_id, name):
+    """
+    A topic rename has to reach every room filed under it. The room ids come from the topic_id index so this only
+    touches the rooms of that topic.
+    """
+    if not fts_available():
+        return
+    with _connection().cursor() as cursor:
+        cursor.execute(
+            f"UPDATE {FTS_TABLE} SET topic = %s WHERE rowid IN (SELECT id FROM base_room WHERE topic_id = %s)",
+            [name, topic_id],
+        )
+
+
+def rebuild_index(batch_size=1000, stdout=None):
+    """
+    Drops every row from the index and re-inserts all rooms in batches. Returns the number of rooms indexed.
+    """
+    connection = _connection()
+    if not fts_available(connection) and not create_index(connection):
+        raise OperationalError("This SQLite build does not support FTS5")
+
+    rooms = Room.objects.using(connection.alias).order_by("id").values_list("id", "name", "description", "topic__name")
+    total = 0
+    with transaction.atomic(using=connection.alias), connection.cursor() as cursor:
+        cursor.execute(f"DELETE FROM {FTS_TABLE}")
+        last_id = 0
+        while True:
+            batch = list(rooms.filter(id__gt=last_id)[:batch_size])
+            if not batch:
+                break
+            cursor.executemany(
+                f"INSERT INTO {FTS_TABLE} (rowid, name, description, topic) VALUES (%s, %s, %s, %s)",
+                [(pk, name, description or "", topic or "") for pk, name, description, topic in batch],
+            )
+            last_id = batch[-1][0]
+            total += len(batch)
+            if stdout:
+                stdout.write(f"Indexed {total} rooms")
+        # merges the b-tree segments written by the batches above into one so queries stay fast
+        cursor.execute(f"INSERT INTO {FTS_TABLE} ({FTS_TABLE}) VALUES ('optimize')")
+    return total
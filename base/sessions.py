@@ -0,0 +1,35 @@
+"""
+Session engine (SESSION_ENGINE = "base.sessions") that puts the per-process LRU of base.authcache in front of
+Django's cached_db sessions. Reads go to the local copy, then the shared cache, then django_session. Every write still
+goes to the database and the shared cache, and bumps the version of that session so no process keeps an outdated copy.
+"""
+from django.contrib.sessions.backends import cached_db
+
+from . import authcache
+
+
+class SessionStore(cached_db.SessionStore):
+    cache_key_prefix = "buddies.sessions"
+
+    def load(self):
+        if self.session_key is not None:
+            data = authcache.local_get(self.cache_key)
+            if data is not None:
+                return data
+        data = super().load()
+        # an empty dict means the session does not exist (anymore), it is not worth remembering
+        if data and self.session_key is not None:
+            authcache.local_set(self.cache_key, data)
+        return data
+
+    def save(self, must_create=False):
+        super().save(must_create)
+        authcache.bump_version(self.cache_key)
+        authcache.local_set(self.cache_key, self._session)
+
+    def delete(self, session_key=None):
+        session_key = session_key or self.session_key
+        super().delete(session_key)
+        if session_key is not None:
+            authcache.local.delete(self.cache_key_prefix + session_key)
+            authcache.bump_version(self.cache_key_prefix + session_key)
@@ -0,0 +1,83 @@
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save, pre_delete
+from django.dispatch import receiver
+
+from . import activity, authcache, caching, realtime, roomcount, search
+from .backends import login_failure_key
+from .models import Message, Room, Topic, User
+
+
+@receiver(post_save, sender=Room)
+def room_saved(sender, instance, created=False, raw=False, **kwargs):
+    if raw:  # fixtures are loaded as-is, rebuild the search index afterwards
+        return
+    search.index_room(instance)
+    caching.invalidate(caching.ROOMS)
+    caching.invalidate(caching.RANKINGS)  # the rankings show room names
+    if created:
+        roomcount.adjust_total(1)
+
+
+@receiver(post_delete, sender=Room)
+def room_deleted(sender, instance, **kwargs):
+    search.unindex_room(instance.id)
+    caching.invalidate(caching.ROOMS)
+    caching.invalidate(caching.RANKINGS)
+    if instance.deleted_at is None:  # soft-deleted rooms were taken off the total already, see base/purge.py
+        roomcount.adjust_total(-1)
+
+
+@receiver(post_save, sender=Topic)
+def topic_saved(sender, instance, created, raw=False, **kwargs):
+    caching.invalidate(caching.TOPICS)
+    if created or raw:  # a brand new topic has no rooms yet
+        return
+    search.reindex_topic(instance.id, instance.name)
+    caching.invalidate(caching.ROOMS)  # the room list shows topic names
+    caching.invalidate(caching.RANKINGS)
+
+
+@receiver(pre_delete, sender=Topic)
+def topic_deleted(sender, instance, **kwargs):
+    # rooms keep existing with their topic set to null, so they should stop matching the old topic name
+    search.reindex_topic(instance.id, "")
+    caching.invalidate(caching.TOPICS)
+    caching.invalidate(caching.ROOMS)
+    caching.invalidate(caching.RANKINGS)
+
+
+@receiver(post_save, sender=Message)
+def message_saved(sender, instance, created, raw=False, **kwargs):
+    if created and not raw:
+        activity.record_message(instance)
+        caching.invalidate(caching.ROOMS)  # message counts and the activity ordering changed
+        # only tell the room about the message once it is actually committed
+        transaction.on_commit(lambda: realtime.publish_message(instance))
+
+
+@receiver(post_delete, sender=Message)
+def message_deleted(sender, instance, **kwargs):
+    activity.forget_message(instance)
+    caching.invalidate(caching.ROOMS)
+
+
+@receiver(post_save, sender=User)
+def user_saved(sender, instance, created, update_fields=None, **kwargs):
+    if created:
+        # someone may have tried to log in with this username or email before the account existed
+        identifiers = [value.lower() for value in (instance.username, instance.email) if value]
+        cache.delete_many([login_failure_key(identifier, None) for identifier in identifiers])
+    authcache.forget_user(instance.pk)  # a password change or a profile edit is seen by the next request
+    # the room list and the message rows show usernames, but a login only touches last_login (and the password hash when
+    # base.backends upgrades it) and should not throw the cache away
+    if created or (update_fields and update_fields <= {"last_login", "password"}):
+        return
+    caching.invalidate(caching.ROOMS)
+    caching.invalidate(caching.MESSAGES)
+
+
+@receiver(post_delete, sender=User)
+def user_deleted(sender, instance, **kwargs):
+    # the session of a deleted account would otherwise keep finding the cached user
+    authcache.forget_user(instance.pk)
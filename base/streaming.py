@@ -0,0 +1,68 @@
+"""
+Streaming render of the room page.
+
+The page is rendered with a marker where the message list goes and split in two. Everything before the marker
+(main.html head, navbar, room name and description) is sent straight away, then the messages are read from a
+server-side cursor with .iterator() and sent in chunks of rendered rows, then the rest of the page. Only one chunk of
+messages is in memory at any time, so a room with a million messages costs the same memory as one with fifty and the
+browser starts drawing the page before the first message is even read.
+
+Under ASGI Django 3.2 iterates a streaming response on the event loop, where the ORM refuses to run
+(SynchronousOnlyOperation). There the page is rendered in full inside the view, which runs in a worker thread, and
+sent as a normal response: correct, but without the early head. As that page is held in memory ?history=all is cut
+at the newest ROOM_ASGI_HISTORY_LIMIT messages there, with the usual link to the older ones after them. Serve
+?history=all from the WSGI application (config/wsgi.py) to get the whole history in one page.
+
+The message query of a streamed page runs after the view returned, so it is neither counted by @query_budget nor
+reported in the Server-Timing header, both are done by then (base/instrumentation.py). It is a single query, also for
+the full history: .iterator() reads its rows chunk by chunk from one cursor. Under ASGI it runs inside the view and is
+counted.
+"""
+from django.conf import settings
+from django.core.handlers.asgi import ASGIRequest
+from django.db import router
+from django.http import HttpResponse, StreamingHttpResponse
+from django.template.loader import render_to_string
+from django.utils.crypto import get_random_string
+from django.utils.safestring import mark_safe
+
+from .caching import render_messages
+from .models import Message
+from .pagination import message_page, room_history
+
+
+def stream_room(request, room, full_history=False):
+    marker = f"<!--messages-{get_random_string(16)}-->"
+    page = render_to_string(
+        "base/room.html", {"room": room, "streaming": True, "message_marker": mark_safe(marker)}, request
+    )
+    head, tail = page.split(marker, 1)
+    # reads have to go to the same database the view would have used, the generator runs after the view returned
+    using = router.db_for_read(Message)
+    asgi = isinstance(request, ASGIRequest)
+
+    def render():
+        yield head
+        if full_history and asgi:
+            # the page is built in memory here, a room's whole history could be any size
+            messages, next_cursor = message_page(room, page_size=settings.ROOM_ASGI_HISTORY_LIMIT, using=using)
+        elif full_history:
+            messages = room_history(room, settings.ROOM_STREAM_CHUNK_SIZE, using)
+            next_cursor = None
+        else:
+            messages, next_cursor = message_page(room, using=using)
+
+        # every chunk of rows is looked up in the message fragment cache at once, see base/caching.py
+        chunk = []
+        for message in messages:
+            chunk.append(message)
+            if len(chunk) == settings.ROOM_STREAM_CHUNK_SIZE:
+                yield render_messages(chunk)
+                chunk = []
+        yield render_messages(chunk)
+        yield render_to_string("base/load_older.html", {"room": room, "next_cursor": next_cursor})
+        yield tail
+
+    if asgi:
+        return HttpResponse("".join(render()), content_type="text/html; charset=utf-8")
+    return StreamingHttpResponse(render(), content_type="text/html; charset=utf-8")
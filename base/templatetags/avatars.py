@@ -0,0 +1,18 @@
+from django import template
+from django.conf import settings
+
+from base.avatars import thumbnail_name
+
+register = template.Library()
+
+
+@register.filter
+def avatar_url(user, size="small"):
+    """
+    {{ message.user|avatar_url }} or {{ user|avatar_url:"large" }}. Built from user.avatar_hash alone, rendering a
+    page full of avatars never looks at the filesystem or the database.
+    """
+    avatar_hash = getattr(user, "avatar_hash", None)
+    if not avatar_hash:
+        return settings.AVATAR_DEFAULT_URL
+    return f"{settings.MEDIA_URL}{thumbnail_name(avatar_hash, settings.AVATAR_SIZES[size])}"
@@ -1,3 +1,1142 @@
-from django.test import TestCase
+import asyncio
+import base64
+import gzip
+import io
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+from concurrent.futures import Future
+from contextlib import closing
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+from django.conf import settings
+from django.contrib import messages
+from django.contrib.auth import authenticate
+from django.contrib.messages.storage.fallback import FallbackStorage
+from django.core.cache import cache
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.handlers.asgi import ASGIRequest
+from django.core.management import call_command
+from django.db import connection
+from django.db.models.functions import Lower
+from django.http import HttpResponse
+from django.test import RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from PIL import Image
+
+from . import (
+    activity,
+    authcache,
+    avatars,
+    backends,
+    benchmark,
+    caching,
+    metrics,
+    ratelimit,
+    realtime,
+    roomcount,
+    routers,
+    transfer,
+)
+from .archive import archive_messages
+from .autocomplete import complete_topics, prefix_range
+from .broker import InProcessBroker
+from .conditional import home_etag, room_etag
+from .db import apply_sqlite_pragmas
+from .forms import CustomUserCreationForm, RoomForm
+from .indexes import EXPRESSION_INDEXES, ensure_expression_indexes
+from .ingest import MessageIngestor
+from .instrumentation import QueryBudgetExceeded, query_budget, request_histogram
+from .models import ActivityRollup, ArchivedMessage, Message, Room, Topic, User
+from .pagination import InvalidCursor, decode_cursor, encode_cursor, message_page, room_history
+from .purge import purge_room, soft_delete_room
+from .rollup import rank_activity, rankings, rollup_messages
+from .search import build_match_query, count_rooms, search_rooms
+from .sessions import SessionStore
+from .streaming import stream_room
+from .templatetags.avatars import avatar_url
+from .transfer import export_data, import_data
+from .unread import mark_room_read, unread_counts
+
+PASSWORD = "buddies-test-password"
+
+
+def make_user(username="ada", email=None):
+    return User.objects.create_user(username=username, email=email or f"{username}@example.com", password=PASSWORD)
+
+
+def make_room(host, name="Python", topic="Programming", **kwargs):
+    return Room.objects.create(host=host, topic=Topic.objects.get_or_create(name=topic)[0], name=name, **kwargs)
+
+
+def post_messages(room, user, count):
+    return [Message.objects.create(room=room, user=user, body=f"Message {i}") for i in range(count)]
+
+
+class BuddiesTestCase(TestCase):
+    def setUp(self):
+        # fragments, counts and cached sessions would otherwise leak from one test into the next
+        cache.clear()
+        self.user = make_user()
+        self.room = make_room(self.user)
+
+
+@override_settings(MESSAGES_PAGE_SIZE=5)
+class MessagePaginationTests(BuddiesTestCase):
+    def test_pages_cover_the_history_once_newest_first(self):
+        posted = post_messages(self.room, self.user, 12)
+        seen, cursor = [], None
+        while True:
+            page, cursor = message_page(self.room, cursor)
+            seen += [message.id for message in page]
+            if cursor is None:
+                break
+        self.assertEqual(seen, [message.id for message in reversed(posted)])
+
+    def test_cursor_round_trip(self):
+        message = post_messages(self.room, self.user, 1)[0]
+        self.assertEqual(decode_cursor(encode_cursor(message)), (message.created_at, message.id))
+
+    def test_cursors_the_database_can_not_take_are_refused(self):
+        for raw in ["2021-10-01T12:00:00+00:00|99999999999999999999", "2021-10-01T12:00:00|1", "garbage"]:
+            token = base64.urlsafe_b64encode(raw.encode()).decode()
+            with self.assertRaises(InvalidCursor):
+                decode_cursor(token)
+
+    def test_older_messages_endpoint(self):
+        post_messages(self.room, self.user, 7)
+        _, cursor = message_page(self.room)
+        url = reverse("room-messages", args=[self.room.id])
+        data = self.client.get(url, {"before": cursor, "format": "json"}).json()
+        self.assertEqual([message["body"] for message in data["messages"]], ["Message 1", "Message 0"])
+        self.assertIsNone(data["next_cursor"])
+        self.assertEqual(self.client.get(url, {"before": "not a cursor"}).status_code, 400)
+
+    def test_room_page_queries_do_not_grow_with_the_messages(self):
+        other = make_room(self.user, name="Django")
+        post_messages(self.room, self.user, 1)
+        for i in range(5):
+            post_messages(other, make_user(f"poster{i}"), 1)
+        self.client.force_login(self.user)
+        counts = []
+        for room in (self.room, other):
+            self.client.get(reverse("room", args=[room.id]))  # the first visit also creates the read marker
+            with CaptureQueriesContext(connection) as queries:
+                self.client.get(reverse("room", args=[room.id]))
+            counts.append(len(queries))
+        self.assertEqual(counts[0], counts[1])
+
+
+class RoomSearchTests(BuddiesTestCase):
+    def test_every_word_matches_as_a_prefix(self):
+        self.assertEqual(build_match_query('pyt "dj'), '"pyt"* "dj"*')
+        self.assertIsNone(build_match_query("  !? "))
+        make_room(self.user, name="Django girls", topic="Web")
+        self.assertEqual([room.name for room in search_rooms("pyt")], ["Python"])
+        self.assertEqual([room.name for room in search_rooms("djan gir")], ["Django girls"])
+        self.assertEqual(search_rooms("python django"), [])
+
+    def test_a_hit_in_the_name_ranks_first(self):
+        make_room(self.user, name="Snakes", description="All about python, python and python")
+        self.assertEqual([room.name for room in search_rooms("python")], ["Python", "Snakes"])
+        self.assertEqual(count_rooms("python", cap=10), 2)
+        self.assertEqual(count_rooms("python", cap=1), 2)  # stops counting past the cap
+
+    def test_index_follows_room_and_topic_changes(self):
+        self.room.name = "Rust"
+        self.room.save()
+        self.assertEqual(search_rooms("python"), [])
+        self.assertEqual([room.name for room in search_rooms("rust")], ["Rust"])
+        Topic.objects.filter(name="Programming").first().delete()
+        self.assertEqual(search_rooms("programming"), [])
+        self.room.delete()
+        self.assertEqual(search_rooms("rust"), [])
+
+    def test_home_page_search(self):
+        make_room(self.user, name="Cooking")
+        with mock.patch("base.roomcount._executor"):  # the count of the search is not needed here
+            response = self.client.get(reverse("home"), {"q": "cook"})
+        self.assertContains(response, "Cooking")
+        self.assertNotContains(response, ">Python<")
+
+
+class RealtimeTests(BuddiesTestCase):
+    def test_in_process_broker_delivers_to_subscribers_of_the_channel(self):
+        broker = InProcessBroker()
+
+        async def listen():
+            events = broker.subscribe("room:1").__aiter__()
+            first = asyncio.ensure_future(events.__anext__())
+            await asyncio.sleep(0)  # let the subscription start
+            broker.publish("room:2", "elsewhere")
+            broker.publish("room:1", "hello")
+            data = await asyncio.wait_for(first, 1)
+            await events.aclose()
+            return data
+
+        self.assertEqual(asyncio.run(listen()), "hello")
+
+    def test_a_fetched_post_is_published_once_committed(self):
+        self.client.force_login(self.user)
+        with mock.patch("base.realtime.get_broker") as get_broker:
+            with self.captureOnCommitCallbacks(execute=True):
+                response = self.client.post(
+                    reverse("room", args=[self.room.id]), {"body": "Live"}, HTTP_X_REQUESTED_WITH="fetch"
+                )
+        self.assertEqual(response.status_code, 204)
+        channel, data = get_broker.return_value.publish.call_args[0]
+        self.assertEqual(channel, realtime.room_channel(self.room.id))
+        message = Message.objects.get(body="Live")
+        self.assertEqual(json.loads(data)["id"], message.id)
+        self.assertIn("Live", json.loads(data)["html"])
+
+    def test_a_reconnecting_stream_gets_the_messages_it_missed(self):
+        seen, missed = post_messages(self.room, self.user, 1)[0], post_messages(self.room, self.user, 2)
+        events = [json.loads(data) for data in realtime._missed_events(self.room.id, seen.id)]
+        self.assertEqual([event["id"] for event in events], [message.id for message in missed])
+
+
+class RoomActivityTests(BuddiesTestCase):
+    def test_posting_and_deleting_keep_the_counters(self):
+        grace = make_user("grace")
+        first = post_messages(self.room, self.user, 2)[-1]
+        last = post_messages(self.room, grace, 1)[0]
+        self.room.refresh_from_db()
+        self.assertEqual(self.room.message_count, 3)
+        self.assertEqual(self.room.last_message_at, last.created_at)
+        self.assertEqual(set(self.room.participants.all()), {self.user, grace})
+
+        last.delete()
+        self.room.refresh_from_db()
+        self.assertEqual(self.room.message_count, 2)
+        self.assertEqual(self.room.last_message_at, first.created_at)
+        self.assertEqual(list(self.room.participants.all()), [self.user])
+
+    def test_bulk_created_messages_are_recorded_in_one_go(self):
+        grace = make_user("grace")
+        messages = Message.objects.bulk_create(
+            [Message(room=self.room, user=self.user, body="Bulk"), Message(room=self.room, user=grace, body="Bulk")]
+        )
+        activity.record_messages(messages)
+        self.room.refresh_from_db()
+        self.assertEqual(self.room.message_count, 2)
+        self.assertEqual(self.room.participants.count(), 2)
+
+    def test_recount_repairs_drifted_counters(self):
+        post_messages(self.room, self.user, 3)
+        Room.objects.filter(id=self.room.id).update(message_count=42, last_message_at=None)
+        activity.Participant.objects.all().delete()
+        activity.recount_rooms([self.room.id])
+        self.room.refresh_from_db()
+        self.assertEqual(self.room.message_count, 3)
+        self.assertIsNotNone(self.room.last_message_at)
+        self.assertEqual(list(self.room.participants.all()), [self.user])
+
+
+class FragmentCacheTests(BuddiesTestCase):
+    def test_fragment_is_rendered_again_only_after_its_group_changed(self):
+        render = mock.Mock(side_effect=["first", "second"])
+        self.assertEqual(caching.cached_fragment(caching.TOPICS, render, "anonymous"), "first")
+        self.assertEqual(caching.cached_fragment(caching.TOPICS, render, "anonymous"), "first")
+        with self.captureOnCommitCallbacks(execute=False) as callbacks:
+            caching.invalidate(caching.TOPICS)
+        # not before the transaction commits, a concurrent request could cache the old data under the new generation
+        self.assertEqual(caching.cached_fragment(caching.TOPICS, render, "anonymous"), "first")
+        for callback in callbacks:
+            callback()
+        self.assertEqual(caching.cached_fragment(caching.TOPICS, render, "anonymous"), "second")
+        self.assertEqual(render.call_count, 2)
+
+    def test_home_page_is_served_from_the_fragments_and_follows_writes(self):
+        self.client.force_login(self.user)
+        self.client.get(reverse("home"))
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(reverse("home"))
+        self.assertEqual(len(queries), 0)  # session, user and every fragment come from the cache
+
+        with self.captureOnCommitCallbacks(execute=True):
+            make_room(self.user, name="Brand new room")
+        self.assertContains(self.client.get(reverse("home")), "Brand new room")
+
+
+@override_settings(PASSWORD_CHECK_WORKERS=0)
+class LoginBackendTests(BuddiesTestCase):
+    def test_username_or_email_in_any_case_in_one_query(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(authenticate(username="ADA", password=PASSWORD), self.user)
+        self.assertEqual(authenticate(username="Ada@Example.com", password=PASSWORD), self.user)
+        self.assertIsNone(authenticate(username="ada", password="wrong"))
+        self.assertIsNone(authenticate(username="nobody", password=PASSWORD))
+
+    def test_non_ascii_emails_match_in_any_case(self):
+        user = make_user("elodie", email="Élodie@Example.com")
+        self.assertEqual(user.email, "élodie@example.com")
+        self.assertEqual(authenticate(username="ÉLODIE@example.COM", password=PASSWORD), user)
+        form = CustomUserCreationForm(
+            {"username": "Other", "email": "ÉLODIE@example.com", "password1": PASSWORD, "password2": PASSWORD}
+        )
+        self.assertIn("email", form.errors)
+
+    def test_upgrading_the_password_hash_keeps_the_cached_pages(self):
+        generation = caching.get_generation(caching.ROOMS)
+        with mock.patch("django.contrib.auth.hashers.PBKDF2PasswordHasher.must_update", return_value=True):
+            with self.captureOnCommitCallbacks(execute=True):
+                self.assertEqual(authenticate(username="ada", password=PASSWORD), self.user)
+        self.assertTrue(User.objects.get(pk=self.user.pk).check_password(PASSWORD))
+        self.assertEqual(caching.get_generation(caching.ROOMS), generation)
+
+    def test_a_repeated_wrong_password_is_not_hashed_again(self):
+        with mock.patch("base.backends.check_password", wraps=backends.check_password) as check:
+            authenticate(username="ada", password="wrong")
+            authenticate(username="ada", password="wrong")
+        self.assertEqual(check.call_count, 1)
+
+        # the remembered failure belongs to the old password hash
+        self.user.set_password("wrong")
+        self.user.save()
+        self.assertEqual(authenticate(username="ada", password="wrong"), self.user)
+
+    def test_lower_indexes_are_there_and_come_back_after_a_rebuild(self):
+        names = [name for name, table, expression in EXPRESSION_INDEXES]
+        with connection.cursor() as cursor:
+            cursor.execute(f'DROP INDEX "{names[0]}"')  # what a table rebuild by a later migration does
+            ensure_expression_indexes()
+            cursor.execute("SELECT name FROM sqlite_master WHERE type = 'index'")
+            self.assertLessEqual(set(names), {row[0] for row in cursor.fetchall()})
+
+
+class MessageIngestTests(TransactionTestCase):
+    # the ingestor writes from its own thread and connection, which only sees committed rows
+    def setUp(self):
+        cache.clear()
+        self.user = make_user()
+        self.room = make_room(self.user)
+        self.ingestor = MessageIngestor(batch_size=10, flush_interval=0.05)
+        self.addCleanup(self.ingestor.stop)
+
+    def test_messages_are_written_in_batches_in_submission_order(self):
+        futures = [self.ingestor.submit(self.user.id, self.room.id, f"Queued {i}") for i in range(25)]
+        saved = [future.result(timeout=5) for future in futures]
+        self.assertEqual([message.body for message in saved], [f"Queued {i}" for i in range(25)])
+        self.assertEqual(
+            list(Message.objects.order_by("id").values_list("id", flat=True)), [message.id for message in saved]
+        )
+        self.room.refresh_from_db()
+        self.assertEqual(self.room.message_count, 25)
+
+    def test_a_failed_batch_fails_its_futures_and_logs_the_error(self):
+        with self.assertLogs("base.ingest", "ERROR") as logs:
+            future = self.ingestor.submit(self.user.id, self.room.id + 1000, "No such room")
+            with self.assertRaises(Exception):
+                future.result(timeout=5)
+        self.assertIn("Traceback", logs.output[0])  # the exception itself, not "NoneType: None"
+
+    def test_only_logged_in_users_can_post_on_either_path(self):
+        url = reverse("room", args=[self.room.id])
+        for enabled in (True, False):
+            with override_settings(MESSAGE_INGEST={**settings.MESSAGE_INGEST, "ENABLED": enabled}):
+                self.assertRedirects(self.client.post(url, {"body": "Hi"}), reverse("login"))
+                response = self.client.post(url, {"body": "Hi"}, HTTP_X_REQUESTED_WITH="fetch")
+                self.assertEqual(response.status_code, 403)
+        self.assertFalse(Message.objects.exists())
+
+
+class BenchmarkTests(TestCase):
+    def test_percentile_and_regressions(self):
+        self.assertEqual(benchmark.percentile(list(range(1, 101)), 95), 95)
+        baseline = {"scenarios": {"home": {"p95_ms": 10.0, "queries": 3}}}
+        self.assertEqual(benchmark.compare({"scenarios": {"home": {"p95_ms": 11.0, "queries": 3}}}, baseline), [])
+        regressions = benchmark.compare({"scenarios": {"home": {"p95_ms": 13.0, "queries": 4}}}, baseline)
+        self.assertEqual(len(regressions), 2)
+
+    def test_run_on_a_seeded_dataset_leaves_it_unchanged(self):
+        cache.clear()
+        benchmark.seed(users=3, topics=2, rooms=4, messages_per_room=3)
+        self.assertEqual(Message.objects.count(), 12)
+        results = benchmark.run(iterations=2, warmup=0, only=["home", "room", "post_message"])
+        self.assertEqual(set(results["scenarios"]), {"home", "room", "post_message"})
+        self.assertEqual(results["meta"]["messages"], 12)  # the posted messages were rolled back
+
+    def test_seeding_resets_the_room_total_and_the_rankings(self):
+        cache.clear()
+        self.assertEqual(roomcount.total_rooms(), 0)
+        rankings_generation = caching.get_generation(caching.RANKINGS)
+        benchmark.seed(users=1, topics=1, rooms=2, messages_per_room=1)
+        self.assertEqual(roomcount.total_rooms(), 2)
+        self.assertNotEqual(caching.get_generation(caching.RANKINGS), rankings_generation)
+
+
+class IngestBenchmarkTests(TransactionTestCase):
+    def test_posts_go_to_a_scratch_copy_of_the_database(self):
+        cache.clear()
+        benchmark.seed(users=2, topics=1, rooms=1, messages_per_room=2)
+        for ingest in (False, True):
+            result = benchmark.ingest_throughput(posters=2, posts=3, ingest=ingest)
+            self.assertEqual((result["messages"], result["failed"]), (6, 0))
+        self.assertEqual(Message.objects.count(), 2)
+
+
+class InstrumentationTests(BuddiesTestCase):
+    def test_responses_carry_server_timing(self):
+        response = self.client.get(reverse("room", args=[self.room.id]))
+        self.assertRegex(
+            response["Server-Timing"], r'^db;dur=[0-9.]+;desc="\d+ queries", tpl;dur=[0-9.]+, view;dur=[0-9.]+$'
+        )
+        self.assertIn("room", request_histogram.snapshot())
+
+    def test_query_budget(self):
+        @query_budget(1)
+        def view(request):
+            list(Room.objects.all())
+            list(Topic.objects.all())
+            return "response"
+
+        request = RequestFactory().get("/")
+        with override_settings(QUERY_BUDGET_STRICT=True), self.assertRaises(QueryBudgetExceeded):
+            view(request)
+        with override_settings(QUERY_BUDGET_STRICT=False), self.assertLogs("base.instrumentation", "WARNING"):
+            self.assertEqual(view(request), "response")
+
+
+class DatabaseTuningTests(BuddiesTestCase):
+    @override_settings(SQLITE_PRAGMAS={"busy_timeout": 1234})  # the test transaction rules out journal_mode and others
+    def test_pragmas_are_applied_without_counting_as_queries(self):
+        with CaptureQueriesContext(connection) as queries:
+            apply_sqlite_pragmas(sender=None, connection=connection)
+        self.assertEqual(len(queries), 0)
+        with connection.cursor() as cursor:
+            cursor.execute("PRAGMA busy_timeout")
+            self.assertEqual(cursor.fetchone()[0], 1234)
+        with override_settings(SQLITE_PRAGMAS={"busy_timeout": "1; DROP TABLE base_room"}):
+            with self.assertRaises(ValueError):
+                apply_sqlite_pragmas(sender=None, connection=connection)
+
+    @override_settings(SQLITE_PRAGMAS={"journal_mode": "wal", "busy_timeout": 1234})
+    def test_the_replica_keeps_its_journal_mode(self):
+        replica = mock.Mock(vendor="sqlite", alias=settings.REPLICA_DATABASE)
+        apply_sqlite_pragmas(sender=None, connection=replica)
+        replica.connection.execute.assert_called_once_with("PRAGMA busy_timeout = 1234")
+
+    def test_sync_replica_moves_a_complete_copy_over_the_replica(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        primary_path, replica_path = os.path.join(directory, "primary"), os.path.join(directory, "replica")
+        for path, rows, mode in ((replica_path, ["old"], "delete"), (primary_path, ["old", "new"], "wal")):
+            with closing(sqlite3.connect(path)) as database:
+                database.execute(f"PRAGMA journal_mode = {mode}")
+                database.execute("CREATE TABLE notes (body TEXT)")
+                database.executemany("INSERT INTO notes VALUES (?)", [(row,) for row in rows])
+                database.commit()
+
+        def rows(database):
+            return [row[0] for row in database.execute("SELECT body FROM notes")]
+
+        engine = "django.db.backends.sqlite3"
+        fake_settings = mock.Mock(
+            REPLICA_DATABASE="replica",
+            DATABASES={
+                "default": {"ENGINE": engine, "NAME": primary_path},
+                "replica": {"ENGINE": engine, "NAME": replica_path},
+            },
+        )
+        with closing(sqlite3.connect(replica_path)) as reader:
+            reader.execute("BEGIN")
+            self.assertEqual(rows(reader), ["old"])
+            with mock.patch.multiple(
+                "base.management.commands.sync_replica", settings=fake_settings, connections=mock.MagicMock()
+            ):
+                call_command("sync_replica", stdout=io.StringIO())
+            self.assertEqual(rows(reader), ["old"])  # a reader in the middle of a query keeps its consistent copy
+        with closing(sqlite3.connect(replica_path)) as replica:
+            self.assertEqual(rows(replica), ["old", "new"])
+            self.assertEqual(replica.execute("PRAGMA journal_mode").fetchone()[0], "delete")
+        self.assertEqual(sorted(os.listdir(directory)), ["primary", "replica"])
+
+    def test_reads_use_the_replica_until_the_reader_writes(self):
+        @routers.read_from_replica
+        def view(request):
+            response = HttpResponse()
+            response.use_replica = routers._use_replica.get()
+            return response
+
+        factory = RequestFactory()
+        self.assertTrue(view(factory.get("/")).use_replica)
+        self.assertFalse(view(factory.post("/")).use_replica)
+        pinned = factory.get("/")
+        pinned.COOKIES[routers.PIN_COOKIE] = "1"
+        self.assertFalse(view(pinned).use_replica)
+        # without a replica configured everything is read from the primary anyway
+        self.assertEqual(routers.ReadReplicaRouter().db_for_read(Room), "default")
+
+    @override_settings(ROOM_PURGE={"BACKGROUND": False, "BATCH_SIZE": 2, "PAUSE": 0})
+    def test_room_writes_pin_the_writer_to_the_primary(self):
+        self.client.force_login(self.user)
+        topic = Topic.objects.get(name="Programming")
+        response = self.client.post(reverse("create-room"), {"name": "Pinned", "description": "", "topic": topic.id})
+        self.assertIn(routers.PIN_COOKIE, response.cookies)
+        room = Room.objects.get(name="Pinned")
+        response = self.client.post(reverse("update-room", args=[room.id]), {"name": "Pinned 2", "topic": topic.id})
+        self.assertIn(routers.PIN_COOKIE, response.cookies)
+        self.assertIn(routers.PIN_COOKIE, self.client.post(reverse("delete-room", args=[room.id])).cookies)
+
+
+@override_settings(MESSAGES_PAGE_SIZE=5, ROOM_STREAM_CHUNK_SIZE=3)
+class StreamingTests(BuddiesTestCase):
+    def test_room_page_is_streamed_in_chunks(self):
+        post_messages(self.room, self.user, 8)
+        with override_settings(ROOM_STREAMING=True):
+            response = self.client.get(reverse("room", args=[self.room.id]))
+        self.assertTrue(response.streaming)
+        chunks = [chunk.decode() for chunk in response.streaming_content]
+        self.assertIn(self.room.name, chunks[0])
+        self.assertNotIn("Message", chunks[0])
+        page = "".join(chunks)
+        self.assertEqual([f"Message {i}" in page for i in (7, 3, 2)], [True, True, False])
+
+    def test_full_history_is_always_streamed(self):
+        post_messages(self.room, self.user, 8)
+        response = self.client.get(reverse("room", args=[self.room.id]), {"history": "all"})
+        self.assertTrue(response.streaming)
+        page = b"".join(response.streaming_content).decode()
+        self.assertTrue(all(f"Message {i}" in page for i in range(8)))
+
+    def test_asgi_requests_get_the_whole_page_at_once(self):
+        post_messages(self.room, self.user, 2)
+        request = ASGIRequest({"type": "http", "method": "GET", "path": "/", "headers": []}, io.BytesIO())
+        request.user = self.user
+        response = stream_room(request, self.room)
+        self.assertFalse(response.streaming)
+        self.assertIn("Message 1", response.content.decode())
+
+    @override_settings(ROOM_ASGI_HISTORY_LIMIT=3)
+    def test_asgi_requests_get_a_bounded_history(self):
+        post_messages(self.room, self.user, 8)
+        request = ASGIRequest({"type": "http", "method": "GET", "path": "/", "headers": []}, io.BytesIO())
+        request.user = self.user
+        page = stream_room(request, self.room, full_history=True).content.decode()
+        self.assertEqual([f"Message {i}" in page for i in (7, 5, 4)], [True, True, False])
+        self.assertIn("?before=", page)
+
+
+class ConditionalGetTests(BuddiesTestCase):
+    def get_twice(self, url, **params):
+        # the first visit hands out the CSRF cookie the ETag of the next ones is made with
+        self.client.get(url, params)
+        response = self.client.get(url, params)
+        self.assertEqual(response.status_code, 200)
+        return response["ETag"]
+
+    def test_room_page_is_not_modified_until_a_message_is_posted(self):
+        url = reverse("room", args=[self.room.id])
+        etag = self.get_twice(url)
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        with self.captureOnCommitCallbacks(execute=True):
+            post_messages(self.room, self.user, 1)
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_room_page_follows_author_changes_and_the_csrf_token(self):
+        url = reverse("room", args=[self.room.id])
+        etag = self.get_twice(url)
+        with self.captureOnCommitCallbacks(execute=True):
+            caching.invalidate(caching.MESSAGES)
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+        etag = self.client.get(url)["ETag"]
+        self.client.cookies["csrftoken"] = "a" * 64
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    @mock.patch("base.roomcount._executor")  # no background recount of the search count
+    def test_home_page_etag_is_per_viewer_and_search(self, executor):
+        url = reverse("home")
+        etag = self.get_twice(url)
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        self.assertEqual(self.client.get(url, {"q": "python"}, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+        self.client.force_login(self.user)
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_pages_with_a_flash_message_get_no_etag(self):
+        request = RequestFactory().get("/")
+        request.user = self.user
+        request.session = {}
+        request._messages = FallbackStorage(request)
+        self.assertIsNotNone(home_etag(request))
+        messages.info(request, "Room created")
+        self.assertIsNone(home_etag(request))
+        self.assertIsNone(room_etag(request, self.room.id))
+
+
+class AutocompleteTests(BuddiesTestCase):
+    def setUp(self):
+        super().setUp()
+        for name in ("python", "PyPI", "Pyramid", "Rust", "pz"):
+            Topic.objects.create(name=name)
+
+    def test_prefix_range(self):
+        self.assertEqual(prefix_range("Py"), ("py", "pz"))
+        # folded like SQLite's lower(), which leaves everything but A-Z alone
+        self.assertEqual(prefix_range("Éc"), ("Éc", "Éd"))
+        self.assertEqual(prefix_range("a\U0010ffff"), ("a\U0010ffff", "b"))
+        self.assertEqual(prefix_range("\U0010ffff"), ("\U0010ffff", None))
+
+    def test_topics_starting_with_the_prefix_in_any_case(self):
+        response = self.client.get(reverse("autocomplete-topics"), {"q": "PY"})
+        self.assertEqual([result["text"] for result in response.json()["results"]], ["PyPI", "Pyramid", "python"])
+        self.assertEqual(len(complete_topics("", limit=2)), 2)
+
+    def test_non_ascii_prefixes_match_the_stored_case(self):
+        Topic.objects.create(name="Éclair")
+        self.assertEqual([name for _, name in complete_topics("Écl")], ["Éclair"])
+        self.assertEqual(complete_topics("\U0010ffff"), [])
+
+    def test_lookup_seeks_the_lower_name_index(self):
+        queryset = Topic.objects.annotate(lowered=Lower("name")).filter(lowered__gte="py", lowered__lt="pz")
+        self.assertIn("topic_name_lower_idx", queryset.explain())
+
+    def test_widget_renders_the_current_label(self):
+        topic = Topic.objects.get(name="Rust")
+        html = RoomForm(instance=Room(topic=topic)).as_p()
+        self.assertIn('value="Rust"', html)
+        self.assertIn(reverse("autocomplete-topics"), html)
+
+
+@override_settings(ROOM_PURGE={"BACKGROUND": False, "BATCH_SIZE": 2, "PAUSE": 0})
+class RoomPurgeTests(BuddiesTestCase):
+    def test_soft_deleted_room_is_hidden_at_once(self):
+        post_messages(self.room, self.user, 3)
+        soft_delete_room(self.room)
+        self.assertFalse(Room.objects.filter(id=self.room.id).exists())
+        self.assertTrue(Room.all_objects.filter(id=self.room.id).exists())
+        self.assertEqual(search_rooms("python"), [])
+        self.assertEqual(Message.objects.filter(room_id=self.room.id).count(), 3)
+
+    def test_pages_of_a_deleted_room_are_not_found(self):
+        self.client.force_login(self.user)
+        soft_delete_room(self.room)
+        for name in ("room", "room-messages", "update-room", "delete-room"):
+            self.assertEqual(self.client.get(reverse(name, args=[self.room.id])).status_code, 404, name)
+
+    def test_purge_deletes_the_messages_in_batches_then_the_room(self):
+        post_messages(self.room, self.user, 5)
+        soft_delete_room(self.room)
+        batches = []
+        deleted = purge_room(self.room.id, progress=lambda room_id, done, total: batches.append((done, total)))
+        self.assertEqual(deleted, 5)
+        self.assertEqual(batches, [(2, 5), (4, 5), (5, 5), (5, 5)])  # the last pass is over the empty archive
+        self.assertFalse(Room.all_objects.filter(id=self.room.id).exists())
+
+    def test_command_resumes_every_soft_deleted_room(self):
+        other = make_room(self.user, name="Django")
+        post_messages(self.room, self.user, 3)
+        post_messages(other, self.user, 1)
+        soft_delete_room(self.room)
+        Room.all_objects.filter(id=other.id).update(deleted_at=timezone.now())  # left behind by a dead process
+        out = io.StringIO()
+        call_command("purge_rooms", stdout=out)
+        self.assertIn("Purged 2 rooms", out.getvalue())
+        self.assertFalse(Message.objects.exists())
+        self.assertFalse(Room.all_objects.exists())
+
+
+@override_settings(MESSAGES_PAGE_SIZE=4)
+class MessageArchiveTests(BuddiesTestCase):
+    def setUp(self):
+        super().setUp()
+        self.posted = post_messages(self.room, self.user, 7)
+        # the first five are a month old, a minute apart
+        for i, message in enumerate(self.posted[:5]):
+            Message.objects.filter(id=message.id).update(
+                created_at=timezone.now() - timedelta(days=30, minutes=10 - i)
+            )
+        self.room.refresh_from_db()
+
+    def test_old_messages_are_moved_compressed_in_batches(self):
+        progress = []
+        self.assertEqual(archive_messages(timedelta(days=1), batch_size=2, progress=progress.append), 5)
+        self.assertEqual(progress, [2, 4, 5])
+        self.assertEqual(Message.objects.count(), 2)
+        archived = ArchivedMessage.objects.get(id=self.posted[0].id)
+        self.assertEqual(archived.body, "Message 0")
+        self.assertEqual(self.room.message_count, 7)  # still the messages of the room
+
+    def test_batches_larger_than_the_parameter_limit_are_deleted_in_parts(self):
+        with mock.patch.object(connection.features, "max_query_params", 2):
+            self.assertEqual(archive_messages(timedelta(days=1), batch_size=5), 5)
+        self.assertEqual(Message.objects.count(), 2)
+        self.assertEqual(ArchivedMessage.objects.count(), 5)
+
+    def test_pages_and_history_continue_into_the_archive(self):
+        archive_messages(timedelta(days=1))
+        expected = [message.id for message in reversed(self.posted)]
+        seen, cursor = [], None
+        while True:
+            page, cursor = message_page(self.room, cursor)
+            seen += [message.id for message in page]
+            if cursor is None:
+                break
+        self.assertEqual(seen, expected)
+        self.assertEqual([message.id for message in room_history(self.room, 2)], expected)
+
+
+class UnreadCountTests(BuddiesTestCase):
+    def setUp(self):
+        super().setUp()
+        self.reader = make_user("grace")
+        self.other = make_room(self.user, name="Django")
+        post_messages(self.room, self.user, 3)
+        post_messages(self.other, self.user, 2)
+        self.room.refresh_from_db()
+
+    def unread(self):
+        url = reverse("unread-counts")
+        return self.client.get(url, {"rooms": f"{self.room.id},{self.other.id}"}).json()["unread"]
+
+    def test_opening_a_room_marks_it_read(self):
+        self.client.force_login(self.reader)
+        self.assertEqual(self.unread(), {str(self.room.id): 3, str(self.other.id): 2})
+        self.client.get(reverse("room", args=[self.room.id]))
+        self.assertEqual(self.unread(), {str(self.room.id): 0, str(self.other.id): 2})
+        post_messages(self.room, self.user, 1)
+        self.assertEqual(self.unread()[str(self.room.id)], 1)
+
+    def test_an_unchanged_room_is_not_written_again(self):
+        mark_room_read(self.reader, self.room)
+        with CaptureQueriesContext(connection) as queries:
+            mark_room_read(self.reader, self.room)
+        self.assertEqual(len(queries), 1)
+        self.assertEqual(unread_counts(self.reader, [self.room.id]), {self.room.id: 0})
+
+    def test_anonymous_and_invalid_requests(self):
+        self.assertEqual(self.unread(), {})
+        self.client.force_login(self.reader)
+        self.assertEqual(self.client.get(reverse("unread-counts"), {"rooms": "1,x"}).status_code, 400)
+
+
+class MessageFragmentTests(BuddiesTestCase):
+    @mock.patch("base.caching.get_template")
+    def test_only_new_or_edited_rows_are_rendered(self, get_template):
+        render = get_template.return_value.render
+        render.side_effect = lambda context: f"<{context['message'].body}>"
+        messages = post_messages(self.room, self.user, 3)
+        self.assertEqual(caching.render_messages(messages), "<Message 0><Message 1><Message 2>")
+        self.assertEqual(render.call_count, 3)
+
+        messages[1].body = "Edited"
+        messages[1].save()
+        self.assertEqual(caching.render_messages(messages), "<Message 0><Edited><Message 2>")
+        self.assertEqual(render.call_count, 4)
+
+    def test_rows_carry_the_time_for_the_browser_to_make_relative(self):
+        message = post_messages(self.room, self.user, 1)[0]
+        html = caching.render_messages([message])
+        self.assertIn(f'datetime="{message.created_at.isoformat()}"', html)
+        self.assertNotIn("ago", html)
+
+
+class MetricsTests(BuddiesTestCase):
+    def test_render_in_the_prometheus_format(self):
+        registry = metrics.Registry()
+        registry.counter("hits_total", "Hits", ["view"]).inc("home", amount=2)
+        latency = registry.histogram("latency_seconds", "Latency", buckets=(0.1, 1.0))
+        latency.observe(0.05)
+        latency.observe(0.5)
+        text = metrics.render(registry.snapshot())
+        self.assertIn('hits_total{view="home"} 2', text)
+        self.assertIn('latency_seconds_bucket{le="1.0"} 2', text)
+        self.assertIn('latency_seconds_bucket{le="+Inf"} 2', text)
+        self.assertIn("latency_seconds_count 2", text)
+
+    @override_settings(METRICS_TOKEN="secret")
+    def test_endpoint_needs_the_token(self):
+        self.assertEqual(self.client.get(reverse("metrics")).status_code, 401)
+        response = self.client.get(reverse("metrics"), HTTP_AUTHORIZATION="Bearer secret")
+        self.assertContains(response, "# TYPE buddies_messages_posted_total counter")
+
+    def test_counters_of_exited_processes_are_kept_and_their_files_removed(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        exited = {
+            "buddies_messages_posted_total": {**metrics.registry.snapshot()["buddies_messages_posted_total"]},
+            "buddies_ingest_queue_depth": {**metrics.registry.snapshot()["buddies_ingest_queue_depth"]},
+        }
+        exited["buddies_messages_posted_total"]["samples"] = [[[], 1000]]
+        exited["buddies_ingest_queue_depth"]["samples"] = [[[], 7]]
+        with open(os.path.join(directory, "4194305-deadbeef.json"), "w") as f:  # above the largest Linux pid
+            json.dump(exited, f)
+
+        def posted(snapshot):
+            return {tuple(labels): value for labels, value in snapshot["buddies_messages_posted_total"]["samples"]}
+
+        own = posted(metrics.registry.snapshot()).get((), 0)
+        with override_settings(METRICS_DIR=directory), mock.patch.object(metrics, "_retired", {}):
+            for _ in range(2):
+                snapshot = metrics.collect()
+                self.assertEqual(posted(snapshot)[()], own + 1000)
+                self.assertNotIn(
+                    [[], 7], snapshot["buddies_ingest_queue_depth"]["samples"]
+                )  # gauges of live ones only
+                self.assertEqual(os.listdir(directory), [f"{os.getpid()}-{metrics._process_token}.json"])
+
+    def test_only_snapshot_files_are_read_and_stale_claims_are_removed(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        snapshot = metrics.registry.snapshot()
+        snapshot["buddies_messages_posted_total"]["samples"] = [[[], 1000]]
+        # a copy somebody left there, and a snapshot claimed by a worker that died before deleting it
+        for filename in ("backup.json", "4194305-deadbeef.json.4194306-deadbeef.retired"):
+            with open(os.path.join(directory, filename), "w") as f:
+                json.dump(snapshot, f)
+        own = metrics.registry.snapshot()["buddies_messages_posted_total"]["samples"]
+        with override_settings(METRICS_DIR=directory), mock.patch.object(metrics, "_retired", {}):
+            self.assertEqual(metrics.collect()["buddies_messages_posted_total"]["samples"], own)
+        self.assertEqual(
+            sorted(os.listdir(directory)), sorted([f"{os.getpid()}-{metrics._process_token}.json", "backup.json"])
+        )
+
+
+class AuthCacheTests(BuddiesTestCase):
+    def load(self, pk):
+        self.loads += 1
+        return User.objects.filter(pk=pk).first()
+
+    def setUp(self):
+        super().setUp()
+        self.loads = 0
+
+    def test_user_is_loaded_once_and_each_caller_gets_its_own_copy(self):
+        first = authcache.get_user(self.user.pk, self.load)
+        second = authcache.get_user(self.user.pk, self.load)
+        self.assertEqual(self.loads, 1)
+        self.assertEqual(first, second)
+        self.assertIsNot(first, second)
+
+    def test_changing_one_user_keeps_the_cached_copies_of_the_others(self):
+        other = make_user("grace")
+        authcache.get_user(self.user.pk, self.load)
+        authcache.get_user(other.pk, self.load)
+        version = authcache.get_version(authcache._user_key(self.user.pk))
+        with self.captureOnCommitCallbacks(execute=True):
+            other.first_name = "Grace"
+            other.save()
+        self.assertEqual(authcache.get_version(authcache._user_key(self.user.pk)), version)
+        authcache.get_user(self.user.pk, self.load)
+        self.assertEqual(authcache.get_user(other.pk, self.load).first_name, "Grace")
+        self.assertEqual(self.loads, 3)
+
+    def test_warm_requests_run_no_auth_queries(self):
+        self.client.force_login(self.user)
+        url = reverse("unread-counts")
+        self.client.get(url, {"rooms": self.room.id})
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.client.get(url, {"rooms": self.room.id}).status_code, 200)
+        self.assertEqual(len(queries), 1)  # the unread counts themselves, no session or user row
+
+    def test_deleted_user_is_not_found_in_the_cache(self):
+        other = User.objects.create(username="grace", email="grace@example.com")
+        backend, pk = backends.UserBackend(), other.pk
+        self.assertEqual(backend.get_user(pk), other)
+        with self.captureOnCommitCallbacks(execute=True):
+            other.delete()
+        self.assertIsNone(backend.get_user(pk))
+
+    def test_logout_ends_the_cached_session(self):
+        self.client.force_login(self.user)
+        session_key = self.client.session.session_key
+        self.client.get(reverse("unread-counts"))
+        self.client.get(reverse("logout"))
+        self.assertEqual(SessionStore(session_key).load(), {})
+
+
+@override_settings(ROOM_COUNT={"TTL": 60, "CAP": 3}, ROOMS_PAGE_SIZE=2, ROOMS_MAX_PAGE=2)
+class RoomCountTests(BuddiesTestCase):
+    def test_display_count(self):
+        self.assertEqual(roomcount.display_count(None, 0, 2, True), "2+")
+        self.assertEqual(roomcount.display_count(3, 0, 2, True), "3")
+        self.assertEqual(roomcount.display_count(10, 0, 2, True), "3+")
+        self.assertEqual(roomcount.display_count(None, 2, 1, False), "3")
+
+    @override_settings(ROOM_PURGE={"BACKGROUND": False, "BATCH_SIZE": 2, "PAUSE": 0})
+    def test_total_is_counted_once_then_moved_by_writes(self):
+        self.assertEqual(roomcount.total_rooms(), 1)
+        with self.captureOnCommitCallbacks(execute=True):
+            room = make_room(self.user, name="Django")
+        with self.assertNumQueries(0):
+            self.assertEqual(roomcount.total_rooms(), 2)
+        with self.captureOnCommitCallbacks(execute=True):
+            soft_delete_room(room)
+        self.assertEqual(roomcount.total_rooms(), 1)
+
+    @mock.patch("base.roomcount._pending", set())  # other tests leave searches pending on their mocked executor
+    @mock.patch("base.roomcount._executor")
+    def test_search_counts_are_made_in_the_background_once(self, executor):
+        self.assertIsNone(roomcount.search_count("Python"))
+        self.assertIsNone(roomcount.search_count("  python "))
+        executor.submit.assert_called_once_with(roomcount._recount, "Python")
+        generation = caching.get_generation(caching.COUNTS)
+        roomcount._recount("Python")
+        self.assertEqual(roomcount.search_count("python"), 1)
+        self.assertNotEqual(caching.get_generation(caching.COUNTS), generation)
+
+    def test_pages_past_the_deepest_one_are_not_found(self):
+        for i in range(5):
+            make_room(self.user, name=f"Room {i}")
+        self.assertContains(self.client.get(reverse("home"), {"page": 1}), "page=2")
+        self.assertNotContains(self.client.get(reverse("home"), {"page": 2}), "page=3")
+        self.assertEqual(self.client.get(reverse("home"), {"page": 3}).status_code, 404)
+
+
+def make_picture(color="red"):
+    data = io.BytesIO()
+    Image.new("RGB", (300, 200), color).save(data, format="PNG")
+    return SimpleUploadedFile("me.PNG", data.getvalue(), content_type="image/png")
+
+
+class AvatarTests(BuddiesTestCase):
+    def setUp(self):
+        super().setUp()
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        settings_override = override_settings(MEDIA_ROOT=media_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def make_thumbnails(self, user):
+        # what the worker process does, run here instead
+        avatar_hash = os.path.basename(user.avatar.name).split(".")[0]
+        directory = default_storage.path(avatars.THUMBNAILS_DIR)
+        avatars.make_thumbnails(user.avatar.path, avatar_hash, [48, 160], directory)
+        return avatar_hash
+
+    def test_thumbnails_are_made_after_the_commit_and_the_hash_saved_when_done(self):
+        with self.captureOnCommitCallbacks() as callbacks:
+            avatars.save_avatar(self.user, make_picture())
+        self.assertEqual(len(callbacks), 1)  # the thumbnails, queued for the commit
+        self.user.save()
+        self.assertEqual(self.user.avatar.name.split("/")[:2], ["avatars", "originals"])
+        self.assertIsNone(self.user.avatar_hash)
+
+        avatar_hash = self.make_thumbnails(self.user)
+        future = Future()
+        future.set_result(None)
+        avatars._thumbnails_done(self.user.pk, avatar_hash, future)
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.avatar_hash, avatar_hash)
+        self.assertEqual(avatar_url(self.user, "large"), f"/media/avatars/{avatar_hash}-160.png")
+
+    def test_a_picture_uploaded_before_is_not_processed_again(self):
+        avatars.save_avatar(self.user, make_picture())
+        avatar_hash = self.make_thumbnails(self.user)
+        other = make_user("grace")
+        with self.captureOnCommitCallbacks() as callbacks:
+            avatars.save_avatar(other, make_picture())
+        self.assertEqual(callbacks, [])
+        self.assertEqual((other.avatar.name, other.avatar_hash), (self.user.avatar.name, avatar_hash))
+
+    def test_failed_thumbnails_keep_the_previous_avatar(self):
+        future = Future()
+        future.set_exception(OSError("cannot identify image file"))
+        with self.assertLogs("base.avatars", "ERROR"):
+            avatars._thumbnails_done(self.user.pk, "0" * 64, future)
+        self.user.refresh_from_db()
+        self.assertIsNone(self.user.avatar_hash)
+
+    def test_only_thumbnails_are_served_forever(self):
+        avatars.save_avatar(self.user, make_picture())
+        avatar_hash = self.make_thumbnails(self.user)
+        response = self.client.get(reverse("avatar", args=[f"{avatar_hash}-48.png"]))
+        self.assertEqual(response["Cache-Control"], "public, max-age=31536000, immutable")
+        response.close()
+        self.assertEqual(self.client.get(reverse("avatar", args=["originals"])).status_code, 404)
+        self.assertEqual(self.client.get(reverse("avatar", args=[f"{'f' * 64}-48.png"])).status_code, 404)
+
+
+class ActivityRollupTests(BuddiesTestCase):
+    def setUp(self):
+        super().setUp()
+        self.other = make_room(self.user, name="Rust", topic="Systems")
+        post_messages(self.room, self.user, 3)
+        post_messages(self.other, self.user, 5)
+
+    def test_messages_are_counted_once_per_room_and_day(self):
+        batches = []
+        self.assertEqual(rollup_messages(batch_size=3, progress=lambda counted, last_id: batches.append(counted)), 8)
+        self.assertEqual(batches, [3, 6, 8])
+        today = timezone.localdate()
+        self.assertEqual(ActivityRollup.objects.get(room=self.other, day=today).message_count, 5)
+
+        post_messages(self.room, self.user, 1)
+        self.assertEqual(rollup_messages(), 1)  # only what was posted since the watermark
+        self.assertEqual(ActivityRollup.objects.get(room=self.room, day=today).message_count, 4)
+
+    def test_messages_older_than_the_window_are_left_out(self):
+        Message.objects.filter(room=self.other).update(created_at=timezone.now() - timedelta(days=30))
+        self.assertEqual(rollup_messages(), 3)
+
+    def test_rankings_are_read_in_one_query_without_deleted_rooms(self):
+        rollup_messages()
+        ActivityRollup.objects.create(room=self.room, day=timezone.localdate() - timedelta(days=30), message_count=99)
+        rank_activity()
+        self.assertFalse(ActivityRollup.objects.filter(message_count=99).exists())
+        with self.assertNumQueries(1):
+            topics, rooms = rankings()
+        self.assertEqual(
+            [(ranking.topic.name, ranking.message_count) for ranking in topics], [("Systems", 5), ("Programming", 3)]
+        )
+        self.assertEqual([ranking.room for ranking in rooms], [self.other, self.room])
+        soft_delete_room(self.other)
+        self.assertEqual([ranking.room for ranking in rankings()[1]], [self.room])
+
+    def test_command_updates_the_home_page(self):
+        out = io.StringIO()
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command("rollup_activity", stdout=out)
+        self.assertIn("8 new messages counted, 4 rankings written", out.getvalue())
+        self.assertContains(self.client.get(reverse("home")), "Most Active Rooms")
+
+
+class TransferTests(BuddiesTestCase):
+    def setUp(self):
+        super().setUp()
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = os.path.join(directory, "buddies.ndjson.gz")
+        self.checkpoint = os.path.join(directory, "buddies.checkpoint")
+        other = make_user("grace")
+        make_room(other, name="Rust", topic="Systems", description="Borrow checking")
+        for room in Room.objects.all():
+            post_messages(room, self.user, 3)
+            post_messages(room, other, 2)
+        Message.objects.filter(body="Message 0").update(created_at=timezone.now() - timedelta(days=30))
+        archive_messages(timedelta(days=1))
+
+    def contents(self):
+        return {
+            "rooms": sorted(
+                Room.objects.values_list("name", "description", "host__username", "topic__name", "created_at")
+            ),
+            "messages": sorted(
+                (room.name, message.user.username, message.body, message.created_at)
+                for room in Room.objects.all()
+                for message in room_history(room, 100)
+            ),
+        }
+
+    def export_and_clear(self):
+        expected = self.contents()
+        self.assertEqual(export_data(self.path), 2 + 2 + 2 + 10)  # users, topics, rooms, messages
+        Room.all_objects.all().delete()
+        Topic.objects.all().delete()
+        return expected
+
+    def test_round_trip(self):
+        expected = self.export_and_clear()
+        imported, skipped = import_data(self.path, chunk_size=3)
+        self.assertEqual(imported, {"user": 0, "topic": 2, "room": 2, "message": 10})  # the users were still there
+        self.assertEqual(skipped, 0)
+        self.assertEqual(self.contents(), expected)
+        room = Room.objects.get(name="Rust")
+        self.assertEqual((room.message_count, room.participants.count()), (5, 2))
+        self.assertEqual(search_rooms("borrow"), [room])
+
+    def test_an_interrupted_import_resumes_from_its_checkpoint(self):
+        expected = self.export_and_clear()
+        import_messages = transfer.IMPORTERS["message"]
+        calls = []
+
+        def interrupted(records, state):
+            calls.append(len(records))
+            if len(calls) == 2:
+                raise KeyboardInterrupt
+            return import_messages(records, state)
+
+        with mock.patch.dict(transfer.IMPORTERS, {"message": interrupted}):
+            with self.assertRaises(KeyboardInterrupt):
+                import_data(self.path, chunk_size=3, checkpoint=self.checkpoint)
+        self.assertEqual(Message.objects.count(), 3)
+        imported, _ = import_data(self.path, chunk_size=3, checkpoint=self.checkpoint)
+        self.assertEqual(imported["message"], 10)
+        self.assertEqual(self.contents(), expected)
+        self.assertFalse(os.path.exists(self.checkpoint))
+
+    def test_users_without_a_username_or_an_email(self):
+        records = [
+            {"format": "buddies", "version": 1},
+            {"model": "user", "id": 50, "username": None, "email": "Margaret@Example.com"},
+            {"model": "user", "id": 51, "username": "Linus", "email": None},
+            {"model": "user", "id": 52, "username": None, "email": None},
+        ]
+        with gzip.open(self.path, "wt") as f:
+            f.writelines(json.dumps(record) + "\n" for record in records)
+        imported, _ = import_data(self.path)
+        self.assertEqual(imported["user"], 3)
+        self.assertTrue(User.objects.filter(username=None, email="margaret@example.com").exists())
+        self.assertTrue(User.objects.filter(username="linus", email=None).exists())
+        self.assertEqual(import_data(self.path)[0]["user"], 1)  # only the one without either is not found again
+
+    def test_other_files_are_refused(self):
+        with gzip.open(self.path, "wt") as f:
+            f.write('{"format": "something else"}\n')
+        with self.assertRaises(ValueError):
+            import_data(self.path)
+
+
+@override_settings(
+    PASSWORD_CHECK_WORKERS=0,
+    RATE_LIMIT={
+        "ENABLED": True,
+        "BACKEND": "base.ratelimit.InProcessLimiter",
+        "IP_HEADER": "REMOTE_ADDR",
+        "RATES": {"message": (2, 60), "login-ip": (20, 60), "login-username": (2, 60)},
+        "TRUSTED_LOGIN_SECONDS": 60,
+    },
+)
+class RateLimitTests(BuddiesTestCase):
+    def setUp(self):
+        super().setUp()
+        # every test starts with full buckets
+        patcher = mock.patch.object(ratelimit, "_limiter", ratelimit.InProcessLimiter())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def login(self, password, ip):
+        return self.client.post(reverse("login"), {"username": "ADA", "password": password}, REMOTE_ADDR=ip)
+
+    def test_posting_too_fast_gets_429_with_retry_after(self):
+        self.client.force_login(self.user)
+        url = reverse("room", args=[self.room.id])
+        for _ in range(2):
+            self.assertEqual(self.client.post(url, {"body": "Hi"}, HTTP_X_REQUESTED_WITH="fetch").status_code, 204)
+        with self.assertNumQueries(0):
+            response = self.client.post(url, {"body": "Hi"}, HTTP_X_REQUESTED_WITH="fetch")
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response["Retry-After"], "30")
+        self.assertEqual(Message.objects.count(), 2)
+        self.assertEqual(self.client.get(url).status_code, 200)  # reading is not limited
+
+    def test_only_failed_logins_count_against_the_account(self):
+        for _ in range(3):
+            self.assertEqual(self.login(PASSWORD, "10.0.0.1").status_code, 302)
+            self.client.logout()
+        for ip in ("10.0.0.2", "10.0.0.3"):
+            self.assertEqual(self.login("wrong", ip).status_code, 200)
+        self.assertEqual(self.login("wrong", "10.0.0.4").status_code, 429)
+        # the owner logged in from here before, a locked account does not lock them out
+        self.assertEqual(self.login(PASSWORD, "10.0.0.1").status_code, 302)
+        self.client.logout()
+        self.assertEqual(self.login(PASSWORD, "10.0.0.5").status_code, 429)
+
+    def test_limiter_backends(self):
+        with self.assertRaises(TypeError):
+            ratelimit.Limiter()
+        path = os.path.join(tempfile.mkdtemp(), "ratelimit")
+        self.addCleanup(shutil.rmtree, os.path.dirname(path))
+        first, second = ratelimit.SharedMemoryLimiter(path, slots=64), ratelimit.SharedMemoryLimiter(path, slots=64)
+        self.assertEqual(first.take("key", 2, 60), 0)
+        self.assertEqual(second.take("key", 2, 60, take=False), 0)  # looking costs nothing
+        self.assertEqual(second.take("key", 2, 60), 0)
+        self.assertAlmostEqual(first.take("key", 2, 60), 30, places=0)  # the bucket is shared through the file
+        self.assertEqual(first.take("other key", 2, 60), 0)
@@ -0,0 +1,363 @@
+"""
+Bulk export and import of users, topics, rooms and messages, for backfills and moving data between environments.
+
+The format is NDJSON: one JSON object per line, gzip compressed when the file name ends in .gz. The first line is a
+header, then come every user, topic, room and message in that order, each with a "model" key, e.g.
+
+    {"format": "buddies", "version": 1}
+    {"model": "user", "id": 1, "username": "ada", ...}
+    {"model": "room", "id": 7, "host_id": 1, "topic_id": 3, "name": "Python", ...}
+    {"model": "message", "id": 12, "user_id": 1, "room_id": 7, "body": "Hello", ...}
+
+``python manage.py export_buddies`` streams the tables out through database iterators, so memory use stays the same
+whatever their size. Archived messages are exported as plain messages, before the others since they are older.
+
+``python manage.py import_buddies`` reads the file line by line and inserts CHUNK_SIZE rows at a time, users and
+topics with bulk_create, rooms and messages with a plain INSERT so they keep their timestamps:
+
+- Users already present (same username or email) and topics with the same name are reused, everything else is
+  inserted under new ids, handed out by the importer so the foreign keys of the next rows can be resolved through an
+  in-memory map of old to new ids. Only users, topics and rooms are kept in the map, never messages.
+- Bulk inserts send no signals. Room counters, participants, the search index and the cached pages are brought up to
+  date once at the end.
+- After every chunk the line number, the next ids and the id map are written to a checkpoint file. An interrupted
+  import started again with the same checkpoint skips the lines already imported. A chunk that was committed just
+  before the checkpoint could be written gets the same ids again, and rows that already exist are skipped.
+
+Import into a site that is not taking writes: a room or message created meanwhile could take an id the importer has
+already handed out.
+"""
+import gzip
+import json
+import os
+import sys
+import zlib
+from contextlib import contextmanager
+from datetime import datetime
+
+from django.core.cache import cache
+from django.core.management.color import no_style
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connection, transaction
+from django.db.models import Max, Q
+from django.db.models.functions import Lower
+from django.utils.dateparse import parse_datetime
+
+from . import activity, caching, roomcount, search
+from .models import ArchivedMessage, Message, Room, Topic, User
+
+FORMAT_VERSION = 1
+
+USER_FIELDS = [
+    "id",
+    "username",
+    "email",
+    "password",
+    "first_name",
+    "last_name",
+    "bio",
+    "avatar",
+    "avatar_hash",
+    "is_active",
+    "is_staff",
+    "is_superuser",
+    "date_joined",
+    "last_login",
+]
+TOPIC_FIELDS = ["id", "name"]
+ROOM_FIELDS = ["id", "host_id", "topic_id", "name", "description", "created_at", "updated_at"]
+MESSAGE_FIELDS = ["id", "user_id", "room_id", "body", "created_at", "updated_at"]
+DATETIME_FIELDS = {"date_joined", "last_login", "created_at", "updated_at"}
+
+
+@contextmanager
+def open_data(path, mode):
+    """
+    Opens path for reading ("r") or writing ("w") as text, through gzip when it ends in .gz. "-" is stdin or stdout.
+    """
+    if path == "-":
+        yield sys.stdin if mode == "r" else sys.stdout
+        return
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, mode + "t", encoding="utf-8") as f:
+        yield f
+
+
+def export_records(chunk_size=2000):
+    """
+    Yields every record of the export, header first. Rows are read chunk_size at a time.
+    """
+    yield {"format": "buddies", "version": FORMAT_VERSION}
+    for name, queryset, fields in [
+        ("user", User.objects.all(), USER_FIELDS),
+        ("topic", Topic.objects.all(), TOPIC_FIELDS),
+        ("room", Room.objects.all(), ROOM_FIELDS),
+    ]:
+        for row in queryset.order_by("id").values(*fields).iterator(chunk_size=chunk_size):
+            yield {"model": name, **row}
+
+    archived = ArchivedMessage.objects.filter(room__deleted_at__isnull=True).order_by("id")
+    archived_fields = [field for field in MESSAGE_FIELDS if field != "body"] + ["compressed_body"]
+    for row in archived.values(*archived_fields).iterator(chunk_size=chunk_size):
+        row["body"] = zlib.decompress(row.pop("compressed_body")).decode()
+        yield {"model": "message", **row}
+
+    messages = Message.objects.filter(room__deleted_at__isnull=True).order_by("id")
+    for row in messages.values(*MESSAGE_FIELDS).iterator(chunk_size=chunk_size):
+        yield {"model": "message", **row}
+
+
+class _Encoder(DjangoJSONEncoder):
+    def default(self, o):
+        # DjangoJSONEncoder cuts datetimes to milliseconds, messages posted within the same millisecond would lose
+        # their order
+        if isinstance(o, datetime):
+            return o.isoformat()
+        return super().default(o)
+
+
+def export_data(path, chunk_size=2000, progress=None):
+    """
+    Writes the export to path and returns the number of records written, the header not included.
+    """
+    written = 0
+    with open_data(path, "w") as f:
+        for record in export_records(chunk_size):
+            f.write(json.dumps(record, cls=_Encoder, separators=(",", ":")) + "\n")
+            if "model" in record:
+                written += 1
+                if progress and written % chunk_size == 0:
+                    progress(written)
+    return written
+
+
+def _new_state():
+    rooms = Room.all_objects.aggregate(Max("id"))["id__max"] or 0
+    # archived messages keep their ids, a new message must not reuse one
+    messages = max(
+        Message.objects.aggregate(Max("id"))["id__max"] or 0,
+        ArchivedMessage.objects.aggregate(Max("id"))["id__max"] or 0,
+    )
+    return {
+        "line": 1,  # the header
+        "next_id": {
+            "user": (User.objects.aggregate(Max("id"))["id__max"] or 0) + 1,
+            "topic": (Topic.objects.aggregate(Max("id"))["id__max"] or 0) + 1,
+            "room": rooms + 1,
+            "message": messages + 1,
+        },
+        # old id (as a string, these are JSON object keys) -> new id
+        "ids": {"user": {}, "topic": {}, "room": {}},
+        "imported": {"user": 0, "topic": 0, "room": 0, "message": 0},
+        "skipped": 0,
+    }
+
+
+def _allocate(state, model):
+    new_id = state["next_id"][model]
+    state["next_id"][model] += 1
+    return new_id
+
+
+def _map(state, model, old_id):
+    return None if old_id is None else state["ids"][model].get(str(old_id))
+
+
+def _insert(model, objects):
+    """
+    bulk_create(objects, ignore_conflicts=True) that keeps the created_at and updated_at of the objects. bulk_create
+    gives auto_now and auto_now_add fields the time of the import, so the rows are inserted with a plain INSERT
+    instead. Sends no signals either.
+    """
+    if not objects:
+        return
+    fields = model._meta.concrete_fields
+    ops = connection.ops
+    sql = "{} {} ({}) VALUES ({}){}".format(
+        ops.insert_statement(ignore_conflicts=True),
+        ops.quote_name(model._meta.db_table),
+        ", ".join(ops.quote_name(field.column) for field in fields),
+        ", ".join(["%s"] * len(fields)),
+        ops.ignore_conflicts_suffix_sql(ignore_conflicts=True),
+    )
+    rows = [[field.get_db_prep_save(getattr(obj, field.attname), connection) for field in fields] for obj in objects]
+    with connection.cursor() as cursor:
+        cursor.executemany(sql, rows)
+
+
+def _import_users(records, state):
+    # logins look users up by lower(username) or lower(email) (base/backends.py), so a user that only differs in case
+    # is the same user
+    # both are nullable, a user without one is only matched by the other
+    usernames = [record["username"].lower() for record in records if record.get("username")]
+    emails = [record["email"].lower() for record in records if record.get("email")]
+    existing_usernames, existing_emails = {}, {}
+    matches = User.objects.annotate(username_lower=Lower("username"), email_lower=Lower("email")).filter(
+        Q(username_lower__in=usernames) | Q(email_lower__in=emails)
+    )
+    for pk, username, email in matches.values_list("id", "username_lower", "email_lower"):
+        if username:
+            existing_usernames[username] = pk
+        if email:
+            existing_emails[email] = pk
+
+    users = []
+    for record in records:
+        old_id = record.pop("id")
+        username, email = (record.get("username") or "").lower(), (record.get("email") or "").lower()
+        pk = existing_usernames.get(username) or existing_emails.get(email)
+        if pk is None:
+            pk = _allocate(state, "user")
+            # stored lowercased, as User.save does (bulk_create does not call it)
+            users.append(
+                User(
+                    id=pk,
+                    **{
+                        **record,
+                        "username": username or record.get("username"),
+                        "email": email or record.get("email"),
+                    },
+                )
+            )
+            # a second record with the same username or email in the file maps to this user too
+            if username:
+                existing_usernames[username] = pk
+            if email:
+                existing_emails[email] = pk
+        state["ids"]["user"][str(old_id)] = pk
+    User.objects.bulk_create(users, ignore_conflicts=True)
+    return len(users)
+
+
+def _import_topics(records, state):
+    existing = dict(
+        Topic.objects.filter(name__in=[record["name"] for record in records]).order_by("-id").values_list("name", "id")
+    )
+    topics = []
+    for record in records:
+        old_id = record.pop("id")
+        pk = existing.get(record["name"])
+        if pk is None:
+            pk = existing[record["name"]] = _allocate(state, "topic")
+            topics.append(Topic(id=pk, **record))
+        state["ids"]["topic"][str(old_id)] = pk
+    Topic.objects.bulk_create(topics, ignore_conflicts=True)
+    return len(topics)
+
+
+def _import_rooms(records, state):
+    rooms = []
+    for record in records:
+        old_id = record.pop("id")
+        record["host_id"] = _map(state, "user", record["host_id"])
+        record["topic_id"] = _map(state, "topic", record["topic_id"])
+        pk = state["ids"]["room"][str(old_id)] = _allocate(state, "room")
+        rooms.append(Room(id=pk, **record))
+    _insert(Room, rooms)
+    return len(rooms)
+
+
+def _import_messages(records, state):
+    messages = []
+    for record in records:
+        record.pop("id")
+        record["room_id"] = _map(state, "room", record["room_id"])
+        if record["room_id"] is None:
+            # the room was not in the file
+            state["skipped"] += 1
+            continue
+        record["user_id"] = _map(state, "user", record["user_id"])
+        messages.append(Message(id=_allocate(state, "message"), **record))
+    _insert(Message, messages)
+    return len(messages)
+
+
+IMPORTERS = {
+    "user": _import_users,
+    "topic": _import_topics,
+    "room": _import_rooms,
+    "message": _import_messages,
+}
+
+
+def _parse(line):
+    record = json.loads(line)
+    for field in DATETIME_FIELDS.intersection(record):
+        if record[field] is not None:
+            record[field] = parse_datetime(record[field])
+    return record
+
+
+def _save_checkpoint(path, state):
+    if not path:
+        return
+    with open(f"{path}.tmp", "w") as f:
+        json.dump(state, f)
+    os.replace(f"{path}.tmp", path)
+
+
+def import_data(path, chunk_size=2000, checkpoint=None, progress=None):
+    """
+    Imports the file at path. With a checkpoint path the import can be resumed after an interruption, the checkpoint
+    is deleted once the import is complete. Returns the number of rows inserted per model and the number of messages
+    skipped.
+    """
+    if checkpoint and os.path.exists(checkpoint):
+        with open(checkpoint) as f:
+            state = json.load(f)
+    else:
+        state = _new_state()
+
+    def flush(model, records, line):
+        if records:
+            with transaction.atomic():
+                state["imported"][model] += IMPORTERS[model](records, state)
+        state["line"] = line
+        _save_checkpoint(checkpoint, state)
+        if progress:
+            progress(state)
+
+    with open_data(path, "r") as f:
+        header = json.loads(f.readline() or "{}")
+        if header.get("format") != "buddies" or header.get("version") != FORMAT_VERSION:
+            raise ValueError(f"{path} is not a Buddies export (version {FORMAT_VERSION})")
+        model, records = None, []
+        number = 1
+        for number, line in enumerate(f, 2):
+            if number <= state["line"] or not line.strip():
+                continue
+            record = _parse(line)
+            if record.get("model") not in IMPORTERS:
+                raise ValueError(f"Unknown record on line {number}: {line[:100]}")
+            if record["model"] != model or len(records) == chunk_size:
+                flush(model, records, number - 1)
+                model, records = record["model"], []
+            del record["model"]
+            records.append(record)
+        flush(model, records, number)
+
+    _finish(state)
+    if checkpoint and os.path.exists(checkpoint):
+        os.remove(checkpoint)
+    return state["imported"], state["skipped"]
+
+
+def _finish(state):
+    """
+    Everything the signal receivers would have done row by row, once for the whole import.
+    """
+    # Postgres and friends hand out ids from sequences, which must move past the ids given out here. On SQLite the
+    # list is empty
+    statements = connection.ops.sequence_reset_sql(no_style(), [User, Topic, Room, Message])
+    if statements:
+        with connection.cursor() as cursor:
+            for sql in statements:
+                cursor.execute(sql)
+
+    room_ids = sorted(state["ids"]["room"].values())
+    for start in range(0, len(room_ids), 500):
+        activity.recount_rooms(room_ids[start : start + 500])
+    search.rebuild_index()
+    cache.delete(roomcount.TOTAL_KEY)
+    for group in (caching.TOPICS, caching.ROOMS, caching.RANKINGS):
+        caching.bump_generation(group)
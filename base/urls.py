@@ -8,7 +8,11 @@ urlpatterns = [
     path("register/", views.registerPage, name="register"),
     path("", views.home, name="home"),
     path("room/<str:pk>/", views.room, name="room"),
+    path("room/<str:pk>/messages/", views.roomMessages, name="room-messages"),
     path("create-room/", views.createRoom, name="create-room"),
     path("update-room/<str:pk>/", views.updateRoom, name="update-room"),
     path("delete-room/<str:pk>/", views.deleteRoom, name="delete-room"),
+    path("update-user/", views.updateUser, name="update-user"),
+    path("unread/", views.unreadCounts, name="unread-counts"),
+    path("autocomplete/topics/", views.topicAutocomplete, name="autocomplete-topics"),
 ]
@@ -1,19 +1,41 @@
+from django.conf import settings
 from django.contrib import messages
 from django.contrib.auth import authenticate, login, logout
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.forms import UserCreationForm
-from django.db.models import Q
-from django.http import HttpResponse
-from django.shortcuts import redirect, render
+from django.db import transaction
+from django.http import FileResponse, Http404, HttpResponse, HttpResponseBadRequest, JsonResponse
+from django.shortcuts import get_object_or_404, redirect, render
+from django.template.loader import render_to_string
+from django.utils.safestring import mark_safe
+from django.views.decorators.cache import cache_control
+from django.views.decorators.http import condition
 
-from .forms import CustomUserCreationForm, RoomForm
-from .models import Message, Room, Topic, User
+from . import metrics, ratelimit, roomcount
+from .autocomplete import complete_topics
+from .avatars import open_thumbnail, save_avatar
+from .caching import RANKINGS, ROOMS, TOPICS, cached_fragment, render_messages
+from .conditional import home_etag, room_etag, room_last_modified
+from .forms import CustomUserCreationForm, RoomForm, UserForm
+from .ingest import get_ingestor
+from .instrumentation import query_budget
+from .models import Message, Room, Topic
+from .pagination import InvalidCursor, message_page
+from .purge import soft_delete_room
+from .ratelimit import rate_limit
+from .rollup import rankings
+from .routers import pin_primary, read_from_replica
+from .search import search_rooms
+from .streaming import stream_room
+from .unread import mark_room_read, unread_counts
 
 
+@rate_limit("login-ip", key="ip")  # one address trying many accounts
+@rate_limit("login-username", key="username", only_failures=True)  # many addresses guessing one password
 def loginPage(request):
     """
     This method checks if the user is trying to login
-    The code goes ahead to check if the user with the username already exists in the database via the User model
+    The code goes ahead to authenticate the username or email and password the user typed in
     """
     page = "login"
     if request.user.is_authenticated:
@@ -24,23 +46,22 @@ def loginPage(request):
         password = request.POST.get("password")
 
         """
-        The try error catcher checks if the user exist and returns an error message if otherwise. 
-        If user exists, the view uses the django authenticate method to verify user.
-        The error message is rendered by django messages
+        The view uses the django authenticate method to verify the user, which looks the user up by username or email
+        and checks the password in one go (see base/backends.py).
+        If no user matches, the error message is rendered by django messages
         """
-        try:
-            user = User.objects.get(username=username)
-
-        except:
-            pass
         user = authenticate(request, username=username, password=password)
         # this checks if the credentials inputed by the user matches the credentials on the database.
         # A user object that matches the credentials will be outputted
 
         if user is not None:  # if a user object is returned
             login(request, user)  # this creates a session in the browser with the user details
+            ratelimit.trust_login(request)  # the per account limit no longer applies to this user from here
+            metrics.logins.inc("success")
             return redirect("home")  # takes the logged in user to the home page
         else:
+            metrics.logins.inc("failure")
+            ratelimit.failed(request)  # only failed attempts count against the account
             messages.error(request, "Username or password does not exist")
 
     context = {"page": page}
@@ -68,56 +89,201 @@ def registerPage(request):
     return render(request, "base/login_register.html", {"form": form})
 
 
+@read_from_replica
+@cache_control(private=True, no_cache=True)  # browsers keep the page but ask every time whether it changed
+@query_budget(6)  # session and user, then at worst topics, rankings and a two step search when the cache is cold
+@condition(etag_func=home_etag)  # answers 304 when nothing changed since the last visit, see base/conditional.py
 def home(request):
     q = (
         request.GET.get("q") if request.GET.get("q") != None else ""
     )  # q is a variable that stores the value of the input field
     # q would be an empty string if the input field is empty which would match all available room
-    rooms = Room.objects.filter(  # if topic__name is set directly as q, the home page will be empty until a particular topic is selected then a list of rooms bearing that topic will be rendered.
-        Q(topic__name__icontains=q) | Q(name__icontains=q) | Q(description__icontains=q)
-    )
     """
-    the icontains is a non-casesensitive value ensures whatever detail in the topic name is typed in the q variable renders
-    rooms that has that value. E.g, if pyt is typed in the search bar, all python related rooms will be rendered even
-    if it is not completly spelt out. In summary, icontains act as a wildcard....more info @ https://docs.djangoproject.com/en/3.2/ref/models/querysets/#icontains
-    Q in this case is a built in django feature used for filtering data. the | is an 'or' operator.
+    The topic sidebar and the unfiltered room list are the same for every visitor until something changes, so they are
+    served as cached html fragments (see base/caching.py). The room list differs per viewer because hosts get Edit and
+    Delete links, so it is cached per user and page. Searches go to the full-text index and are rendered every time.
     """
-    topics = Topic.objects.all()
-    room_count = rooms.count()
-    context = {"rooms": rooms, "topics": topics, "room_count": room_count}
+    topics_html = cached_fragment(
+        TOPICS, lambda: render_to_string("base/topic_list.html", {"topics": Topic.objects.all()}, request)
+    )
+    # the most active topics and rooms of the last days, counted by the rollup job (base/rollup.py)
+    ranking_html = cached_fragment(
+        RANKINGS,
+        lambda: render_to_string("base/activity_ranking.html", dict(zip(["topics", "rooms"], rankings())), request),
+    )
+
+    # the room list is shown ROOMS_PAGE_SIZE rooms at a time, ?page= picks the page
+    try:
+        page = max(int(request.GET.get("page", 1)), 1)
+    except ValueError:
+        page = 1
+    if page > settings.ROOMS_MAX_PAGE:
+        # every page further down skips more rows (OFFSET) and is one more cached fragment per user, a search narrows
+        # the list instead
+        raise Http404("No such page")
+    offset = (page - 1) * settings.ROOMS_PAGE_SIZE
+
+    if q:
+        # search_rooms looks q up in the full-text index of room names, descriptions and topic names (see base/search.py).
+        # Every word typed is matched as the start of a word, e.g, if pyt is typed in the search bar, all python related
+        # rooms will be rendered even if it is not completly spelt out, and the best matches come first.
+        # The number of matches is not counted here, it comes from the count cache (see base/roomcount.py)
+        rooms = search_rooms(q, settings.ROOMS_PAGE_SIZE + 1, offset)
+        rooms_html = render_room_list(request, rooms, page, q, roomcount.search_count(q))
+    else:
+        rooms_html = cached_fragment(
+            ROOMS,
+            lambda: render_room_list(
+                request,
+                Room.objects.select_related("host", "topic")[offset : offset + settings.ROOMS_PAGE_SIZE + 1],
+                page,
+                q,
+                roomcount.total_rooms(),
+            ),
+            request.user.pk or "anonymous",
+            page,
+        )
+    context = {
+        "topics_html": mark_safe(topics_html),
+        "ranking_html": mark_safe(ranking_html),
+        "rooms_html": mark_safe(rooms_html),
+    }
     return render(request, "base/home.html", context)
 
 
+def render_room_list(request, rooms, page, q, count):
+    """
+    rooms holds one room more than a page when there is a next page, which is how we know without counting
+    """
+    rooms = list(rooms)
+    has_more = len(rooms) > settings.ROOMS_PAGE_SIZE
+    rooms = rooms[: settings.ROOMS_PAGE_SIZE]
+    offset = (page - 1) * settings.ROOMS_PAGE_SIZE
+    context = {
+        "rooms": rooms,
+        "room_count": roomcount.display_count(count, offset, len(rooms), has_more),
+        "q": q,
+        "previous_page": page - 1 if page > 1 else None,
+        "next_page": page + 1 if has_more and page < settings.ROOMS_MAX_PAGE else None,
+    }
+    return render_to_string("base/room_list.html", context, request)
+
+
+@read_from_replica
+@rate_limit("message", key="user")  # checked before anything touches the database, see base/ratelimit.py
+@cache_control(private=True, no_cache=True)
+@query_budget(10)  # posting a message also updates the room counters and participants
+@condition(etag_func=room_etag, last_modified_func=room_last_modified)
 def room(request, pk):
-    room = Room.objects.get(id=pk)
-    room_messages = room.message_set.all().order_by("-created_at")
-    # this is a django built in feature that allows us to access the messages in a room, backward foreign key
+    room = get_object_or_404(Room, id=pk)  # deleted rooms are left out by Room.objects, see base/purge.py
 
     if request.method == "POST":
-        message = Message.objects.create(user=request.user, room=room, body=request.POST.get("body"))
+        fetched = request.headers.get("X-Requested-With") == "fetch"
+        if not request.user.is_authenticated:
+            # a message needs an author, whether it is saved here or by the ingestor
+            return HttpResponse(status=403) if fetched else redirect("login")
+        if settings.MESSAGE_INGEST["ENABLED"]:
+            # the message is written in a batch by a background thread (see base/ingest.py)
+            future = get_ingestor().submit(request.user.id, room.id, request.POST.get("body"))
+            if not fetched:
+                future.result()  # the redirected page has to show the new message
+        else:
+            # built before the transaction, which loads the user: on SQLite a transaction that reads before it writes can
+            # not wait for the write lock and fails with "database is locked" as soon as another post holds it
+            message = Message(user=request.user, room=room, body=request.POST.get("body"))
+            with transaction.atomic():  # the message and the room activity counters are saved together, see base/activity.py
+                message.save()
+        if fetched:
+            # posted by the room page script, the new message reaches every open page (this one too) over the live stream
+            return HttpResponse(status=204)
         return redirect("room", pk=pk)
-    context = {"room": room, "room_messages": room_messages}
+
+    if request.user.is_authenticated:
+        mark_room_read(request.user, room)  # the home page shows the messages posted since, see base/unread.py
+
+    full_history = request.GET.get("history") == "all"
+    if settings.ROOM_STREAMING or full_history:
+        # the page is sent while it is being rendered, see base/streaming.py. The whole history is only ever streamed,
+        # never built in memory
+        return stream_room(request, room, full_history=full_history)
+
+    room_messages, next_cursor = message_page(room)
+    # only the newest page of messages is loaded here, older ones are fetched by roomMessages as the user scrolls back
+    # the rows come from the per-message fragment cache, see base/caching.py
+    context = {"room": room, "message_rows": render_messages(room_messages), "next_cursor": next_cursor}
     return render(request, "base/room.html", context)
 
 
+@query_budget(4)
+def roomMessages(request, pk):
+    """
+    This is the "load older" endpoint for the room page.
+    It returns the page of messages that comes after the ?before= cursor, either as an html fragment that the room page
+    appends to the conversation or as json when the client asks for it with ?format=json or an Accept header.
+    """
+    room = get_object_or_404(Room, id=pk)
+    try:
+        room_messages, next_cursor = message_page(room, cursor=request.GET.get("before"))
+    except InvalidCursor:
+        return HttpResponseBadRequest("Invalid cursor")
+
+    if request.GET.get("format") == "json" or "application/json" in request.headers.get("Accept", ""):
+        data = {
+            "messages": [
+                {
+                    "id": message.id,
+                    "user": message.user.username if message.user else None,
+                    "body": message.body,
+                    "created_at": message.created_at.isoformat(),
+                }
+                for message in room_messages
+            ],
+            "next_cursor": next_cursor,
+        }
+        return JsonResponse(data)
+
+    context = {"room": room, "message_rows": render_messages(room_messages), "next_cursor": next_cursor}
+    return render(request, "base/message_list.html", context)
+
+
+@query_budget(3)
+def unreadCounts(request):
+    """
+    Returns the number of unread messages of every room in ?rooms=1,2,3 for the logged in user, in one query.
+    The home page asks for the rooms it shows, so the cached room list stays the same for every visit.
+    """
+    if not request.user.is_authenticated:
+        return JsonResponse({"unread": {}})
+    try:
+        room_ids = [int(pk) for pk in request.GET.get("rooms", "").split(",") if pk][: settings.UNREAD_MAX_ROOMS]
+    except ValueError:
+        return HttpResponseBadRequest("Invalid room ids")
+    return JsonResponse({"unread": unread_counts(request.user, room_ids)})
+
+
 @login_required(login_url="login")
 # this decorator is used to check if the user is logged in. If not, the user will be redirected to the login page
+@query_budget(5)  # session, user, and on POST the topic check, the insert and the search index. Not the table sizes
 def createRoom(request):
     form = RoomForm()
     if request.method == "POST":
         form = RoomForm(request.POST)
         if form.is_valid():
-            form.save()
-            return redirect("home")
+            room = form.save(commit=False)
+            room.host = request.user  # the host is not a form field, whoever creates the room hosts it
+            room.save()
+            # the home page reads from the replica, which may not have the new room yet
+            return pin_primary(redirect("home"))
 
     context = {"form": form}
     return render(request, "base/room_form.html", context)
 
 
 @login_required(login_url="login")
+@query_budget(6)
 def updateRoom(request, pk):  # pk is the primary key used in referencing the data.
-    room = Room.objects.get(
-        id=pk
+    room = get_object_or_404(
+        Room, id=pk
     )  # you create a variable that would contain the data you are fetching from the database using the ....get(id=pk) which is specific due to the pk you passed in.
     form = RoomForm(
         instance=room
@@ -129,17 +295,71 @@ def updateRoom(request, pk):  # pk is the primary key used in referencing the da
         )  # this is to check if the method is a post method so the instance fetched can be updated with the new values instead of creating another data entirely in the database.
         if form.is_valid():
             form.save()
-            return redirect("home")
+            return pin_primary(redirect("home"))
     context = {"form": form}
     return render(request, "base/room_form.html", context)
 
 
 @login_required(login_url="login")
 def deleteRoom(request, pk):
-    room = Room.objects.get(id=pk)  # fetches the room with the unique id
+    room = get_object_or_404(Room, id=pk)  # fetches the room with the unique id, a 404 once it is deleted
     if request.method == "POST":
-        room.delete()  # deletes the room
-        return redirect("home")  # takes the user back to the home page after the delete is successful
+        soft_delete_room(room)  # hides the room right away, its messages are deleted in the background (base/purge.py)
+        return pin_primary(redirect("home"))  # takes the user back to the home page after the delete is successful
     return render(
         request, "base/delete.html", {"obj": room}
     )  # the 'obj' here references the obj in the delete.html file. For this function, the room is the object
+
+
+@login_required(login_url="login")
+@query_budget(5)  # session and user, then on POST the uniqueness checks of the username and email and the update
+def updateUser(request):
+    user = request.user
+    form = UserForm(instance=user)
+
+    if request.method == "POST":
+        form = UserForm(request.POST, request.FILES, instance=user)
+        if form.is_valid():
+            user = form.save(commit=False)
+            if form.cleaned_data["avatar"]:
+                # stored under its content hash, the thumbnails are made in the background (base/avatars.py)
+                save_avatar(user, form.cleaned_data["avatar"])
+            user.save()
+            return redirect("home")
+
+    return render(request, "base/update_user.html", {"form": form})
+
+
+def avatarView(request, filename):
+    """
+    Serves an avatar thumbnail. Their names are made from the content hash and never get other content, so browsers
+    and proxies may keep them forever. In production the web server should serve MEDIA_ROOT itself, with the same header.
+    """
+    thumbnail = open_thumbnail(filename)
+    if thumbnail is None:
+        raise Http404("No such avatar")
+    response = FileResponse(thumbnail, content_type="image/png")
+    response["Cache-Control"] = "public, max-age=31536000, immutable"
+    return response
+
+
+def autocompleteResponse(matches):
+    return JsonResponse({"results": [{"id": pk, "text": text} for pk, text in matches]})
+
+
+@query_budget(3)
+def topicAutocomplete(request):
+    """
+    Returns the topics whose name starts with ?q=, used by the topic box on the room form (see base/autocomplete.py)
+    """
+    return autocompleteResponse(complete_topics(request.GET.get("q", "")))
+
+
+def metricsView(request):
+    """
+    Serves the metrics of every worker process in the Prometheus text format (see base/metrics.py).
+    When METRICS_TOKEN is set the scraper has to send it as a bearer token.
+    """
+    if settings.METRICS_TOKEN and request.headers.get("Authorization") != f"Bearer {settings.METRICS_TOKEN}":
+        return HttpResponse(status=401)
+    return HttpResponse(metrics.render(metrics.collect()), content_type="text/plain; version=0.0.4; charset=utf-8")
@@ -13,4 +13,10 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+# imported after get_asgi_application() so the apps are loaded
+from base.realtime import RoomEventsRouter  # noqa: E402
+
+# live room updates are streamed by base.realtime, everything else is handled by Django
+application = RoomEventsRouter(django_application)
@@ -31,7 +31,7 @@ BASE_DIR = Path(__file__).resolve().parent.parent
 SECRET_KEY = env("SECRET_KEY")
 
 # SECURITY WARNING: don't run with debug turned on in production!
-DEBUG = os.getenv("DEBUG", False)
+DEBUG = env.bool("DEBUG", default=False)  # parsed, so that DEBUG=False in the environment turns it off
 
 ALLOWED_HOSTS = []
 
@@ -56,16 +56,27 @@ MIDDLEWARE = [
     "django.contrib.auth.middleware.AuthenticationMiddleware",
     "django.contrib.messages.middleware.MessageMiddleware",
     "django.middleware.clickjacking.XFrameOptionsMiddleware",
+    "base.instrumentation.RequestTimingMiddleware",  # keep last, it times the view alone
 ]
 
 ROOT_URLCONF = "config.urls"
 
+# With TEMPLATE_CACHE every template is read and compiled once per process and the compiled template is reused for
+# every render. It is on unless DEBUG is set, so templates edited in development still show up without a restart.
+TEMPLATE_CACHE = env.bool("TEMPLATE_CACHE", default=not DEBUG)
+TEMPLATE_LOADERS = [
+    "django.template.loaders.filesystem.Loader",
+    "django.template.loaders.app_directories.Loader",
+]
+
 TEMPLATES = [
     {
         "BACKEND": "django.template.backends.django.DjangoTemplates",
         "DIRS": [BASE_DIR / "templates"],
-        "APP_DIRS": True,
         "OPTIONS": {
+            "loaders": [("django.template.loaders.cached.Loader", TEMPLATE_LOADERS)]
+            if TEMPLATE_CACHE
+            else TEMPLATE_LOADERS,
             "context_processors": [
                 "django.template.context_processors.debug",
                 "django.template.context_processors.request",
@@ -86,9 +97,63 @@ DATABASES = {
     "default": {
         "ENGINE": "django.db.backends.sqlite3",
         "NAME": BASE_DIR / "db.sqlite3",
+        "CONN_MAX_AGE": env.int("CONN_MAX_AGE", default=600),  # keep connections open between requests
     }
 }
 
+# Optional read replica, see base/routers.py. For SQLite point REPLICA_NAME at a second file kept in sync with
+# "manage.py sync_replica".
+REPLICA_DATABASE = "replica"
+if env("REPLICA_NAME", default=""):
+    DATABASES[REPLICA_DATABASE] = {
+        **DATABASES["default"],
+        "NAME": env("REPLICA_NAME"),
+        # sync_replica replaces the file, a connection only sees the new copy once it is opened again
+        "CONN_MAX_AGE": 0,
+        "TEST": {"MIRROR": "default"},
+    }
+
+DATABASE_ROUTERS = ["base.routers.ReadReplicaRouter"]
+
+# Seconds a user's reads stay on the primary after they wrote something, so they never miss their own changes
+REPLICA_PIN_SECONDS = env.int("REPLICA_PIN_SECONDS", default=5)
+
+# Applied to every new SQLite connection, see base/db.py. The journal mode is written into the database file itself,
+# with DEBUG the development database keeps its rollback journal
+SQLITE_PRAGMAS = {
+    "journal_mode": env("SQLITE_JOURNAL_MODE", default="delete" if DEBUG else "wal"),
+    "synchronous": env("SQLITE_SYNCHRONOUS", default="normal"),
+    "busy_timeout": env.int("SQLITE_BUSY_TIMEOUT", default=5000),  # milliseconds
+    "mmap_size": env.int("SQLITE_MMAP_SIZE", default=256 * 1024 * 1024),  # bytes
+    "cache_size": env.int("SQLITE_CACHE_SIZE", default=-64000),  # negative values are KiB, so 64MB
+    "temp_store": "memory",
+}
+
+
+# Cache
+# https://docs.djangoproject.com/en/3.2/topics/cache/
+# CACHE_URL picks the backend, e.g. locmemcache://, filecache:///var/tmp/buddies, pymemcache://127.0.0.1:11211
+
+CACHES = {
+    "default": env.cache("CACHE_URL", default="locmemcache://"),
+}
+
+# Sessions and the logged in user are read from a per-process LRU, then the shared cache, then the database,
+# see base/authcache.py. SIZE entries are kept per process for at most TTL seconds, users stay SHARED_TIMEOUT seconds
+# in the shared cache.
+SESSION_ENGINE = "base.sessions"
+SESSION_CACHE_ALIAS = "default"
+AUTH_LOCAL_CACHE = {
+    "SIZE": env.int("AUTH_LOCAL_CACHE_SIZE", default=10000),
+    "TTL": env.int("AUTH_LOCAL_CACHE_TTL", default=300),
+    "SHARED_TIMEOUT": env.int("AUTH_SHARED_CACHE_TIMEOUT", default=60 * 60),
+}
+
+# Cache used for the versioned home page fragments, see base/caching.py. Entries are invalidated by bumping a
+# generation number so the timeout only bounds how long unreachable fragments stay around.
+FRAGMENT_CACHE_ALIAS = "default"
+FRAGMENT_CACHE_TIMEOUT = env.int("FRAGMENT_CACHE_TIMEOUT", default=60 * 60 * 24)
+
 
 # Password validation
 # https://docs.djangoproject.com/en/3.2/ref/settings/#auth-password-validators
@@ -127,9 +192,17 @@ USE_TZ = True
 # https://docs.djangoproject.com/en/3.2/howto/static-files/
 
 STATIC_URL = "/static/"
-MEDIA_URL = ""  # specifies the url for user uploaded images
+MEDIA_URL = "/media/"  # specifies the url for user uploaded images
+
+# tells django where to save user uploaded files like profile pictures
+MEDIA_ROOT = env("MEDIA_ROOT", default=str(BASE_DIR / "media"))
+
+# Avatar thumbnails, see base/avatars.py. One square png per size (in pixels) is made by AVATAR_WORKERS processes.
+# Users without an avatar get AVATAR_DEFAULT_URL, an empty url hides the picture.
+AVATAR_SIZES = {"small": 48, "large": 160}
+AVATAR_WORKERS = env.int("AVATAR_WORKERS", default=2)
+AVATAR_DEFAULT_URL = env("AVATAR_DEFAULT_URL", default="")
 
-MEDIA_ROOT = BASE_DIR / ""  # tells django where to save user uploaded files like profile pictures
 # Default primary key field type
 # https://docs.djangoproject.com/en/3.2/ref/settings/#default-auto-field
 
@@ -138,6 +211,111 @@ DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
 AUTH_USER_MODEL = "base.User"
 
 AUTHENTICATION_BACKENDS = [
-    "django.contrib.auth.backends.ModelBackend",
     "base.backends.UserBackend",
 ]
+
+# Number of worker processes verifying password hashes for logins, 0 verifies them in the request thread
+PASSWORD_CHECK_WORKERS = env.int("PASSWORD_CHECK_WORKERS", default=min(4, os.cpu_count() or 1))
+
+# Seconds a failed username/password combination is remembered and rejected without hashing it again
+LOGIN_FAILURE_CACHE_TIMEOUT = env.int("LOGIN_FAILURE_CACHE_TIMEOUT", default=60)
+
+# Number of messages rendered per page in a room, older messages are loaded on demand
+MESSAGES_PAGE_SIZE = env.int("MESSAGES_PAGE_SIZE", default=50)
+
+# Number of rooms per page on the home page
+ROOMS_PAGE_SIZE = env.int("ROOMS_PAGE_SIZE", default=50)
+
+# Deepest ?page= of the home page room list, further pages answer 404
+ROOMS_MAX_PAGE = env.int("ROOMS_MAX_PAGE", default=100)
+
+# Room counts on the home page, see base/roomcount.py. Search counts are recounted in the background once older than
+# TTL seconds, counts above CAP are shown as "CAP+".
+ROOM_COUNT = {
+    "TTL": env.int("ROOM_COUNT_TTL", default=60),
+    "CAP": env.int("ROOM_COUNT_CAP", default=1000),
+}
+
+# Upper bound on the number of ranked rooms returned by a home page search
+SEARCH_MAX_RESULTS = env.int("SEARCH_MAX_RESULTS", default=500)
+
+# Number of rooms one request to the unread counts endpoint may ask for
+UNREAD_MAX_ROOMS = env.int("UNREAD_MAX_ROOMS", default=500)
+
+# Number of suggestions returned by the topic autocomplete endpoint
+AUTOCOMPLETE_LIMIT = env.int("AUTOCOMPLETE_LIMIT", default=10)
+
+# Pub/sub backend that fans new messages out to the live room streams, see base/broker.py.
+# Use base.broker.RedisBroker with {"url": "redis://..."} as OPTIONS when running more than one worker process.
+REALTIME_BROKER = {
+    "BACKEND": env("REALTIME_BROKER_BACKEND", default="base.broker.InProcessBroker"),
+    "OPTIONS": env.json("REALTIME_BROKER_OPTIONS", default={}),
+}
+
+# Seconds between keepalive comments on an idle room stream
+REALTIME_HEARTBEAT = env.int("REALTIME_HEARTBEAT", default=15)
+
+# Write-behind message ingestion, see base/ingest.py. When enabled posted messages are queued and written in batches
+# of up to BATCH_SIZE, at most FLUSH_INTERVAL seconds after they were posted.
+MESSAGE_INGEST = {
+    "ENABLED": env.bool("MESSAGE_INGEST", default=False),
+    "BATCH_SIZE": env.int("MESSAGE_INGEST_BATCH_SIZE", default=100),
+    "FLUSH_INTERVAL": env.float("MESSAGE_INGEST_FLUSH_INTERVAL", default=0.05),
+    "QUEUE_SIZE": env.int("MESSAGE_INGEST_QUEUE_SIZE", default=10000),
+}
+
+# Messages older than this are moved to the compressed archive table by manage.py archive_messages (base/archive.py).
+# Rooms still page back into the archive, only the storage changes.
+MESSAGE_ARCHIVE_AFTER_DAYS = env.int("MESSAGE_ARCHIVE_AFTER_DAYS", default=180)
+
+# Trending topics and most active rooms on the home page, see base/rollup.py. manage.py rollup_activity counts new
+# messages BATCH_SIZE at a time and ranks the TOP topics and rooms by their messages of the last WINDOW_DAYS days.
+ACTIVITY_ROLLUP = {
+    "WINDOW_DAYS": env.int("ACTIVITY_WINDOW_DAYS", default=7),
+    "TOP": env.int("ACTIVITY_TOP", default=10),
+    "BATCH_SIZE": env.int("ACTIVITY_ROLLUP_BATCH_SIZE", default=5000),
+}
+
+# Deleted rooms are hidden at once and purged afterwards, see base/purge.py. Messages are deleted BATCH_SIZE per
+# transaction with PAUSE seconds between batches. With BACKGROUND off nothing is purged until manage.py purge_rooms runs.
+ROOM_PURGE = {
+    "BACKGROUND": env.bool("ROOM_PURGE_BACKGROUND", default=True),
+    "BATCH_SIZE": env.int("ROOM_PURGE_BATCH_SIZE", default=1000),
+    "PAUSE": env.float("ROOM_PURGE_PAUSE", default=0.01),
+}
+
+# Token bucket rate limits, see base/ratelimit.py. RATES maps each limit to (burst, period): up to burst requests at
+# once, refilled at burst requests per period seconds. Use base.ratelimit.SharedMemoryLimiter as BACKEND to share the
+# buckets between the worker processes of a machine (OPTIONS {"path": ..., "slots": ...}).
+RATE_LIMIT = {
+    "ENABLED": env.bool("RATE_LIMIT_ENABLED", default=True),
+    "BACKEND": env("RATE_LIMIT_BACKEND", default="base.ratelimit.InProcessLimiter"),
+    "OPTIONS": env.json("RATE_LIMIT_OPTIONS", default={}),
+    "IP_HEADER": env("RATE_LIMIT_IP_HEADER", default="REMOTE_ADDR"),
+    "RATES": {
+        "message": (20, 60),  # messages posted per user
+        "login-ip": (20, 60),  # login attempts per address
+        "login-username": (5, 60),  # failed login attempts per account
+    },
+    # a username that logged in from an address is not limited per account from there for this many seconds
+    "TRUSTED_LOGIN_SECONDS": env.int("RATE_LIMIT_TRUSTED_LOGIN_SECONDS", default=30 * 24 * 60 * 60),
+}
+
+# Raise base.instrumentation.QueryBudgetExceeded when a view runs more queries than its @query_budget allows,
+# instead of only logging a warning. On by default with DEBUG, turn it on in CI too.
+QUERY_BUDGET_STRICT = env.bool("QUERY_BUDGET_STRICT", default=DEBUG)
+
+# Stream the room page while it renders instead of building it in memory first, see base/streaming.py.
+# ?history=all always streams. Messages are read and sent ROOM_STREAM_CHUNK_SIZE at a time.
+ROOM_STREAMING = env.bool("ROOM_STREAMING", default=False)
+ROOM_STREAM_CHUNK_SIZE = env.int("ROOM_STREAM_CHUNK_SIZE", default=200)
+# Under ASGI the page can not be streamed and is built in memory, so ?history=all only renders this many messages there
+# and links to the older ones like a normal page does.
+ROOM_ASGI_HISTORY_LIMIT = env.int("ROOM_ASGI_HISTORY_LIMIT", default=1000)
+
+# Metrics served at /metrics, see base/metrics.py. With more than one worker process point METRICS_DIR at a directory
+# they all can write to, each process saves its numbers there every METRICS_FLUSH_INTERVAL seconds.
+# With METRICS_TOKEN set, scrapers have to send "Authorization: Bearer <token>".
+METRICS_DIR = env("METRICS_DIR", default="")
+METRICS_FLUSH_INTERVAL = env.float("METRICS_FLUSH_INTERVAL", default=5.0)
+METRICS_TOKEN = env("METRICS_TOKEN", default="")
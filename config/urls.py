@@ -18,11 +18,15 @@ from django.conf.urls.static import static
 from django.contrib import admin
 from django.urls import include, path
 
+from base.views import avatarView, metricsView
+
 admin.site.site_header = "Buddies Admin"
 admin.site.site_title = "Buddies Admin Portal"
 admin.site.index_title = "Admin"
 
 urlpatterns = [
     path("admin/", admin.site.urls),
+    path("metrics", metricsView, name="metrics"),  # scraped by Prometheus
+    path(settings.MEDIA_URL.lstrip("/") + "avatars/<str:filename>", avatarView, name="avatar"),
     path("", include("base.urls")),
 ]